@@ -1,22 +1,65 @@
 # app.py - Flask Backend with AWS S3 Integration and Authentication
-from flask import Flask, request, jsonify, render_template, send_file, session, redirect, url_for
+from flask import Flask, Request, Response, request, jsonify, render_template, session, redirect, url_for
+from flask import before_render_template, template_rendered
 import io  # ADD THIS LINE if not already there
 from flask_mail import Mail, Message  # ADD this line
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
-import boto3
+from werkzeug.http import is_resource_modified, parse_date, unquote_etag
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 from botocore.exceptions import ClientError
+import click
 import os
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 
 import hashlib
+import mimetypes
 import uuid
 from dotenv import load_dotenv
+import asyncio
+import base64
+import contextvars
+import html
 import json
+import math
+import random
+import re
+import sqlite3
+import zipfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from functools import wraps
 
+try:
+    from PIL import Image  # optional: image thumbnails are skipped without Pillow
+except ImportError:
+    Image = None
+
+try:
+    import pymupdf  # optional: PDF previews are skipped without PyMuPDF
+except ImportError:
+    pymupdf = None
+
+try:
+    import zstandard  # optional: STORAGE_COMPRESSION=zstd falls back to gzip without it
+except ImportError:
+    zstandard = None
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # optional: needed for STORAGE_ENCRYPTION
+except ImportError:
+    AESGCM = InvalidTag = None
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -28,6 +71,27 @@ app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey123')
 def health():
     return "OK", 200
 
+@app.route("/ready")
+def ready():
+    """Readiness probe: checks the bucket and local database are reachable"""
+    checks = {}
+    try:
+        s3_client.head_bucket(Bucket=S3_BUCKET)
+        checks['s3'] = 'ok'
+    except Exception as e:
+        checks['s3'] = f'error: {e}'
+    try:
+        get_db().execute('SELECT 1')
+        checks['database'] = 'ok'
+    except Exception as e:
+        checks['database'] = f'error: {e}'
+    healthy = all(value == 'ok' for value in checks.values())
+    return jsonify(checks), 200 if healthy else 503
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 
 # Email Configuration (ADD these lines)
 app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
@@ -37,10 +101,10 @@ app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER')
 
-mail = Mail(app)  # ADD this
+mail = Mail()  # bound in create_app(); Flask-Mail only connects when sending
 
 # Session configuration for production
-app.config['SESSION_COOKIE_SECURE'] = True  # Only send cookies over HTTPS
+app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', 'True') == 'True'  # Only send cookies over HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
@@ -51,38 +115,222 @@ S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'your-bucket-name')
 S3_REGION = os.environ.get('AWS_REGION', 'ap-south-1')
 AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. a local S3 emulator
 
-# Debug: Check if environment variables are loaded
-print("=" * 60)
-print("AWS CONFIGURATION CHECK:")
-print(f"Bucket: {S3_BUCKET}")
-print(f"Region: {S3_REGION}")
-print(f"Access Key: {AWS_ACCESS_KEY[:10] + '...' if AWS_ACCESS_KEY else 'None'}")
-print(f"Secret Key: {'Loaded ✓' if AWS_SECRET_KEY else 'None ✗'}")
-print("=" * 60)
-
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
-    region_name=S3_REGION
-)
-
-# Test S3 connection
-try:
-    s3_client.list_buckets()
-    print("S3 TEST: Connected Successfully ✓")
-except Exception as e:
-    print("S3 TEST FAILED:", e)
+# Async S3 I/O: independent S3 calls run concurrently, at most S3_CONCURRENCY at once
+S3_ASYNC_IO = os.environ.get('S3_ASYNC_IO', 'True') == 'True'
+S3_CONCURRENCY = int(os.environ.get('S3_CONCURRENCY', 32))
+
+# S3 connection pool: keep-alive connections shared by all threads of a worker
+S3_MAX_CONNECTIONS = int(os.environ.get('S3_MAX_CONNECTIONS', max(S3_CONCURRENCY, 10)))
+S3_TCP_KEEPALIVE = os.environ.get('S3_TCP_KEEPALIVE', 'True') == 'True'
+S3_MAX_RETRIES = int(os.environ.get('S3_MAX_RETRIES', 3))
+S3_RETRY_MODE = os.environ.get('S3_RETRY_MODE', 'standard')
+S3_CONNECT_TIMEOUT = float(os.environ.get('S3_CONNECT_TIMEOUT', 5))
+S3_READ_TIMEOUT = float(os.environ.get('S3_READ_TIMEOUT', 60))
+
+# Instrumentation: /metrics is always on; SERVER_TIMING adds a Server-Timing header
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'False') == 'True'
+
+# ==================== S3 CLIENT ====================
+# Created on first use in each process (never at import, never shared across
+# a fork), so worker boot does no network I/O and does not import boto3.
+# Only botocore.exceptions is imported at the top, for ClientError handlers;
+# it loads a few small modules (~10 ms) and none of boto3 or the client.
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    global _s3_client, _s3_client_pid
+    if _s3_client is None or _s3_client_pid != os.getpid():
+        with _s3_client_lock:
+            if _s3_client is None or _s3_client_pid != os.getpid():
+                import boto3
+                from botocore.config import Config
+                client = boto3.client(
+                    's3',
+                    aws_access_key_id=AWS_ACCESS_KEY,
+                    aws_secret_access_key=AWS_SECRET_KEY,
+                    region_name=S3_REGION,
+                    endpoint_url=S3_ENDPOINT_URL,
+                    config=Config(
+                        max_pool_connections=S3_MAX_CONNECTIONS,
+                        tcp_keepalive=S3_TCP_KEEPALIVE,
+                        retries={'max_attempts': S3_MAX_RETRIES, 'mode': S3_RETRY_MODE},
+                        connect_timeout=S3_CONNECT_TIMEOUT,
+                        read_timeout=S3_READ_TIMEOUT
+                    )
+                )
+                client.meta.events.register('before-call.s3', _before_s3_call)
+                client.meta.events.register('after-call.s3', _after_s3_call)
+                client.meta.events.register('after-call-error.s3', _after_s3_call)
+                _s3_client, _s3_client_pid = client, os.getpid()
+    return _s3_client
+
+s3_client = LocalProxy(get_s3_client)
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'zip'}
-MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 16 * 1024 * 1024))  # 16MB default
+
+# Multipart forms are spooled by Werkzeug before a view runs, so request bodies
+# are capped up front (413): the file limit plus room for boundaries, part
+# headers and form fields. Batch uploads carry many files and get their own cap.
+FORM_OVERHEAD = 64 * 1024
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 256 * 1024 * 1024))
+
+# Streaming uploads: memory per upload is about UPLOAD_PART_SIZE * UPLOAD_CONCURRENCY
+UPLOAD_PART_SIZE = max(int(os.environ.get('UPLOAD_PART_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)  # S3 minimum part is 5MB
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 4))
+
+# Resumable uploads: chunks are multipart parts, so each is UPLOAD_PART_SIZE
+UPLOAD_STAGING_PREFIX = 'uploads/'
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))  # seconds without a chunk before GC
+
+# Direct transfers: browsers upload/download straight to S3 with presigned URLs
+DIRECT_TRANSFERS = os.environ.get('DIRECT_TRANSFERS', 'False') == 'True'
+PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', 300))  # seconds
+
+# Deduplicated storage: bytes live once under blobs/<sha256>, user files are pointers.
+# The precheck lets clients skip uploading bytes the server already has; 'user'
+# scope only matches the caller's own files, 'global' matches any user's (this
+# lets anyone who knows a file's hash obtain a copy of it).
+DEDUP_STORAGE = os.environ.get('DEDUP_STORAGE', 'False') == 'True'
+DEDUP_PRECHECK_SCOPE = os.environ.get('DEDUP_PRECHECK_SCOPE', 'user')
+BLOB_PREFIX = 'blobs/'
+# Writers and deleters of a blob object coordinate through blob_claims rows; a
+# claim left behind by a crashed worker is ignored after this many seconds
+BLOB_CLAIM_TIMEOUT = int(os.environ.get('BLOB_CLAIM_TIMEOUT', 300))
+
+# Storage transforms: file bytes are compressed and/or encrypted on their way to S3.
+# STORAGE_COMPRESSION is 'none', 'gzip' or 'zstd' (gzip if zstandard is missing);
+# types that are already compressed are stored as they are. STORAGE_ENCRYPTION
+# needs the cryptography package and STORAGE_MASTER_KEY (32 random bytes, base64),
+# which wraps a data key per user. Presigned direct transfers skip transformed files.
+STORAGE_COMPRESSION = os.environ.get('STORAGE_COMPRESSION', 'none')
+STORAGE_ENCRYPTION = os.environ.get('STORAGE_ENCRYPTION', 'False') == 'True'
+STORAGE_MASTER_KEY = os.environ.get('STORAGE_MASTER_KEY', '')
+ENCRYPTION_FRAME_SIZE = 64 * 1024  # plaintext bytes per AES-GCM frame
+INCOMPRESSIBLE_EXTENSIONS = {'zip', 'docx', 'jpg', 'jpeg', 'png', 'gif'}
+
+# Most files accepted by one batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+
+
+class UploadRequest(Request):
+    """Request whose body limit depends on the endpoint it was routed to"""
+    body_limits = {
+        'batch_upload': BATCH_MAX_BYTES + FORM_OVERHEAD,
+        'upload_chunk': UPLOAD_PART_SIZE + FORM_OVERHEAD,
+    }
+
+    @property
+    def max_content_length(self):
+        return self.body_limits.get(self.endpoint, super().max_content_length)
+
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + FORM_OVERHEAD
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': 'File size exceeds limit'}), 413
+
+# Downloads are streamed from S3 in chunks of this size
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+
+# In-process cache for object metadata. User records are not cached: a
+# stale entry would let other workers accept a password after it was reset.
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 10000))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))  # seconds
+
+# User storage: 'sqlite' (default) or 's3' for the legacy app-data/users.json file
+USER_STORE_BACKEND = os.environ.get('USER_STORE_BACKEND', 'sqlite')
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', 'clouddrive.db')
 
 # User storage in S3
 USERS_FILE_KEY = 'app-data/users.json'
 RESET_TOKENS_KEY = 'app-data/reset-tokens.json'  # ADD this line
 
+# User files live under users/<user_id>/<folder path>/<uuid>_<name>; folders
+# exist as zero-byte '<path>/' marker objects (and implicitly, as prefixes).
+# Keys at the bucket root predate folders: `flask migrate-user-prefixes` moves them.
+USER_PREFIX = 'users/'
+MAX_FOLDER_PATH = 512  # characters; S3 keys top out at 1024 bytes
+MOVE_BATCH_SIZE = int(os.environ.get('MOVE_BATCH_SIZE', 500))  # objects copied per batch by moves/migration
+
+# File index rows live in SQLite; app-data/file-index/<user_id>.json is the
+# older S3 index, imported on first use
+FILE_INDEX_PREFIX = 'app-data/file-index/'
+INTERNAL_PREFIXES = ('app-data/', 'shares/', 'blobs/', 'previews/', 'uploads/')
+FILE_INDEX_TOMBSTONE_DAYS = int(os.environ.get('FILE_INDEX_TOMBSTONE_DAYS', 7))  # how far back ?since= works
+MAX_PAGE_SIZE = 1000
+
+# Integrity: the scrubber re-hashes stored files; VERIFY_ON_DOWNLOAD checks full downloads too
+SCRUB_WORKERS = int(os.environ.get('SCRUB_WORKERS', 4))
+SCRUB_BYTES_PER_SECOND = int(os.environ.get('SCRUB_BYTES_PER_SECOND', 20 * 1024 * 1024))  # 0 = unthrottled
+SCRUB_SLICE_SECONDS = int(os.environ.get('SCRUB_SLICE_SECONDS', 120))  # per background job run
+VERIFY_ON_DOWNLOAD = os.environ.get('VERIFY_ON_DOWNLOAD', 'False') == 'True'
+
+# Rate limits as "<requests>/<seconds>" token buckets, per client IP and per user
+# (the submitted email on auth forms). 'memory' buckets are per process;
+# 'sqlite' shares them between all workers using SQLITE_DB_PATH.
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMITS = {
+    'auth': {
+        'ip': os.environ.get('RATE_LIMIT_AUTH_IP', '20/60'),
+        'user': os.environ.get('RATE_LIMIT_AUTH_USER', '5/60'),
+    },
+    'upload': {
+        'ip': os.environ.get('RATE_LIMIT_UPLOAD_IP', '120/60'),
+        'user': os.environ.get('RATE_LIMIT_UPLOAD_USER', '60/60'),
+    },
+    # Resumable upload chunks: one large file is hundreds of requests
+    'chunk': {
+        'ip': os.environ.get('RATE_LIMIT_CHUNK_IP', '1200/60'),
+        'user': os.environ.get('RATE_LIMIT_CHUNK_USER', '600/60'),
+    },
+}
+# Requests of each kind a worker process runs at once; more get a 503
+CONCURRENCY_LIMITS = {
+    'auth': int(os.environ.get('MAX_CONCURRENT_AUTH', 4)),
+    'upload': int(os.environ.get('MAX_CONCURRENT_UPLOADS', 8)),
+}
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))  # proxies whose X-Forwarded-For is trusted
+
+# Default per-user storage quota in bytes (0 = unlimited); `flask set-quota` overrides it per user
+STORAGE_QUOTA = int(os.environ.get('STORAGE_QUOTA', 200 * 1024 * 1024))
+
+# Background jobs: emails and post-upload work run off the request path.
+# JOB_WORKERS=0 disables in-process workers (run `flask run-jobs` instead).
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 5))  # seconds; doubles per attempt
+JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', 600))
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 300))  # seconds before a running job is presumed dead
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 3600))  # job pruning and token sweeps
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', 1000))
+RESET_TOKEN_TTL = timedelta(hours=1)
+VERIFY_UPLOADS = os.environ.get('VERIFY_UPLOADS', 'direct')  # 'all', 'direct' (client-hashed) or 'none'
+THUMBNAIL_PREFIX = 'previews/'
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))
+THUMBNAIL_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
+# Rendering needs the whole source in memory, so larger files get no preview
+THUMBNAIL_MAX_SOURCE_SIZE = int(os.environ.get('THUMBNAIL_MAX_SOURCE_SIZE', 50 * 1024 * 1024))
+PREVIEW_MAX_AGE = 365 * 24 * 3600  # previews of an immutable key never change
+
+# Search: SQLite FTS5 over filenames, extensions and extracted text (pdf needs PyMuPDF)
+SEARCH_TEXT_EXTENSIONS = {'txt', 'pdf', 'docx'}
+# Extracted text is kept in plain form in SQLite, so with STORAGE_ENCRYPTION
+# it is off unless enabled explicitly (names and extensions stay searchable)
+SEARCH_INDEX_CONTENT = os.environ.get('SEARCH_INDEX_CONTENT', str(not STORAGE_ENCRYPTION)) == 'True'
+SEARCH_TEXT_LIMIT = int(os.environ.get('SEARCH_TEXT_LIMIT', 100000))  # characters indexed per file
+# pdf and docx are parsed in memory, so larger ones are indexed by name only
+SEARCH_MAX_SOURCE_SIZE = int(os.environ.get('SEARCH_MAX_SOURCE_SIZE', 50 * 1024 * 1024))
+SEARCH_PAGE_SIZE = 50
+
 def load_users():
     """Load users from S3"""
     try:
@@ -107,7 +355,7 @@ def save_users(users):
         print(f"Error saving users: {e}")
 
 def load_reset_tokens():
-    """Load reset tokens from S3"""
+    """Load legacy reset tokens from S3 (only read by migrate-tokens)"""
     try:
         response = s3_client.get_object(Bucket=S3_BUCKET, Key=RESET_TOKENS_KEY)
         return json.loads(response['Body'].read().decode('utf-8'))
@@ -117,249 +365,3286 @@ def load_reset_tokens():
         print(f"Error loading reset tokens: {e}")
         return {}
 
-def save_reset_tokens(tokens):
-    """Save reset tokens to S3"""
-    try:
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=RESET_TOKENS_KEY,
-            Body=json.dumps(tokens, indent=4),
-            ContentType='application/json'
-        )
-    except Exception as e:
-        print(f"Error saving reset tokens: {e}")
 
-def login_required(f):
-    """Decorator to check if user is logged in"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_email' not in session:
-            return redirect(url_for('login_page'))
-        return f(*args, **kwargs)
-    return decorated_function
+# ==================== METRICS ====================
+# Per-request stats live in a context variable so S3 calls made from worker
+# threads (which run in a copy of the request's context) are attributed too.
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
 
-def generate_file_hash(file_content):
-    return hashlib.sha256(file_content).hexdigest()
+class Histogram:
+    """Cumulative Prometheus-style histogram"""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
 
-# ==================== AUTHENTICATION ROUTES ====================
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.s3_calls = defaultdict(lambda: [0, 0.0])  # operation -> [count, seconds]
+        self.spans = defaultdict(float)  # span name -> seconds
+        self.template_started = None
 
-@app.route('/login')
-def login_page():
-    if 'user_email' in session:
-        return redirect(url_for('index'))
-    return render_template('login.html')
+_metrics_lock = threading.Lock()
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+request_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (endpoint, method)
+request_s3_calls = defaultdict(lambda: Histogram(COUNT_BUCKETS))  # endpoint
+request_counts = defaultdict(int)  # (endpoint, method, status)
+s3_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # operation
+s3_errors = defaultdict(int)  # operation
+span_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # span
+bytes_in = defaultdict(int)  # endpoint
+bytes_out = defaultdict(int)  # endpoint
+job_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # kind
+job_outcomes = defaultdict(int)  # (kind, outcome)
+rejected_requests = defaultdict(int)  # (limit, reason)
+integrity_checks = defaultdict(int)  # (source, status)
 
-@app.route('/signup')
-def signup_page():
-    if 'user_email' in session:
-        return redirect(url_for('index'))
-    return render_template('signup.html')
+def record_span(name, seconds):
+    """Add to the current request's total for a span (observed when the request ends)"""
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.spans[name] += seconds
+    else:
+        with _metrics_lock:
+            span_latency[name].observe(seconds)
 
-@app.route('/login', methods=['POST'])
-def login():
+@contextmanager
+def timed_span(name):
+    """Time a block (password hashing, file hashing, ...) for metrics and Server-Timing"""
+    started = time.perf_counter()
     try:
-        email = request.form.get('email')
-        password = request.form.get('password')
-        
-        if not email or not password:
-            return render_template('login.html', error='Please provide email and password')
-        
-        users = load_users()
-        
-        if email not in users:
-            return render_template('login.html', error='Invalid email or password')
-        
-        if not check_password_hash(users[email]['password'], password):
-            return render_template('login.html', error='Invalid email or password')
-        
-        session['user_email'] = email
-        session['user_id'] = users[email]['user_id']
-        return redirect(url_for('index'))
-        
-    except Exception as e:
-        return render_template('login.html', error=str(e))
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
 
-@app.route('/signup', methods=['POST'])
-def signup():
+def _before_s3_call(model, context, **kwargs):
+    context['metrics_operation'] = model.name
+    context['metrics_started'] = time.perf_counter()
+
+def _after_s3_call(context, **kwargs):
+    started = context.get('metrics_started')
+    if started is None:
+        return
+    operation = context['metrics_operation']
+    elapsed = time.perf_counter() - started
+    http_response = kwargs.get('http_response')
+    failed = http_response is None or http_response.status_code >= 400
+    with _metrics_lock:
+        s3_latency[operation].observe(elapsed)
+        if failed:
+            s3_errors[operation] += 1
+    stats = _request_stats.get()
+    if stats is not None:
+        call = stats.s3_calls[operation]
+        call[0] += 1
+        call[1] += elapsed
+
+def _template_started(sender, template, context, **extra):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.template_started = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    stats = _request_stats.get()
+    if stats is not None and stats.template_started is not None:
+        record_span('template', time.perf_counter() - stats.template_started)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
+
+def request_endpoint():
+    """Route pattern (not the concrete path) so keys don't explode label cardinality"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+def _count_bytes(iterable, endpoint):
     try:
-        email = request.form.get('email')
-        password = request.form.get('password')
-        
-        if not email or not password:
-            return render_template('signup.html', error='Please provide email and password')
-        
-        if len(password) < 6:
-            return render_template('signup.html', error='Password must be at least 6 characters')
-        
-        users = load_users()
-        
-        if email in users:
-            return render_template('signup.html', error='Email already registered')
-        
-        users[email] = {
-            'user_id': str(uuid.uuid4()),
-            'password': generate_password_hash(password),
-            'created_at': datetime.now().isoformat()
-        }
-        
-        save_users(users)
-        
-        session['user_email'] = email
-        session['user_id'] = users[email]['user_id']
-        return redirect(url_for('index'))
-        
-    except Exception as e:
-        return render_template('signup.html', error=str(e))
+        for chunk in iterable:
+            with _metrics_lock:
+                bytes_out[endpoint] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
 
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('login_page'))
+@app.before_request
+def start_request_metrics():
+    _request_stats.set(RequestStats())
 
-# ==================== PASSWORD RESET ROUTES ====================
+@app.after_request
+def finish_request_metrics(response):
+    stats = _request_stats.get()
+    if stats is None:
+        return response
+    endpoint = request_endpoint()
+    elapsed = time.perf_counter() - stats.started
+    s3_count = sum(count for count, _ in stats.s3_calls.values())
+    
+    with _metrics_lock:
+        request_latency[(endpoint, request.method)].observe(elapsed)
+        request_s3_calls[endpoint].observe(s3_count)
+        request_counts[(endpoint, request.method, response.status_code)] += 1
+        for name, seconds in stats.spans.items():
+            span_latency[name].observe(seconds)
+        bytes_in[endpoint] += request.content_length or 0
+        if not response.is_streamed:
+            bytes_out[endpoint] += response.calculate_content_length() or 0
+    if response.is_streamed:
+        response.response = _count_bytes(response.response, endpoint)
+    
+    if SERVER_TIMING:
+        timings = [f'app;dur={elapsed * 1000:.1f}']
+        for operation, (count, seconds) in stats.s3_calls.items():
+            timings.append(f's3-{operation};dur={seconds * 1000:.1f};desc="{count} calls"')
+        for name, seconds in stats.spans.items():
+            timings.append(f'{name};dur={seconds * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
 
-@app.route('/forgot-password')
-def forgot_password_page():
-    """Display forgot password page"""
-    if 'user_email' in session:
-        return redirect(url_for('index'))
-    return render_template('forgot_password.html')
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-@app.route('/forgot-password', methods=['POST'])
-def forgot_password():
-    """Handle password reset request"""
+def _render_histograms(lines, name, help_text, histograms, label_names):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for label_values, histogram in sorted(histograms.items()):
+        if not isinstance(label_values, tuple):
+            label_values = (label_values,)
+        labels = ','.join(f'{n}="{_escape_label(v)}"' for n, v in zip(label_names, label_values))
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.total}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.total}')
+
+def _render_counter(lines, name, help_text, values, label_names, metric_type='counter'):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {metric_type}')
+    for label_values, value in sorted(values.items()):
+        if not isinstance(label_values, tuple):
+            label_values = (label_values,)
+        labels = ','.join(f'{n}="{_escape_label(v)}"' for n, v in zip(label_names, label_values))
+        lines.append(f'{name}{{{labels}}} {value}')
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _metrics_lock:
+        _render_histograms(lines, 'clouddrive_request_duration_seconds', 'Request latency by route.',
+                           request_latency, ('endpoint', 'method'))
+        _render_counter(lines, 'clouddrive_requests_total', 'Requests by route and status.',
+                        request_counts, ('endpoint', 'method', 'status'))
+        _render_histograms(lines, 'clouddrive_request_s3_calls', 'S3 operations issued per request.',
+                           request_s3_calls, ('endpoint',))
+        _render_histograms(lines, 'clouddrive_s3_operation_duration_seconds', 'S3 operation latency.',
+                           s3_latency, ('operation',))
+        _render_counter(lines, 'clouddrive_s3_errors_total', 'Failed S3 operations.',
+                        s3_errors, ('operation',))
+        _render_histograms(lines, 'clouddrive_span_duration_seconds',
+                           'Time spent hashing passwords and files and rendering templates.',
+                           span_latency, ('span',))
+        _render_counter(lines, 'clouddrive_request_bytes_total', 'Request body bytes received.',
+                        bytes_in, ('endpoint',))
+        _render_counter(lines, 'clouddrive_response_bytes_total', 'Response body bytes sent.',
+                        bytes_out, ('endpoint',))
+        _render_histograms(lines, 'clouddrive_job_duration_seconds', 'Background job run time.',
+                           job_latency, ('kind',))
+        _render_counter(lines, 'clouddrive_job_runs_total', 'Background job runs by outcome.',
+                        job_outcomes, ('kind', 'outcome'))
+        _render_counter(lines, 'clouddrive_integrity_checks_total',
+                        'Stored files re-hashed, by source (scrub, job, download) and result.',
+                        integrity_checks, ('source', 'status'))
+        _render_counter(lines, 'clouddrive_rejected_requests_total',
+                        'Requests refused by rate limits (429) or concurrency caps (503).',
+                        rejected_requests, ('limit', 'reason'))
     try:
-        email = request.form.get('email')
-        
-        if not email:
-            return render_template('forgot_password.html', error='Please provide your email')
-        
-        users = load_users()
-        
-        if email not in users:
-            return render_template('forgot_password.html', 
-                success='If an account exists with this email, you will receive a password reset link.')
-        
-        # Generate reset token
-        reset_token = str(uuid.uuid4())
-        expiry_time = datetime.now() + timedelta(hours=1)
-        
-        # Store token
-        tokens = load_reset_tokens()
-        tokens[reset_token] = {
-            'email': email,
-            'expiry': expiry_time.isoformat(),
-            'used': False
-        }
-        save_reset_tokens(tokens)
-        
-        # Send email
-        base_url = os.environ.get("BASE_URL", request.host_url.rstrip("/"))
-        reset_link = f"{request.host_url}reset-password/{reset_token}"
-        
-        msg = Message(
-            subject='CloudDrive - Password Reset Request',
-            recipients=[email]
-        )
-        msg.html = f"""
-        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-            <h2 style="color: #667eea;">CloudDrive Password Reset</h2>
-            <p>Hi there,</p>
-            <p>You recently requested to reset your password for your CloudDrive account.</p>
-            <p>Click the button below to reset your password:</p>
-            <div style="text-align: center; margin: 30px 0;">
-                <a href="{reset_link}" 
-                   style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                          color: white;
-                          padding: 12px 30px;
-                          text-decoration: none;
-                          border-radius: 8px;
-                          display: inline-block;
-                          font-weight: bold;">
-                    Reset Password
-                </a>
-            </div>
-            <p>Or copy and paste this link into your browser:</p>
-            <p style="background: #f5f5f5; padding: 10px; border-radius: 5px; word-break: break-all;">
-                {reset_link}
-            </p>
-            <p style="color: #666; font-size: 0.9em;">
-                This link will expire in 1 hour.
-            </p>
-            <p style="color: #666; font-size: 0.9em;">
-                If you didn't request a password reset, you can safely ignore this email.
-            </p>
-            <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
-            <p style="color: #999; font-size: 0.8em;">
-                CloudDrive - Secure File Storage System
-            </p>
-        </div>
-        """
-        
-        mail.send(msg)
-        
-        return render_template('forgot_password.html', 
-            success='If an account exists with this email, you will receive a password reset link.')
-        
-    except Exception as e:
-        print(f"Error in forgot_password: {e}")
-        return render_template('forgot_password.html', 
-            error='An error occurred. Please try again later.')
+        _render_counter(lines, 'clouddrive_jobs', 'Background jobs by kind and status.',
+                        job_counts(), ('kind', 'status'), 'gauge')
+    except sqlite3.Error:
+        pass
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    for field, metric_type in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('size', 'gauge')):
+        suffix = '_total' if metric_type == 'counter' else ''
+        _render_counter(lines, f'clouddrive_cache_{field}{suffix}', f'Cache {field}.',
+                        {name: stats[field] for name, stats in cache_stats.items()}, ('cache',), metric_type)
+    return '\n'.join(lines) + '\n'
 
-@app.route('/reset-password/<token>')
-def reset_password_page(token):
-    """Display reset password page"""
-    if 'user_email' in session:
-        return redirect(url_for('index'))
+# ==================== ASYNC S3 I/O ====================
+# boto3 clients are thread-safe, so each call runs on a shared executor and
+# asyncio gathers them under a semaphore. Flask views stay synchronous and
+# call s3_map(), which also has a plain sequential mode (S3_ASYNC_IO=False).
+
+_s3_executor = ThreadPoolExecutor(max_workers=S3_CONCURRENCY, thread_name_prefix='s3-io')
+
+async def _gather_s3(operation, calls, concurrency):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    method = getattr(s3_client, operation)
     
-    tokens = load_reset_tokens()
+    context = contextvars.copy_context()
     
-    if token not in tokens:
-        return render_template('reset_password.html', error='Invalid or expired reset link')
+    async def run(kwargs):
+        async with semaphore:
+            return await loop.run_in_executor(
+                _s3_executor, lambda: context.copy().run(method, Bucket=S3_BUCKET, **kwargs)
+            )
     
-    token_data = tokens[token]
+    return await asyncio.gather(*(run(kwargs) for kwargs in calls), return_exceptions=True)
+
+def s3_map(operation, calls, concurrency=None):
+    """Run one S3 operation for each kwargs dict; returns results (or exceptions) in order"""
+    calls = list(calls)
+    if not S3_ASYNC_IO or len(calls) < 2:
+        results = []
+        method = getattr(s3_client, operation)
+        for kwargs in calls:
+            try:
+                results.append(method(Bucket=S3_BUCKET, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+    return asyncio.run(_gather_s3(operation, calls, concurrency or S3_CONCURRENCY))
+
+# ==================== CACHE ====================
+
+caches = {}
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds"""
     
-    expiry_time = datetime.fromisoformat(token_data['expiry'])
-    if datetime.now() > expiry_time:
-        return render_template('reset_password.html', error='This reset link has expired')
+    def __init__(self, name, maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        caches[name] = self
     
-    if token_data.get('used', False):
-        return render_template('reset_password.html', error='This reset link has already been used')
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
     
-    return render_template('reset_password.html', token=token)
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def get_or_load(self, key, loader):
+        """Return the cached value, calling loader() on a miss (None is not cached)"""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
 
-@app.route('/reset-password/<token>', methods=['POST'])
-def reset_password(token):
-    """Handle password reset"""
-    try:
-        new_password = request.form.get('password')
-        confirm_password = request.form.get('confirm_password')
-        
-        if not new_password or not confirm_password:
-            return render_template('reset_password.html', token=token, 
-                error='Please provide both password fields')
-        
-        if new_password != confirm_password:
-            return render_template('reset_password.html', token=token,
-                error='Passwords do not match')
-        
-        if len(new_password) < 6:
-            return render_template('reset_password.html', token=token,
-                error='Password must be at least 6 characters')
-        
-        tokens = load_reset_tokens()
-        
-        if token not in tokens:
-            return render_template('reset_password.html', token=token,
-                error='Invalid or expired reset link')
-        
-        token_data = tokens[token]
-        
-        expiry_time = datetime.fromisoformat(token_data['expiry'])
-        if datetime.now() > expiry_time:
+object_metadata_cache = TTLCache('object_metadata')
+
+def get_object_metadata(key):
+    """S3 user metadata for a key (ownership checks), cached"""
+    return object_metadata_cache.get_or_load(
+        key, lambda: s3_client.head_object(Bucket=S3_BUCKET, Key=key)['Metadata']
+    )
+
+# ==================== LOCAL DATABASE ====================
+
+DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        email TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        user_id TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        run_after REAL NOT NULL,
+        last_error TEXT,
+        result TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, run_after)',
+    'CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at)',
+    """CREATE TABLE IF NOT EXISTS shares (
+        token TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        owner_id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS shares_expiry ON shares (expires_at)',
+    'CREATE INDEX IF NOT EXISTS shares_owner ON shares (owner_id, expires_at)',
+    'CREATE INDEX IF NOT EXISTS shares_key ON shares (key)',
+    """CREATE TABLE IF NOT EXISTS reset_tokens (
+        token TEXT PRIMARY KEY,
+        email TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        used INTEGER NOT NULL DEFAULT 0
+    )""",
+    'CREATE INDEX IF NOT EXISTS reset_tokens_expiry ON reset_tokens (expires_at)',
+    """CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        user_email TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        key TEXT NOT NULL,
+        staging_key TEXT NOT NULL,
+        s3_upload_id TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        chunks INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        job_id TEXT,
+        result TEXT,
+        created_at TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS upload_sessions_updated ON upload_sessions (updated_at)',
+    """CREATE TABLE IF NOT EXISTS blob_claims (
+        id TEXT PRIMARY KEY,
+        hash TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        started_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS blob_claims_hash ON blob_claims (hash)',
+    """CREATE TABLE IF NOT EXISTS upload_blob_refs (
+        session_id TEXT PRIMARY KEY,
+        hash TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS search_docs (
+        id INTEGER PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        user_id TEXT NOT NULL,
+        ext TEXT NOT NULL,
+        folder TEXT NOT NULL,
+        last_modified TEXT NOT NULL,
+        entry TEXT NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS search_docs_user ON search_docs (user_id, last_modified)',
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+        owner, filename, ext, content,
+        prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TABLE IF NOT EXISTS search_users (
+        user_id TEXT PRIMARY KEY,
+        indexed_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS data_keys (
+        key_id TEXT PRIMARY KEY,
+        wrapped_key BLOB NOT NULL,
+        created_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS scrub_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TEXT NOT NULL,
+        finished_at TEXT,
+        checkpoint_user TEXT NOT NULL DEFAULT '',
+        checkpoint_key TEXT NOT NULL DEFAULT '',
+        files INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS integrity_failures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        expected TEXT,
+        actual TEXT,
+        source TEXT NOT NULL,
+        found_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS rate_limits (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        allowed INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS file_index (
+        user_id TEXT NOT NULL,
+        key TEXT NOT NULL,
+        entry TEXT,
+        size INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, key)
+    )""",
+    'CREATE INDEX IF NOT EXISTS file_index_updated ON file_index (user_id, updated_at)',
+    # One per /api/files sort; the expressions must match SORT_COLUMNS
+    "CREATE INDEX IF NOT EXISTS file_index_name ON file_index "
+    "(user_id, lower(json_extract(entry, '$.filename')), key) WHERE entry IS NOT NULL",
+    'CREATE INDEX IF NOT EXISTS file_index_size ON file_index (user_id, size, key) WHERE entry IS NOT NULL',
+    "CREATE INDEX IF NOT EXISTS file_index_date ON file_index "
+    "(user_id, json_extract(entry, '$.last_modified'), key) WHERE entry IS NOT NULL",
+    """CREATE TABLE IF NOT EXISTS file_index_users (
+        user_id TEXT PRIMARY KEY,
+        pruned_before TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS usage (
+        user_id TEXT PRIMARY KEY,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        files INTEGER NOT NULL DEFAULT 0,
+        quota INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS upload_chunks (
+        session_id TEXT NOT NULL,
+        number INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        etag TEXT NOT NULL,
+        PRIMARY KEY (session_id, number)
+    )""",
+]
+
+_db_local = threading.local()
+
+def get_db():
+    """Per-thread SQLite connection; WAL mode lets readers run alongside a writer"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SQLITE_DB_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            for statement in DB_SCHEMA:
+                conn.execute(statement)
+        _db_local.conn = conn
+    return conn
+
+# ==================== USER STORE ====================
+
+class SQLiteUserStore:
+    """Users in a local SQLite table: point lookups and single-row atomic writes"""
+    
+    def get(self, email):
+        row = get_db().execute(
+            'SELECT user_id, password, created_at FROM users WHERE email = ?', (email,)
+        ).fetchone()
+        return dict(row) if row else None
+    
+    def create(self, email, user):
+        """Insert a user; returns False if the email is already registered"""
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    'INSERT INTO users (email, user_id, password, created_at) VALUES (?, ?, ?, ?)',
+                    (email, user['user_id'], user['password'], user['created_at'])
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+    
+    def update_password(self, email, password_hash):
+        """Returns False if there is no such user"""
+        with get_db() as conn:
+            cursor = conn.execute('UPDATE users SET password = ? WHERE email = ?', (password_hash, email))
+        return cursor.rowcount == 1
+    
+    def all(self):
+        rows = get_db().execute('SELECT email, user_id, password, created_at FROM users').fetchall()
+        return {row['email']: {k: row[k] for k in ('user_id', 'password', 'created_at')} for row in rows}
+
+class S3UserStore:
+    """Legacy backend: the whole users.json is read and rewritten on each change"""
+    
+    def get(self, email):
+        return load_users().get(email)
+    
+    def create(self, email, user):
+        users = load_users()
+        if email in users:
+            return False
+        users[email] = user
+        save_users(users)
+        return True
+    
+    def update_password(self, email, password_hash):
+        users = load_users()
+        if email not in users:
+            return False
+        users[email]['password'] = password_hash
+        save_users(users)
+        return True
+    
+    def all(self):
+        return load_users()
+
+user_store = S3UserStore() if USER_STORE_BACKEND == 's3' else SQLiteUserStore()
+
+def migrate_users_to_sqlite():
+    """Copy users.json into the SQLite store; returns (copied, skipped)"""
+    store = SQLiteUserStore()
+    copied = skipped = 0
+    for email, user in load_users().items():
+        if store.create(email, user):
+            copied += 1
+        else:
+            skipped += 1
+    return copied, skipped
+
+@app.cli.command('migrate-users')
+def migrate_users_command():
+    """One-shot copy of app-data/users.json into the SQLite user store."""
+    copied, skipped = migrate_users_to_sqlite()
+    print(f"Migrated {copied} users ({skipped} already present)")
+
+# ==================== SHARES AND RESET TOKENS ====================
+# Share links and reset tokens are rows keyed by token, with an index on
+# expiry so the sweeper deletes expired rows without scanning live ones.
+# Expiry times are epoch seconds; the dicts handed to routes keep the old
+# naive-local ISO 'expiry' field.
+
+def share_record(row):
+    return {
+        'token': row['token'],
+        'key': row['key'],
+        'filename': row['filename'],
+        'owner_id': row['owner_id'],
+        'expiry': datetime.fromtimestamp(row['expires_at']).isoformat()
+    }
+
+def create_share(key, filename, owner_id, expiry_time):
+    """Store a share link for key; returns its record"""
+    token = str(uuid.uuid4())
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO shares (token, key, filename, owner_id, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (token, key, filename, owner_id, datetime.now(timezone.utc).isoformat(), expiry_time.timestamp())
+        )
+    return {'token': token, 'key': key, 'filename': filename, 'owner_id': owner_id,
+            'expiry': expiry_time.isoformat()}
+
+def load_share(token):
+    """Share record for a token; falls back to a legacy shares/<token>.json object"""
+    row = get_db().execute('SELECT * FROM shares WHERE token = ?', (token,)).fetchone()
+    if row is not None:
+        return share_record(row)
+    # Raises ClientError (NoSuchKey) for unknown tokens
+    share_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f'shares/{token}.json')
+    return json.loads(share_obj['Body'].read().decode('utf-8'))
+
+def list_shares(owner_id):
+    """A user's unexpired share links, soonest expiry first"""
+    rows = get_db().execute(
+        'SELECT * FROM shares WHERE owner_id = ? AND expires_at > ? ORDER BY expires_at',
+        (owner_id, time.time())
+    ).fetchall()
+    return [share_record(row) for row in rows]
+
+def revoke_share(token, owner_id):
+    """Delete a share link; returns False if the user has no such link"""
+    with get_db() as conn:
+        cursor = conn.execute('DELETE FROM shares WHERE token = ? AND owner_id = ?', (token, owner_id))
+    return cursor.rowcount == 1
+
+def delete_shares_for_keys(keys):
+    """Drop share links to deleted files"""
+    with get_db() as conn:
+        conn.executemany('DELETE FROM shares WHERE key = ?', [(key,) for key in keys])
+
+def rekey_shares(renamed):
+    """Point share links at moved files: renamed maps old key -> new key"""
+    with get_db() as conn:
+        conn.executemany('UPDATE shares SET key = ? WHERE key = ?', [(new, old) for old, new in renamed.items()])
+
+def create_reset_token(email):
+    token = str(uuid.uuid4())
+    with get_db() as conn:
+        conn.execute('INSERT INTO reset_tokens (token, email, expires_at) VALUES (?, ?, ?)',
+                     (token, email, (datetime.now() + RESET_TOKEN_TTL).timestamp()))
+    return token
+
+def get_reset_token(token):
+    """{'email', 'expiry', 'used'} for a reset token, or None"""
+    row = get_db().execute('SELECT * FROM reset_tokens WHERE token = ?', (token,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'email': row['email'],
+        'expiry': datetime.fromtimestamp(row['expires_at']).isoformat(),
+        'used': bool(row['used'])
+    }
+
+def use_reset_token(token):
+    """Mark a token used; returns False if it was already used (so it works exactly once)"""
+    with get_db() as conn:
+        cursor = conn.execute('UPDATE reset_tokens SET used = 1 WHERE token = ? AND used = 0', (token,))
+    return cursor.rowcount == 1
+
+def sweep_expired_tokens(batch_size=SWEEP_BATCH_SIZE):
+    """Delete expired shares and reset tokens in batches; returns (shares, tokens) deleted"""
+    now = time.time()
+    deleted = []
+    for table, column in (('shares', 'token'), ('reset_tokens', 'token')):
+        total = 0
+        while True:
+            # Short transactions, so a large backlog never holds the write lock for long
+            with get_db() as conn:
+                cursor = conn.execute(
+                    f'DELETE FROM {table} WHERE {column} IN '
+                    f'(SELECT {column} FROM {table} WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)',
+                    (now, batch_size)
+                )
+            total += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+        deleted.append(total)
+    return tuple(deleted)
+
+def migrate_tokens_to_sqlite():
+    """Move legacy shares/*.json objects and reset-tokens.json into SQLite.
+
+    Expired records are dropped rather than copied. Returns (shares, tokens) copied.
+    """
+    now = datetime.now()
+    share_keys = [obj['Key'] for obj in iter_bucket_objects('shares/') if obj['Key'].endswith('.json')]
+    responses = s3_map('get_object', [{'Key': key} for key in share_keys])
+    copied_shares = 0
+    with get_db() as conn:
+        for response in responses:
+            if isinstance(response, Exception):
+                continue
+            share = json.loads(response['Body'].read().decode('utf-8'))
+            expiry_time = datetime.fromisoformat(share['expiry'])
+            if expiry_time > now:
+                conn.execute(
+                    'INSERT OR IGNORE INTO shares (token, key, filename, owner_id, created_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (share['token'], share['key'], share['filename'], share['owner_id'],
+                     datetime.now(timezone.utc).isoformat(), expiry_time.timestamp())
+                )
+                copied_shares += 1
+    
+    copied_tokens = 0
+    with get_db() as conn:
+        for token, data in load_reset_tokens().items():
+            expiry_time = datetime.fromisoformat(data['expiry'])
+            if expiry_time > now and not data.get('used'):
+                conn.execute('INSERT OR IGNORE INTO reset_tokens (token, email, expires_at) VALUES (?, ?, ?)',
+                             (token, data['email'], expiry_time.timestamp()))
+                copied_tokens += 1
+    
+    delete_keys(share_keys + [RESET_TOKENS_KEY])
+    return copied_shares, copied_tokens
+
+@app.cli.command('migrate-tokens')
+def migrate_tokens_command():
+    """One-shot move of legacy S3 share records and reset tokens into SQLite."""
+    shares, tokens = migrate_tokens_to_sqlite()
+    print(f"Migrated {shares} active shares and {tokens} active reset tokens")
+
+@app.cli.command('sweep-tokens')
+def sweep_tokens_command():
+    """Delete expired share links and reset tokens now."""
+    shares, tokens = sweep_expired_tokens()
+    print(f"Deleted {shares} expired shares and {tokens} expired reset tokens")
+
+# ==================== FILE INDEX ====================
+# One SQLite row per file, keyed by (user_id, key), so listing is a local
+# query instead of a bucket scan plus a head_object per key. Every worker
+# process shares the database and each change is a single write
+# transaction, so concurrent uploads for one user cannot lose entries.
+# A removed file leaves a tombstone row (entry NULL) for ?since= sync.
+
+def load_legacy_file_index(user_id):
+    """The JSON index kept in S3 before the index moved to SQLite, or None"""
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=f'{FILE_INDEX_PREFIX}{user_id}.json')
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+
+def load_file_index(user_id):
+    """A user's index as {'files', 'deleted', 'pruned_before'}, or None if it has never been built"""
+    conn = get_db()
+    user = conn.execute('SELECT pruned_before FROM file_index_users WHERE user_id = ?', (user_id,)).fetchone()
+    if user is None:
+        return None
+    index = {'files': {}, 'deleted': {}, 'pruned_before': user['pruned_before']}
+    for row in conn.execute('SELECT key, entry, updated_at FROM file_index WHERE user_id = ?', (user_id,)):
+        if row['entry'] is None:
+            index['deleted'][row['key']] = row['updated_at']
+        else:
+            index['files'][row['key']] = json.loads(row['entry'])
+    return index
+
+def get_file_index(user_id):
+    ensure_file_index(user_id)
+    return load_file_index(user_id)
+
+def get_file_entries(user_id, keys):
+    """{key: entry} for those of keys the user owns"""
+    keys = list(dict.fromkeys(keys))
+    entries = {}
+    for start in range(0, len(keys), 500):  # stays under SQLite's bound parameter limit
+        chunk = keys[start:start + 500]
+        rows = get_db().execute(
+            'SELECT key, entry FROM file_index WHERE user_id = ? AND entry IS NOT NULL '
+            f"AND key IN ({', '.join('?' * len(chunk))})", [user_id] + chunk
+        )
+        entries.update((row['key'], json.loads(row['entry'])) for row in rows)
+    return entries
+
+def get_file_entry(user_id, key):
+    """Index entry of key if the user owns it, else None.
+
+    Access checks use this rather than cached S3 metadata, which another
+    worker may have left stale after a delete.
+    """
+    ensure_file_index(user_id)
+    return get_file_entries(user_id, [key]).get(key)
+
+def prefix_range(prefix):
+    """(low, high) bounds of the keys starting with prefix, for an indexed range scan"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def entries_under(user_id, prefix):
+    """Index entries of the user's files whose keys start with prefix"""
+    rows = get_db().execute(
+        'SELECT entry FROM file_index WHERE user_id = ? AND key >= ? AND key < ? AND entry IS NOT NULL',
+        (user_id, *prefix_range(prefix))
+    )
+    return [json.loads(row['entry']) for row in rows]
+
+def root_file_entries(user_id):
+    """Entries of files uploaded before folders existed, which sit outside users/"""
+    rows = get_db().execute(
+        'SELECT entry FROM file_index WHERE user_id = ? AND NOT (key >= ? AND key < ?) AND entry IS NOT NULL',
+        (user_id, *prefix_range(USER_PREFIX))
+    )
+    return [json.loads(row['entry']) for row in rows]
+
+def user_has_blob(user_id, blob_hash):
+    return get_db().execute(
+        "SELECT 1 FROM file_index WHERE user_id = ? AND json_extract(entry, '$.blob_hash') = ? LIMIT 1",
+        (user_id, blob_hash)
+    ).fetchone() is not None
+
+def file_index_entry(key, metadata, size, last_modified):
+    """Build an index entry from S3 object metadata"""
+    entry = {
+        'key': key,
+        'filename': metadata.get('original-filename', key),
+        'size': size,
+        'last_modified': last_modified,
+        'file_hash': metadata.get('file-hash', 'N/A')
+    }
+    if metadata.get('plain-size'):
+        entry['size'] = int(metadata['plain-size'])  # size is of the compressed/encrypted object
+    if metadata.get('blob-hash'):
+        entry['blob_hash'] = metadata['blob-hash']
+        entry['size'] = int(metadata.get('blob-size', size))
+    return entry
+
+def replace_file_index(user_id, files, only_if_missing=False):
+    """Set a user's whole index to files ({key: entry}) and reset their usage counters.
+
+    Clients syncing with ?since= are told to re-list, since tombstones are
+    dropped. With only_if_missing, an index another worker built first wins.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if only_if_missing and conn.execute(
+            'SELECT 1 FROM file_index_users WHERE user_id = ?', (user_id,)
+        ).fetchone():
+            return
+        conn.execute('DELETE FROM file_index WHERE user_id = ?', (user_id,))
+        conn.executemany(
+            'INSERT INTO file_index (user_id, key, entry, size, updated_at) VALUES (?, ?, ?, ?, ?)',
+            [(user_id, key, json.dumps(entry), entry['size'], entry.get('updated_at', now))
+             for key, entry in files.items()]
+        )
+        conn.execute('INSERT INTO file_index_users (user_id, pruned_before) VALUES (?, ?) '
+                     'ON CONFLICT(user_id) DO UPDATE SET pruned_before = excluded.pruned_before', (user_id, now))
+        set_usage_from_index(conn, user_id)
+
+def ensure_file_index(user_id):
+    """Build the index of a user from before it existed.
+
+    Imports their old S3 JSON index if there is one; otherwise scans only
+    their own prefix. Root-level files of users with neither are picked up
+    by rebuild-file-index.
+    """
+    if get_db().execute('SELECT 1 FROM file_index_users WHERE user_id = ?', (user_id,)).fetchone():
+        return
+    legacy = load_legacy_file_index(user_id)
+    files = legacy['files'] if legacy else scan_bucket_files(user_prefix(user_id)).get(user_id, {})
+    replace_file_index(user_id, files, only_if_missing=True)
+
+def update_file_index(user_id, add=None, remove=None, release_blobs=False):
+    """Add and/or remove entries in a user's index, with their usage counters, in one transaction.
+
+    Removed keys leave a timestamped tombstone so clients can sync with
+    ?since=; tombstones older than FILE_INDEX_TOMBSTONE_DAYS are pruned.
+    Returns the entries this call removed: a key removed concurrently by
+    another request is not among them. With release_blobs, those entries'
+    blob references are dropped in the same transaction (moves keep them).
+    """
+    ensure_file_index(user_id)
+    now = datetime.now(timezone.utc)
+    bytes_delta = files_delta = 0
+    removed = []
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')  # sizes are read and written with no other writer in between
+        for entry in add or []:
+            entry['updated_at'] = now.isoformat()
+            previous = conn.execute('SELECT size FROM file_index WHERE user_id = ? AND key = ? AND entry IS NOT NULL',
+                                    (user_id, entry['key'])).fetchone()
+            bytes_delta += entry['size'] - (previous['size'] if previous else 0)
+            files_delta += previous is None
+            conn.execute(
+                'INSERT INTO file_index (user_id, key, entry, size, updated_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(user_id, key) DO UPDATE SET entry = excluded.entry, size = excluded.size, '
+                'updated_at = excluded.updated_at',
+                (user_id, entry['key'], json.dumps(entry), entry['size'], now.isoformat())
+            )
+        for key in remove or []:
+            previous = conn.execute('SELECT entry FROM file_index WHERE user_id = ? AND key = ? AND entry IS NOT NULL',
+                                    (user_id, key)).fetchone()
+            if previous is not None:
+                conn.execute('UPDATE file_index SET entry = NULL, size = 0, updated_at = ? WHERE user_id = ? AND key = ?',
+                             (now.isoformat(), user_id, key))
+                removed.append(json.loads(previous['entry']))
+                bytes_delta -= removed[-1]['size']
+                files_delta -= 1
+        orphaned = []
+        if release_blobs:
+            orphaned = release_blob_refs(conn, [entry['blob_hash'] for entry in removed if entry.get('blob_hash')])
+        
+        cutoff = (now - timedelta(days=FILE_INDEX_TOMBSTONE_DAYS)).isoformat()
+        if conn.execute('DELETE FROM file_index WHERE user_id = ? AND entry IS NULL AND updated_at < ?',
+                        (user_id, cutoff)).rowcount:
+            conn.execute('UPDATE file_index_users SET pruned_before = ? WHERE user_id = ?', (cutoff, user_id))
+        if not adjust_usage(conn, user_id, bytes_delta, files_delta):
+            set_usage_from_index(conn, user_id)
+    delete_blobs(orphaned)
+    update_search_index(user_id, add=add, remove=remove)
+    return removed
+
+# SQL sort expressions over file_index rows, matched by its file_index_* indexes
+SORT_COLUMNS = {
+    'name': "lower(json_extract(entry, '$.filename'))",
+    'size': 'size',
+    'date': "json_extract(entry, '$.last_modified')"
+}
+
+def parse_timestamp(value):
+    """Parse an ISO date/time query parameter; naive values are taken as UTC"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def encode_cursor(sort_value, key):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, key]).encode()).decode()
+
+def decode_cursor(cursor):
+    sort_value, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return sort_value, key
+
+def query_file_index(user_id, args):
+    """Filter, sort and page a user's file index according to /api/files query args.
+
+    Filters, ordering and the keyset cursor run in SQL, so a page reads
+    only its own rows. Raises ValueError for malformed parameters.
+    """
+    sort = args.get('sort', 'date')
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+    order = args.get('order', 'desc' if sort == 'date' else 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError('order must be asc or desc')
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    
+    conn = get_db()
+    result = {}
+    conditions, params = ['user_id = ?', 'entry IS NOT NULL'], [user_id]
+    
+    since = args.get('since')
+    if since:
+        since_time = parse_timestamp(since)
+        user = conn.execute('SELECT pruned_before FROM file_index_users WHERE user_id = ?', (user_id,)).fetchone()
+        if user and user['pruned_before'] and since_time < parse_timestamp(user['pruned_before']):
+            result['full_resync'] = True
+        else:
+            since_value = since_time.astimezone(timezone.utc).isoformat()
+            conditions.append('updated_at > ?')
+            params.append(since_value)
+            result['deleted'] = [row['key'] for row in conn.execute(
+                'SELECT key FROM file_index WHERE user_id = ? AND entry IS NULL AND updated_at > ?',
+                (user_id, since_value)
+            )]
+    
+    name = SORT_COLUMNS['name']
+    extensions = {ext.strip().lower().lstrip('.') for ext in args.get('ext', '').split(',') if ext.strip()}
+    if extensions:
+        # Compared with what follows the last dot, so an extension containing a dot matches nothing
+        matchable = [ext for ext in extensions if '.' not in ext]
+        conditions.append('(' + ' OR '.join(['0'] + [f'substr({name}, ?) = ?'] * len(matchable)) + ')')
+        for ext in matchable:
+            params += [-(len(ext) + 1), f'.{ext}']
+    
+    if 'folder' in args:
+        prefix = folder_prefix(user_id, normalize_folder(args['folder']))
+        in_folder = "key >= ? AND key < ? AND instr(substr(key, ?), '/') = 0"
+        params += [*prefix_range(prefix), len(prefix) + 1]
+        if prefix == user_prefix(user_id):
+            # Files uploaded before folders existed sit at the bucket root
+            in_folder = f'{in_folder} OR substr(key, 1, ?) != ?'
+            params += [len(USER_PREFIX), USER_PREFIX]
+        conditions.append(f'({in_folder})')
+    
+    prefix = args.get('prefix', '').lower()
+    if prefix:
+        conditions.append(f'{name} >= ? AND {name} < ?')
+        params += prefix_range(prefix)
+    
+    date = SORT_COLUMNS['date']
+    if args.get('from'):
+        conditions.append(f'{date} >= ?')
+        params.append(parse_timestamp(args['from']).astimezone(timezone.utc).isoformat())
+    if args.get('to'):
+        conditions.append(f'{date} <= ?')
+        params.append(parse_timestamp(args['to']).astimezone(timezone.utc).isoformat())
+    
+    where = ' AND '.join(conditions)
+    result['total'] = conn.execute(f'SELECT COUNT(*) FROM file_index WHERE {where}', params).fetchone()[0]
+    
+    # (sort value, key) is unique, so the cursor marks an exact position
+    column = SORT_COLUMNS[sort]
+    direction = 'ASC' if order == 'asc' else 'DESC'
+    if args.get('cursor'):
+        where += f" AND ({column}, key) {'>' if order == 'asc' else '<'} (?, ?)"
+        params = params + list(decode_cursor(args['cursor']))
+    query = (f'SELECT key, entry, {column} AS sort_value FROM file_index WHERE {where} '
+             f'ORDER BY {column} {direction}, key {direction}')
+    if limit is not None:
+        query += ' LIMIT ?'
+        params = params + [limit + 1]
+    rows = conn.execute(query, params).fetchall()
+    
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        result['next_cursor'] = encode_cursor(rows[-1]['sort_value'], rows[-1]['key'])
+    
+    result['files'] = [json.loads(row['entry']) for row in rows]
+    result.setdefault('next_cursor', None)
+    return result
+
+def iter_bucket_objects(prefix=''):
+    """Yield every object in the bucket, following pagination"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+def scan_bucket_files(prefix=''):
+    """Scan the bucket (or the keys under prefix) and group user files by owner id"""
+    files_by_user = defaultdict(dict)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        objects = [obj for obj in page.get('Contents', []) if not obj['Key'].startswith(INTERNAL_PREFIXES)]
+        # One head_object per key, issued concurrently for the whole page
+        heads = s3_map('head_object', [{'Key': obj['Key']} for obj in objects])
+        for obj, head in zip(objects, heads):
+            if isinstance(head, Exception):
+                continue
+            owner_id = head['Metadata'].get('user-id')
+            if not owner_id:
+                continue
+            files_by_user[owner_id][obj['Key']] = file_index_entry(
+                obj['Key'], head['Metadata'], obj['Size'], obj['LastModified'].isoformat()
+            )
+    return files_by_user
+
+def rebuild_file_indexes():
+    """Regenerate every user's index from the bucket; returns {user_id: file count}"""
+    files_by_user = scan_bucket_files()
+    user_ids = {user['user_id'] for user in user_store.all().values()} | set(files_by_user)
+    counts = {}
+    for user_id in user_ids:
+        replace_file_index(user_id, files_by_user.get(user_id, {}))
+        counts[user_id] = len(files_by_user.get(user_id, {}))
+    return counts
+
+@app.cli.command('rebuild-file-index')
+def rebuild_file_index_command():
+    """Rebuild the per-user file indexes from the objects in the bucket."""
+    counts = rebuild_file_indexes()
+    print(f"Rebuilt {len(counts)} file indexes ({sum(counts.values())} files)")
+
+# ==================== USAGE AND QUOTAS ====================
+# Per-user byte and file counters, adjusted by update_file_index() in the
+# same transaction as the index, so they always follow it without a bucket scan.
+# Sizes are logical: a deduplicated file counts in full for each owner.
+
+def adjust_usage(conn, user_id, bytes_delta, files_delta):
+    """Apply a change to a user's counters within conn's transaction; False if the user has no counters yet"""
+    cursor = conn.execute('UPDATE usage SET bytes = bytes + ?, files = files + ? WHERE user_id = ?',
+                          (bytes_delta, files_delta, user_id))
+    return cursor.rowcount == 1
+
+def set_usage_from_index(conn, user_id):
+    """Reset a user's counters to the totals of their file index, within conn's transaction"""
+    conn.execute(
+        'INSERT INTO usage (user_id, bytes, files) '
+        'SELECT ?, COALESCE(SUM(size), 0), COUNT(*) FROM file_index WHERE user_id = ? AND entry IS NOT NULL '
+        'ON CONFLICT(user_id) DO UPDATE SET bytes = excluded.bytes, files = excluded.files',
+        (user_id, user_id)
+    )
+
+def get_usage(user_id):
+    """{'bytes', 'files', 'quota'}; quota 0 means unlimited"""
+    row = get_db().execute('SELECT bytes, files, quota FROM usage WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return {'bytes': 0, 'files': 0, 'quota': STORAGE_QUOTA}
+    return {'bytes': row['bytes'], 'files': row['files'],
+            'quota': STORAGE_QUOTA if row['quota'] is None else row['quota']}
+
+def quota_remaining(user_id):
+    """Bytes the user may still store, or None without a quota"""
+    usage = get_usage(user_id)
+    if not usage['quota']:
+        return None
+    return max(usage['quota'] - usage['bytes'], 0)
+
+def exceeds_quota(user_id, size):
+    remaining = quota_remaining(user_id)
+    return remaining is not None and size > remaining
+
+def set_quota(user_id, quota):
+    """Override a user's quota in bytes (None restores the default, 0 is unlimited)"""
+    with get_db() as conn:
+        conn.execute('INSERT INTO usage (user_id, quota) VALUES (?, ?) '
+                     'ON CONFLICT(user_id) DO UPDATE SET quota = excluded.quota', (user_id, quota))
+
+def usage_report():
+    """Usage of every user, largest first: one row per user, no object listing"""
+    emails = {user['user_id']: email for email, user in user_store.all().items()}
+    rows = get_db().execute('SELECT user_id, bytes, files, quota FROM usage ORDER BY bytes DESC').fetchall()
+    seen = {row['user_id'] for row in rows}
+    report = [{
+        'user_id': row['user_id'],
+        'email': emails.get(row['user_id'], ''),
+        'bytes': row['bytes'],
+        'files': row['files'],
+        'quota': STORAGE_QUOTA if row['quota'] is None else row['quota']
+    } for row in rows]
+    report.extend({'user_id': user_id, 'email': email, 'bytes': 0, 'files': 0, 'quota': STORAGE_QUOTA}
+                  for user_id, email in emails.items() if user_id not in seen)
+    return report
+
+def recalculate_usage():
+    """Reset every user's counters from their file index; returns how many users"""
+    with get_db() as conn:
+        user_ids = [row['user_id'] for row in conn.execute('SELECT user_id FROM file_index_users').fetchall()]
+        for user_id in user_ids:
+            set_usage_from_index(conn, user_id)
+    return len(user_ids)
+
+@app.cli.command('usage-report')
+def usage_report_command():
+    """Print storage used by every user."""
+    print(f"{'email':<40}{'files':>10}{'used MB':>12}{'quota MB':>12}")
+    for row in usage_report():
+        quota = f"{row['quota'] / 1048576:.1f}" if row['quota'] else 'unlimited'
+        print(f"{row['email'] or row['user_id']:<40}{row['files']:>10}{row['bytes'] / 1048576:>12.1f}{quota:>12}")
+
+@app.cli.command('set-quota')
+@click.argument('email')
+@click.argument('quota_bytes', required=False, type=int)
+def set_quota_command(email, quota_bytes):
+    """Set a user's quota in bytes (0 = unlimited; omit to restore the default)."""
+    user = user_store.get(email)
+    if user is None:
+        raise click.ClickException(f'No user {email}')
+    set_quota(user['user_id'], quota_bytes)
+    print(f"Quota for {email}: {get_usage(user['user_id'])['quota']} bytes")
+
+@app.cli.command('recalculate-usage')
+def recalculate_usage_command():
+    """Recompute usage counters from the file indexes (local database only)."""
+    print(f"Recalculated usage for {recalculate_usage()} users")
+
+# ==================== STORAGE TRANSFORMS ====================
+# Plaintext is compressed, then encrypted, as it streams to S3, and decoded
+# the same way on the way out, so no file is ever held whole in memory.
+# Encrypted objects are a series of AES-GCM frames of ENCRYPTION_FRAME_SIZE
+# plaintext bytes. Each frame's nonce is the object's random prefix plus the
+# frame number and a last-frame flag, so reordered or truncated frames fail
+# to decrypt. What was applied is recorded in the object's metadata
+# ('storage-encoding', 'storage-key-id', 'storage-nonce', 'plain-size'), so
+# changing the settings never makes existing objects unreadable.
+
+class StorageDecodeError(Exception):
+    pass
+
+_data_keys = {}  # key id -> unwrapped data key, this process only
+_data_keys_lock = threading.Lock()
+
+def storage_master_key():
+    key = base64.b64decode(STORAGE_MASTER_KEY) if STORAGE_MASTER_KEY else b''
+    if len(key) != 32:
+        raise RuntimeError('STORAGE_MASTER_KEY must be 32 bytes, base64-encoded')
+    return key
+
+def data_key(key_id):
+    """The AES-256 data key for a user id (or 'blobs'), created and wrapped on first use"""
+    with _data_keys_lock:
+        if key_id in _data_keys:
+            return _data_keys[key_id]
+    if AESGCM is None:
+        raise RuntimeError('Encrypted storage needs the cryptography package')
+    master = AESGCM(storage_master_key())
+    row = get_db().execute('SELECT wrapped_key FROM data_keys WHERE key_id = ?', (key_id,)).fetchone()
+    if row is None:
+        nonce = os.urandom(12)
+        wrapped = nonce + master.encrypt(nonce, AESGCM.generate_key(256), key_id.encode())
+        with get_db() as conn:
+            # Another worker may have created it first; theirs wins
+            conn.execute('INSERT OR IGNORE INTO data_keys (key_id, wrapped_key, created_at) VALUES (?, ?, ?)',
+                         (key_id, wrapped, datetime.now(timezone.utc).isoformat()))
+            row = conn.execute('SELECT wrapped_key FROM data_keys WHERE key_id = ?', (key_id,)).fetchone()
+    key = master.decrypt(row['wrapped_key'][:12], row['wrapped_key'][12:], key_id.encode())
+    with _data_keys_lock:
+        _data_keys[key_id] = key
+    return key
+
+def storage_transform(filename, key_id):
+    """Metadata describing how to store a new object, or None to store it as is"""
+    transform = {}
+    if STORAGE_COMPRESSION != 'none' and file_extension(filename) not in INCOMPRESSIBLE_EXTENSIONS:
+        transform['storage-encoding'] = 'zstd' if STORAGE_COMPRESSION == 'zstd' and zstandard else 'gzip'
+    if STORAGE_ENCRYPTION:
+        transform['storage-key-id'] = key_id
+        transform['storage-nonce'] = base64.b64encode(os.urandom(7)).decode()
+    return transform or None
+
+def is_transformed(metadata):
+    return bool(metadata.get('storage-encoding') or metadata.get('storage-key-id'))
+
+def _frame_nonce(prefix, number, last):
+    return prefix + number.to_bytes(4, 'big') + (b'\x01' if last else b'\x00')
+
+def _frames(chunks, frame_size):
+    """Re-chunk into (frame, is_last) of exactly frame_size bytes, except the last"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        # Strictly more than a frame: only the end of input says which frame is last
+        while len(buffer) > frame_size:
+            yield bytes(buffer[:frame_size]), False
+            del buffer[:frame_size]
+    yield bytes(buffer), True
+
+def encode_chunks(chunks, transform):
+    """Compress, then encrypt, an iterator of plaintext chunks"""
+    if transform.get('storage-encoding') == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif transform.get('storage-encoding') == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    else:
+        compressor = None
+    if compressor:
+        chunks = _compress(chunks, compressor)
+    if transform.get('storage-key-id'):
+        aesgcm = AESGCM(data_key(transform['storage-key-id']))
+        prefix = base64.b64decode(transform['storage-nonce'])
+        chunks = (aesgcm.encrypt(_frame_nonce(prefix, number, last), frame, None)
+                  for number, (frame, last) in enumerate(_frames(chunks, ENCRYPTION_FRAME_SIZE)))
+    return chunks
+
+def _compress(chunks, compressor):
+    for chunk in chunks:
+        with timed_span('compress'):
+            data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def decode_chunks(chunks, metadata):
+    """Undo encode_chunks for an object's stored bytes, given its metadata"""
+    if metadata.get('storage-key-id'):
+        chunks = _decrypt(chunks, metadata)
+    if metadata.get('storage-encoding') == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Reading zstd-compressed files needs the zstandard package')
+        chunks = zstandard.ZstdDecompressor().read_to_iter(ChunkReader(chunks), write_size=DOWNLOAD_CHUNK_SIZE)
+        chunks = _wrap_decode_errors(chunks, zstandard.ZstdError)
+    elif metadata.get('storage-encoding') == 'gzip':
+        chunks = _wrap_decode_errors(_gunzip(chunks), zlib.error)
+    return chunks
+
+def _decrypt(chunks, metadata):
+    aesgcm = AESGCM(data_key(metadata['storage-key-id']))
+    prefix = base64.b64decode(metadata['storage-nonce'])
+    for number, (frame, last) in enumerate(_frames(chunks, ENCRYPTION_FRAME_SIZE + 16)):  # + GCM tag
+        try:
+            yield aesgcm.decrypt(_frame_nonce(prefix, number, last), frame, None)
+        except InvalidTag:
+            raise StorageDecodeError(f'Frame {number} failed authentication')
+
+def _gunzip(chunks):
+    # Output is capped per call, so a highly compressed chunk never inflates all at once
+    decompressor = zlib.decompressobj(31)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk, DOWNLOAD_CHUNK_SIZE)
+        while data:
+            yield data
+            data = decompressor.decompress(decompressor.unconsumed_tail, DOWNLOAD_CHUNK_SIZE)
+    if not decompressor.eof:
+        raise zlib.error('Compressed data is truncated')
+
+def _wrap_decode_errors(chunks, error_type):
+    try:
+        yield from chunks
+    except error_type as e:
+        raise StorageDecodeError(str(e))
+
+class ChunkReader:
+    """File-like read() over an iterator of byte chunks"""
+    
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+    
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+    
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+def decoded_chunks(file_obj):
+    """Plaintext chunks of a get_object result, undoing any storage transform"""
+    return decode_chunks(iter_s3_body(file_obj['Body']), file_obj['Metadata'])
+
+def decoded_body(file_obj):
+    """File-like plaintext body of a get_object result"""
+    if is_transformed(file_obj['Metadata']):
+        return ChunkReader(decoded_chunks(file_obj))
+    return file_obj['Body']
+
+def stored_object_metadata(key, metadata):
+    """Metadata of the object holding a file's bytes (the blob, for dedup pointers)"""
+    return get_object_metadata(storage_key(key, metadata)) if metadata.get('blob-hash') else metadata
+
+# ==================== STREAMING UPLOADS ====================
+
+class FileTooLarge(Exception):
+    pass
+
+class QuotaExceeded(FileTooLarge):
+    pass
+
+def iter_parts(stream, part_size=UPLOAD_PART_SIZE):
+    """Read a stream into part_size chunks (the last one may be shorter)"""
+    while True:
+        part = bytearray()
+        while len(part) < part_size:
+            chunk = stream.read(part_size - len(part))
+            if not chunk:
+                break
+            part += chunk
+        if not part:
+            return
+        yield bytes(part)
+        if len(part) < part_size:
+            return
+
+def _chain_parts(first, second, rest):
+    yield first
+    yield second
+    yield from rest
+
+class HashingReader:
+    """Stream wrapper that hashes and counts the bytes read through it"""
+    
+    def __init__(self, stream, max_size=MAX_FILE_SIZE):
+        self._stream = stream
+        self._hasher = hashlib.sha256()
+        self.max_size = max_size
+        self.size = 0
+    
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise FileTooLarge()
+        with timed_span('hash'):
+            self._hasher.update(data)
+        return data
+    
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+def stream_to_s3(stream, key, metadata, max_size=MAX_FILE_SIZE, transform=None):
+    """Upload a stream to S3 without buffering it whole.
+
+    Bytes are hashed as they arrive and sent as multipart parts in parallel.
+    With a storage transform they are compressed/encrypted on the way; the
+    hash, the returned size and 'plain-size' describe the plaintext. The
+    'file-hash' metadata entry is filled in here. Returns (size, hash).
+    """
+    source = HashingReader(stream, max_size)
+    body = source
+    if transform:
+        metadata.update(transform)
+        body = ChunkReader(encode_chunks(iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''), transform))
+    parts = iter_parts(body)
+    first = next(parts, b'')
+    second = next(parts, None)
+    
+    # Small files fit in one part: a single put_object is cheaper
+    if second is None:
+        metadata['file-hash'] = source.hexdigest()
+        if transform:
+            metadata['plain-size'] = str(source.size)
+        s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=first, Metadata=metadata)
+        return source.size, metadata['file-hash']
+    
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=S3_BUCKET, Key=key, Metadata=metadata
+    )['UploadId']
+    
+    def upload_part(number, body):
+        response = s3_client.upload_part(
+            Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=body
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+    
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            pending, done = set(), []
+            for number, part in enumerate(_chain_parts(first, second, parts), 1):
+                # Wait for a free slot so at most UPLOAD_CONCURRENCY parts are held
+                if len(pending) >= UPLOAD_CONCURRENCY:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    done.extend(f.result() for f in finished)
+                pending.add(pool.submit(contextvars.copy_context().run, upload_part, number, part))
+            done.extend(f.result() for f in pending)
+        
+        s3_client.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(done, key=lambda p: p['PartNumber'])}
+        )
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+        raise
+    
+    # The hash is only known once every byte is read; record it with a server-side copy
+    metadata['file-hash'] = source.hexdigest()
+    if transform:
+        metadata['plain-size'] = str(source.size)
+    s3_client.copy(
+        {'Bucket': S3_BUCKET, 'Key': key}, S3_BUCKET, key,
+        ExtraArgs={'Metadata': metadata, 'MetadataDirective': 'REPLACE'}
+    )
+    return source.size, metadata['file-hash']
+
+def put_user_file(stream, original_filename, user_id, user_email, folder=''):
+    """Stream an upload to S3 under a fresh key in folder; returns its file index entry.
+
+    The stream is cut off at MAX_FILE_SIZE or at the user's remaining quota,
+    whichever is smaller, so an over-quota upload stops mid-transfer.
+    """
+    remaining = quota_remaining(user_id)
+    max_size = MAX_FILE_SIZE if remaining is None else min(MAX_FILE_SIZE, remaining)
+    unique_filename = new_file_key(user_id, original_filename, folder)
+    metadata = {
+        'original-filename': original_filename,
+        'upload-date': datetime.now().isoformat(),
+        'user-id': user_id,
+        'user-email': user_email
+    }
+    try:
+        if DEDUP_STORAGE:
+            file_hash, size = store_blob(stream, max_size, storage_transform(original_filename, 'blobs'))
+            put_blob_pointer(unique_filename, metadata, file_hash, size)
+        else:
+            transform = storage_transform(original_filename, user_id)
+            size, file_hash = stream_to_s3(stream, unique_filename, metadata, max_size, transform)
+    except FileTooLarge:
+        if max_size < MAX_FILE_SIZE:
+            raise QuotaExceeded()
+        raise
+    object_metadata_cache.invalidate(unique_filename)
+    return file_index_entry(unique_filename, metadata, size, datetime.now(timezone.utc).isoformat())
+
+def upload_result(entry):
+    return {
+        'message': 'File uploaded successfully',
+        'filename': entry['filename'],
+        's3_key': entry['key'],
+        'file_hash': entry['file_hash'],
+        'size': entry['size']
+    }
+
+def store_upload(stream, original_filename, user_id, user_email, folder=''):
+    """Stream an upload to S3 and record it in the owner's file index"""
+    entry = put_user_file(stream, original_filename, user_id, user_email, folder)
+    update_file_index(user_id, add=[entry])
+    result = upload_result(entry)
+    result['jobs'] = enqueue_post_upload(entry, user_id)
+    return result
+
+# ==================== DEDUPLICATED STORAGE ====================
+# Blob bytes are stored once under blobs/<sha256> with a reference count in
+# the local database. User-visible keys are zero-byte pointer objects whose
+# metadata carries the usual ownership fields plus 'blob-hash'.
+# Workers in other processes share the bucket, so writes and deletes of a
+# blob object are coordinated through claims in the database: a 'write'
+# claim keeps the object from being deleted, a 'delete' claim holds back
+# writers until the object is gone.
+
+def blob_key(file_hash):
+    return f'{BLOB_PREFIX}{file_hash}'
+
+def storage_key(key, metadata):
+    """The S3 key holding a file's bytes (the blob for dedup pointers)"""
+    return blob_key(metadata['blob-hash']) if metadata.get('blob-hash') else key
+
+def claim_session_blob_ref(conn, session_id, file_hash):
+    """True the first time an upload session references a blob; retried finalizes get False"""
+    return conn.execute(
+        'INSERT INTO upload_blob_refs (session_id, hash) VALUES (?, ?) ON CONFLICT(session_id) DO NOTHING',
+        (session_id, file_hash)
+    ).rowcount == 1
+
+def acquire_blob(file_hash, session_id=None):
+    """Add a reference to an existing blob; returns its size, or None if unknown.
+
+    With a session_id, the reference is taken at most once per resumable
+    upload, so a finalize that runs twice does not leak a reference.
+    """
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT size FROM blobs WHERE hash = ?', (file_hash,)).fetchone()
+        if row is None:
+            return None
+        if session_id is None or claim_session_blob_ref(conn, session_id, file_hash):
+            conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (file_hash,))
+        return row['size']
+
+def register_blob(file_hash, size, session_id=None):
+    """Record a reference to a blob that was just written (at most once per session_id)"""
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if session_id is None or claim_session_blob_ref(conn, session_id, file_hash):
+            conn.execute(
+                'INSERT INTO blobs (hash, size, refcount) VALUES (?, ?, 1) '
+                'ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1',
+                (file_hash, size)
+            )
+
+@contextmanager
+def blob_write_claim(file_hash):
+    """Hold a 'write' claim on a blob while its object is checked for and written.
+
+    Waits for a deletion in progress to finish first; one that starts while
+    the claim is held leaves the object in place.
+    """
+    claim_id = uuid.uuid4().hex
+    while True:
+        with get_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM blob_claims WHERE hash = ? AND started_at < ?',
+                         (file_hash, time.time() - BLOB_CLAIM_TIMEOUT))
+            if conn.execute("SELECT 1 FROM blob_claims WHERE hash = ? AND kind = 'delete'",
+                            (file_hash,)).fetchone() is None:
+                conn.execute("INSERT INTO blob_claims (id, hash, kind, started_at) VALUES (?, ?, 'write', ?)",
+                             (claim_id, file_hash, time.time()))
+                break
+        time.sleep(0.05)  # a deletion is one S3 call
+    try:
+        yield
+    finally:
+        with get_db() as conn:
+            conn.execute('DELETE FROM blob_claims WHERE id = ?', (claim_id,))
+
+def release_blob_refs(conn, file_hashes):
+    """Drop one reference per hash in the caller's transaction; returns the blobs to delete.
+
+    A blob losing its last reference gets a 'delete' claim, unless it is
+    being written, in which case its object is kept for the writer.
+    """
+    now = time.time()
+    orphaned = []
+    for file_hash in file_hashes:
+        row = conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ? RETURNING refcount',
+                           (file_hash,)).fetchone()
+        if row is None or row['refcount'] > 0:
+            continue
+        conn.execute('DELETE FROM blobs WHERE hash = ?', (file_hash,))
+        conn.execute('DELETE FROM blob_claims WHERE hash = ? AND started_at < ?',
+                     (file_hash, now - BLOB_CLAIM_TIMEOUT))
+        if conn.execute('SELECT 1 FROM blob_claims WHERE hash = ?', (file_hash,)).fetchone() is None:
+            conn.execute("INSERT INTO blob_claims (id, hash, kind, started_at) VALUES (?, ?, 'delete', ?)",
+                         (uuid.uuid4().hex, file_hash, now))
+            orphaned.append(file_hash)
+    return orphaned
+
+def delete_blobs(file_hashes):
+    """Delete the objects release_blob_refs claimed (after its commit), then drop the claims"""
+    if not file_hashes:
+        return
+    try:
+        delete_keys([blob_key(file_hash) for file_hash in file_hashes])
+    finally:
+        # A failed delete leaves an orphaned object, which is only wasted space
+        with get_db() as conn:
+            conn.executemany("DELETE FROM blob_claims WHERE hash = ? AND kind = 'delete'",
+                             [(file_hash,) for file_hash in file_hashes])
+
+def release_blob(file_hash):
+    """Drop a reference; the blob object is deleted with its last reference"""
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        orphaned = release_blob_refs(conn, [file_hash])
+    delete_blobs(orphaned)
+
+def hash_stream(stream, max_size=MAX_FILE_SIZE, throttle=None):
+    """SHA-256 and size of a stream, read in chunks (paced by an optional ByteThrottle)"""
+    hasher = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(DOWNLOAD_CHUNK_SIZE), b''):
+        size += len(chunk)
+        if size > max_size:
+            raise FileTooLarge()
+        if throttle is not None:
+            throttle.consume(len(chunk))
+        with timed_span('hash'):
+            hasher.update(chunk)
+    return hasher.hexdigest(), size
+
+def store_blob(stream, max_size=MAX_FILE_SIZE, transform=None):
+    """Store a stream's bytes as a blob (once per hash); returns (hash, size)"""
+    if stream.seekable():
+        # Hash first so known content never leaves the worker
+        file_hash, size = hash_stream(stream, max_size)
+        with blob_write_claim(file_hash):
+            if acquire_blob(file_hash) is not None:
+                return file_hash, size
+            stream.seek(0)
+            stream_to_s3(stream, blob_key(file_hash), {}, transform=transform)
+            register_blob(file_hash, size)
+        return file_hash, size
+    
+    # Unseekable request bodies are staged, then copied into place server-side
+    staging_key = f'{BLOB_PREFIX}staging/{uuid.uuid4().hex}'
+    try:
+        size, file_hash = stream_to_s3(stream, staging_key, {}, max_size, transform)
+        with blob_write_claim(file_hash):
+            if acquire_blob(file_hash) is None:
+                s3_client.copy({'Bucket': S3_BUCKET, 'Key': staging_key}, S3_BUCKET, blob_key(file_hash))
+                register_blob(file_hash, size)
+    finally:
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=staging_key)
+    return file_hash, size
+
+def put_blob_pointer(key, metadata, file_hash, size):
+    """Write the zero-byte user-visible object that points at a blob"""
+    metadata.update({'file-hash': file_hash, 'blob-hash': file_hash, 'blob-size': str(size)})
+    s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=b'', Metadata=metadata)
+
+def open_user_file(key):
+    """open_s3_object for a user key, following dedup pointers to their blob"""
+    if DEDUP_STORAGE:
+        metadata = get_object_metadata(key)
+        if metadata.get('blob-hash'):
+            file_obj = open_s3_object(storage_key(key, metadata))
+            file_obj['Metadata'] = {**file_obj['Metadata'], **metadata}  # keeps the blob's storage-* entries
+            return file_obj
+    return open_s3_object(key)
+
+# ==================== RESUMABLE UPLOADS ====================
+# A session is an S3 multipart upload to a staging key. Each numbered chunk
+# is one part, checked against the client's SHA-256 before it is sent on.
+# The file hash is built in memory while chunks arrive in order. If they
+# arrive out of order or on another worker, a job re-reads the staged
+# object instead. Finalizing copies the staged object to the user's key
+# with its metadata, so a file never appears without its hash.
+
+_upload_hashers = {}  # session id -> [hasher, next chunk number], this process only
+_upload_hashers_lock = threading.Lock()
+_upload_session_locks = defaultdict(threading.Lock)
+
+def expected_chunk_size(upload, number):
+    if number < upload['chunks']:
+        return upload['chunk_size']
+    return upload['size'] - upload['chunk_size'] * (upload['chunks'] - 1)
+
+def create_upload_session(original_filename, size, user_id, user_email, folder=''):
+    session_id = uuid.uuid4().hex
+    staging_key = f'{UPLOAD_STAGING_PREFIX}{session_id}'
+    s3_upload_id = s3_client.create_multipart_upload(Bucket=S3_BUCKET, Key=staging_key)['UploadId']
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO upload_sessions (id, user_id, user_email, filename, key, staging_key, s3_upload_id, '
+            'size, chunk_size, chunks, status, created_at, updated_at) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'open', ?, ?)",
+            (session_id, user_id, user_email, original_filename, new_file_key(user_id, original_filename, folder),
+             staging_key, s3_upload_id, size, UPLOAD_PART_SIZE, max(1, -(-size // UPLOAD_PART_SIZE)),
+             datetime.now(timezone.utc).isoformat(), time.time())
+        )
+    with _upload_hashers_lock:
+        _upload_hashers[session_id] = [hashlib.sha256(), 1]
+    return get_upload_session(session_id, user_id)
+
+def get_upload_session(session_id, user_id):
+    row = get_db().execute(
+        'SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?', (session_id, user_id)
+    ).fetchone()
+    return dict(row) if row else None
+
+def received_chunks(session_id):
+    return get_db().execute(
+        'SELECT number, size, sha256, etag FROM upload_chunks WHERE session_id = ? ORDER BY number', (session_id,)
+    ).fetchall()
+
+def upload_session_status(upload):
+    """Public view of a session: which chunks and byte ranges the server holds"""
+    chunks = received_chunks(upload['id'])
+    received = [chunk['number'] for chunk in chunks]
+    ranges = []
+    for number in received:
+        start = (number - 1) * upload['chunk_size']
+        end = start + expected_chunk_size(upload, number) - 1
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    received_set = set(received)
+    return {
+        'upload_id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'chunks': upload['chunks'],
+        'status': upload['status'],
+        'received': received,
+        'missing': [n for n in range(1, upload['chunks'] + 1) if n not in received_set],
+        'received_ranges': ranges,
+        'bytes_received': sum(chunk['size'] for chunk in chunks),
+        'job': upload['job_id'],
+        'file': json.loads(upload['result']) if upload['result'] else None
+    }
+
+def _advance_upload_hash(session_id, number, data, replaced_hash, chunk_hash):
+    """Fold an in-order chunk into the session's running hash"""
+    with _upload_hashers_lock:
+        state = _upload_hashers.get(session_id)
+    if state is None:
+        return
+    with _upload_session_locks[session_id]:
+        if number < state[1] and replaced_hash not in (None, chunk_hash):
+            # Bytes already hashed were replaced: the running hash is now wrong
+            with _upload_hashers_lock:
+                _upload_hashers.pop(session_id, None)
+        elif number == state[1]:
+            with timed_span('hash'):
+                state[0].update(data)
+            state[1] += 1
+
+def store_chunk(upload, number, data, chunk_hash):
+    """Upload one verified chunk as a multipart part; re-sending a chunk replaces it"""
+    response = s3_client.upload_part(
+        Bucket=S3_BUCKET, Key=upload['staging_key'], UploadId=upload['s3_upload_id'],
+        PartNumber=number, Body=data,
+        ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode()  # S3 re-checks it in transit
+    )
+    with get_db() as conn:
+        previous = conn.execute(
+            'SELECT sha256 FROM upload_chunks WHERE session_id = ? AND number = ?', (upload['id'], number)
+        ).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO upload_chunks (session_id, number, size, sha256, etag) VALUES (?, ?, ?, ?, ?)',
+            (upload['id'], number, len(data), chunk_hash, response['ETag'])
+        )
+        conn.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?', (time.time(), upload['id']))
+    _advance_upload_hash(upload['id'], number, data, previous['sha256'] if previous else None, chunk_hash)
+
+def complete_upload_session(upload):
+    """Assemble the parts and finalize; returns (upload result, None) or (None, job id) when hashing is deferred"""
+    with get_db() as conn:
+        cursor = conn.execute(
+            "UPDATE upload_sessions SET status = 'finalizing', updated_at = ? WHERE id = ? AND status = 'open'",
+            (time.time(), upload['id'])
+        )
+    if cursor.rowcount == 0:
+        return None, None
+    
+    s3_client.complete_multipart_upload(
+        Bucket=S3_BUCKET, Key=upload['staging_key'], UploadId=upload['s3_upload_id'],
+        MultipartUpload={'Parts': [{'PartNumber': chunk['number'], 'ETag': chunk['etag']}
+                                   for chunk in received_chunks(upload['id'])]}
+    )
+    with _upload_hashers_lock:
+        state = _upload_hashers.pop(upload['id'], None)
+    _upload_session_locks.pop(upload['id'], None)
+    
+    if state is not None and state[1] > upload['chunks']:
+        try:
+            return finalize_upload(upload['id'], state[0].hexdigest()), None
+        except Exception as e:
+            print(f"Finalizing upload {upload['id']} failed, retrying in the background: {e}")
+    
+    job_id = enqueue_job('finalize_upload', {'upload_id': upload['id']}, upload['user_id'])
+    with get_db() as conn:
+        conn.execute('UPDATE upload_sessions SET job_id = ? WHERE id = ?', (job_id, upload['id']))
+    return None, job_id
+
+def finalize_upload(session_id, file_hash=None):
+    """Move a completed staging object to the user's key and index it; returns the upload result.
+
+    Safe to run again after a crash or a lost job lease: every step
+    overwrites the same objects, and the blob reference is taken once.
+    """
+    upload = dict(get_db().execute('SELECT * FROM upload_sessions WHERE id = ?', (session_id,)).fetchone())
+    if upload['status'] == 'complete':
+        return json.loads(upload['result'])
+    
+    staging = {'Bucket': S3_BUCKET, 'Key': upload['staging_key']}
+    if file_hash is None:
+        file_hash, _ = hash_stream(s3_client.get_object(**staging)['Body'], max_size=float('inf'))
+    
+    metadata = {
+        'original-filename': upload['filename'],
+        'upload-date': datetime.now().isoformat(),
+        'user-id': upload['user_id'],
+        'user-email': upload['user_email']
+    }
+    # Chunks arrive as plaintext; with a storage transform they are re-encoded instead of copied
+    transform = storage_transform(upload['filename'], 'blobs' if DEDUP_STORAGE else upload['user_id'])
+    if DEDUP_STORAGE:
+        with blob_write_claim(file_hash):
+            if acquire_blob(file_hash, session_id) is None:
+                if transform:
+                    stream_to_s3(s3_client.get_object(**staging)['Body'], blob_key(file_hash), {},
+                                 float('inf'), transform)
+                else:
+                    s3_client.copy(staging, S3_BUCKET, blob_key(file_hash))
+                register_blob(file_hash, upload['size'], session_id)
+        put_blob_pointer(upload['key'], metadata, file_hash, upload['size'])
+    elif transform:
+        stream_to_s3(s3_client.get_object(**staging)['Body'], upload['key'], metadata, float('inf'), transform)
+    else:
+        metadata['file-hash'] = file_hash
+        s3_client.copy(staging, S3_BUCKET, upload['key'],
+                       ExtraArgs={'Metadata': metadata, 'MetadataDirective': 'REPLACE'})
+    s3_client.delete_object(**staging)
+    object_metadata_cache.invalidate(upload['key'])
+    
+    entry = file_index_entry(upload['key'], metadata, upload['size'], datetime.now(timezone.utc).isoformat())
+    update_file_index(upload['user_id'], add=[entry])
+    result = upload_result(entry)
+    result['jobs'] = enqueue_post_upload(entry, upload['user_id'])
+    with get_db() as conn:
+        cursor = conn.execute(
+            "UPDATE upload_sessions SET status = 'complete', result = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'finalizing'",
+            (json.dumps(result), time.time(), session_id)
+        )
+        if cursor.rowcount == 0:
+            # A concurrent run published first; report its result
+            return json.loads(conn.execute('SELECT result FROM upload_sessions WHERE id = ?',
+                                           (session_id,)).fetchone()['result'])
+        conn.execute('DELETE FROM upload_chunks WHERE session_id = ?', (session_id,))
+    return result
+
+def abort_upload_session(upload):
+    try:
+        s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=upload['staging_key'],
+                                         UploadId=upload['s3_upload_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+    if upload['status'] == 'finalizing':
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=upload['staging_key'])  # assembled but never published
+    with get_db() as conn:
+        conn.execute('DELETE FROM upload_chunks WHERE session_id = ?', (upload['id'],))
+        conn.execute('DELETE FROM upload_blob_refs WHERE session_id = ?', (upload['id'],))
+        conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload['id'],))
+    with _upload_hashers_lock:
+        _upload_hashers.pop(upload['id'], None)
+    _upload_session_locks.pop(upload['id'], None)
+
+def gc_upload_sessions():
+    """Abort sessions idle for UPLOAD_SESSION_TTL and forget finished ones; returns how many"""
+    rows = get_db().execute(
+        "SELECT * FROM upload_sessions WHERE updated_at < ? AND "
+        "(status != 'finalizing' OR job_id IN (SELECT id FROM jobs WHERE status = 'failed'))",
+        (time.time() - UPLOAD_SESSION_TTL,)
+    ).fetchall()
+    for row in rows:
+        abort_upload_session(dict(row))
+    return len(rows)
+
+@app.cli.command('gc-uploads')
+def gc_uploads_command():
+    """Abort abandoned resumable uploads now."""
+    print(f"Removed {gc_upload_sessions()} upload sessions")
+
+# ==================== STREAMING DOWNLOADS ====================
+
+def open_s3_object(key):
+    """get_object with the request's Range / If-Range passed through to S3"""
+    params = {'Bucket': S3_BUCKET, 'Key': key}
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    
+    if range_header:
+        params['Range'] = range_header
+        if if_range:
+            # Only a strong ETag or a date may validate a range request
+            if if_range.startswith('W/'):
+                del params['Range']
+            elif if_range.startswith('"'):
+                params['IfMatch'] = if_range
+            elif parse_date(if_range):
+                params['IfUnmodifiedSince'] = parse_date(if_range)
+    
+    try:
+        file_obj = s3_client.get_object(**params)
+    except ClientError as e:
+        # If-Range did not match, so the client gets the whole (changed) file
+        if if_range and e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+            return s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        raise
+    if 'ContentRange' in file_obj and is_transformed(file_obj['Metadata']):
+        # Stored byte ranges do not map to plaintext ones: compressed/encrypted files are read whole
+        file_obj['Body'].close()
+        return s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+    return file_obj
+
+def iter_s3_body(body, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Yield an S3 body in fixed-size chunks, closing it when done"""
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+def iter_verified_chunks(chunks, key, expected):
+    """Pass chunks through, hashing them and withholding the last one until the hash matches.
+
+    On a mismatch the stream is cut short, so the client sees a failed
+    (truncated) download rather than silently corrupt bytes.
+    """
+    hasher = hashlib.sha256()
+    held = None
+    for chunk in chunks:
+        with timed_span('hash'):
+            hasher.update(chunk)
+        if held is not None:
+            yield held
+        held = chunk
+    actual = hasher.hexdigest()
+    status = 'ok' if actual == expected else 'mismatch'
+    record_integrity_check({'key': key, 'status': status, 'expected': expected, 'actual': actual}, 'download')
+    if status != 'ok':
+        raise IOError(f'Integrity check failed for {key}')
+    if held is not None:
+        yield held
+
+def s3_object_response(file_obj, download_name, key=None):
+    """Build a streamed 200/206/304 response from a get_object result"""
+    etag = unquote_etag(file_obj['ETag'])[0]
+    last_modified = file_obj['LastModified']
+    partial = 'ContentRange' in file_obj
+    
+    if not partial and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        file_obj['Body'].close()
+        response = Response(status=304)
+    else:
+        mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        expected = file_obj['Metadata'].get('file-hash')
+        body = decoded_chunks(file_obj)
+        if VERIFY_ON_DOWNLOAD and key and expected and not partial:
+            body = iter_verified_chunks(body, key, expected)
+        response = Response(
+            body,
+            status=206 if partial else 200,
+            mimetype=mimetype,
+            direct_passthrough=True
+        )
+        response.headers['Content-Length'] = file_obj['Metadata'].get('plain-size', file_obj['ContentLength'])
+        if partial:
+            response.headers['Content-Range'] = file_obj['ContentRange']
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    
+    response.headers['Accept-Ranges'] = 'none' if is_transformed(file_obj['Metadata']) else 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+# ==================== BATCH OPERATIONS ====================
+
+DELETE_OBJECTS_LIMIT = 1000  # S3 delete_objects accepts at most 1000 keys
+
+def split_owned_keys(keys, user_id):
+    """Split keys into (owned index entries, error records) using indexed lookups"""
+    ensure_file_index(user_id)
+    entries = get_file_entries(user_id, keys)
+    owned, errors = [], []
+    for key in dict.fromkeys(keys):
+        if key in entries:
+            owned.append(entries[key])
+        else:
+            errors.append({'key': key, 'error': 'Unauthorized'})
+    return owned, errors
+
+def delete_keys(keys):
+    """Delete keys with delete_objects in 1000-key calls; returns (deleted, errors)"""
+    deleted, errors = [], []
+    chunks = [keys[start:start + DELETE_OBJECTS_LIMIT] for start in range(0, len(keys), DELETE_OBJECTS_LIMIT)]
+    responses = s3_map('delete_objects', [
+        {'Delete': {'Objects': [{'Key': key} for key in chunk], 'Quiet': True}} for chunk in chunks
+    ])
+    for chunk, response in zip(chunks, responses):
+        if isinstance(response, Exception):
+            errors.extend({'key': key, 'error': str(response)} for key in chunk)
+            continue
+        failed = {error['Key']: error.get('Message', error.get('Code')) for error in response.get('Errors', [])}
+        for key in chunk:
+            object_metadata_cache.invalidate(key)
+            if key in failed:
+                errors.append({'key': key, 'error': failed[key]})
+            else:
+                deleted.append(key)
+    return deleted, errors
+
+def delete_entries(user_id, entries):
+    """Delete owned index entries with their blob references, previews and share links; returns (deleted, errors)"""
+    deleted, failed = delete_keys([entry['key'] for entry in entries])
+    if deleted:
+        # A concurrent delete may have removed some of these first; it released their blobs
+        removed = update_file_index(user_id, remove=deleted, release_blobs=True)
+        removed_keys = {entry['key'] for entry in removed}
+        failed += [{'key': key, 'error': 'File not found'} for key in deleted if key not in removed_keys]
+        deleted = [key for key in deleted if key in removed_keys]
+        delete_keys([thumbnail_key(entry['key']) for entry in removed if has_thumbnail(entry['filename'])])
+        delete_shares_for_keys(deleted)
+    return deleted, failed
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable write target; zipfile falls back to data descriptors for it"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+    
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+def unique_archive_name(name, used):
+    """Avoid duplicate names inside a ZIP: report.pdf, report (2).pdf, ..."""
+    candidate, number = name, 1
+    stem, dot, ext = name.rpartition('.')
+    if not dot:
+        stem, ext = name, ''
+    while candidate in used:
+        number += 1
+        candidate = f"{stem} ({number}){dot}{ext}"
+    used.add(candidate)
+    return candidate
+
+def iter_zip(entries):
+    """Stream a ZIP of index entries, copying each S3 body through chunk by chunk"""
+    sink = _ZipSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for entry in entries:
+            info = zipfile.ZipInfo(
+                unique_archive_name(entry['filename'], used_names),
+                date_time=datetime.fromisoformat(entry['last_modified']).timetuple()[:6]
+            )
+            info.file_size = entry['size']
+            key = blob_key(entry['blob_hash']) if entry.get('blob_hash') else entry['key']
+            file_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+            with archive.open(info, 'w') as dest:
+                for chunk in decoded_chunks(file_obj):
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+# ==================== FOLDERS ====================
+# A folder view is one list_objects_v2 call with Prefix and Delimiter='/', so
+# it reads only that folder's keys; sizes and hashes come from the file index.
+# S3 cannot rename, so moves copy each object server-side in parallel batches,
+# then re-point the index, share links and previews before deleting the
+# originals. A move that fails partway leaves every file readable under
+# either its old or its new key.
+
+def user_prefix(user_id):
+    return f'{USER_PREFIX}{user_id}/'
+
+def folder_prefix(user_id, folder):
+    return user_prefix(user_id) + (f'{folder}/' if folder else '')
+
+def new_file_key(user_id, filename, folder=''):
+    return f'{folder_prefix(user_id, folder)}{uuid.uuid4().hex}_{filename}'
+
+def key_folder(key):
+    """Folder path of a file key ('' for the root, including legacy root-level keys)"""
+    if not key.startswith(USER_PREFIX):
+        return ''
+    return '/'.join(key.split('/')[2:-1])
+
+def key_basename(key):
+    return key.rsplit('/', 1)[-1]
+
+def normalize_folder(path):
+    """Clean a client folder path like 'a/b/' into 'a/b' ('' is the root).
+
+    Raises ValueError for segments that are empty once made safe (e.g. '..').
+    """
+    segments = []
+    for segment in (path or '').split('/'):
+        if not segment:
+            continue
+        safe = secure_filename(segment)
+        if not safe:
+            raise ValueError(f'Invalid folder name: {segment}')
+        segments.append(safe)
+    folder = '/'.join(segments)
+    if len(folder) > MAX_FOLDER_PATH:
+        raise ValueError('Folder path is too long')
+    return folder
+
+def request_folder(value):
+    """normalize_folder() for a request value; None if it is invalid"""
+    try:
+        return normalize_folder(value)
+    except ValueError:
+        return None
+
+def list_folder(user_id, folder, limit=MAX_PAGE_SIZE, cursor=None):
+    """One page of a folder: its subfolders and its files' index entries"""
+    server_time = datetime.now(timezone.utc).isoformat()  # taken first, so ?since= misses nothing
+    prefix = folder_prefix(user_id, folder)
+    params = {'Bucket': S3_BUCKET, 'Prefix': prefix, 'Delimiter': '/', 'MaxKeys': limit}
+    if cursor:
+        params['ContinuationToken'] = cursor
+    response = s3_client.list_objects_v2(**params)
+    
+    ensure_file_index(user_id)
+    keys = [obj['Key'] for obj in response.get('Contents', [])]
+    entries = get_file_entries(user_id, keys)
+    files = [entries[key] for key in keys if key in entries]
+    if not folder and not cursor:
+        # Files uploaded before folders existed sit at the bucket root, outside the user's prefix
+        files += root_file_entries(user_id)
+    
+    return {
+        'folder': folder,
+        'exists': not folder or response.get('KeyCount', 0) > 0,
+        'folders': [p['Prefix'][len(prefix):-1] for p in response.get('CommonPrefixes', [])],
+        'files': files,
+        'next_cursor': response.get('NextContinuationToken'),
+        'server_time': server_time
+    }
+
+def create_folder(user_id, folder):
+    """Write markers for a folder and its parents, so each outlives its contents"""
+    segments = folder.split('/')
+    for result in s3_map('put_object', [
+        {'Key': folder_prefix(user_id, '/'.join(segments[:depth])), 'Body': b''}
+        for depth in range(1, len(segments) + 1)
+    ]):
+        if isinstance(result, Exception):
+            raise result
+
+def folder_markers(user_id, folder):
+    """Keys of the folder's marker and of every marker below it"""
+    return [obj['Key'] for obj in iter_bucket_objects(folder_prefix(user_id, folder)) if obj['Key'].endswith('/')]
+
+def folder_entries(user_id, folder):
+    """Index entries of every file in a folder and its subfolders"""
+    ensure_file_index(user_id)
+    return entries_under(user_id, folder_prefix(user_id, folder))
+
+def move_files(user_id, moves, concurrency=None):
+    """Move files: moves is a list of (index entry, new key, new filename).
+
+    Returns (new keys, errors). Copies use the managed copy, which switches
+    to a multipart copy for large objects (copy_object stops at 5 GB). A
+    multipart copy does not carry metadata over, so it is always passed
+    explicitly, with 'original-filename' rewritten for renamed files.
+    """
+    moved, errors = [], []
+    for start in range(0, len(moves), MOVE_BATCH_SIZE):
+        batch = moves[start:start + MOVE_BATCH_SIZE]
+        heads = s3_map('head_object', [{'Key': entry['key']} for entry, _, _ in batch], concurrency)
+        calls, copied = [], []
+        for (entry, new_key, filename), head in zip(batch, heads):
+            if isinstance(head, Exception):
+                errors.append({'key': entry['key'], 'error': str(head)})
+                continue
+            calls.append({'Key': new_key, 'CopySource': {'Bucket': S3_BUCKET, 'Key': entry['key']}, 'ExtraArgs': {
+                'Metadata': dict(head['Metadata'], **{'original-filename': filename}),
+                'MetadataDirective': 'REPLACE',
+                'ContentType': head.get('ContentType', 'application/octet-stream')
+            }})
+            copied.append((entry, new_key, filename))
+        
+        done = []
+        for (entry, new_key, filename), result in zip(copied, s3_map('copy', calls, concurrency)):
+            if isinstance(result, Exception):
+                errors.append({'key': entry['key'], 'error': str(result)})
+            else:
+                done.append((entry, dict(entry, key=new_key, filename=filename)))
+        if not done:
+            continue
+        
+        rekey_search_docs({old['key']: new['key'] for old, new in done})  # keeps extracted text
+        update_file_index(user_id, add=[new for _, new in done], remove=[old['key'] for old, _ in done])
+        rekey_shares({old['key']: new['key'] for old, new in done})
+        # Previews that were never rendered are simply missing; they render on first view
+        previews = [(old['key'], new['key']) for old, new in done
+                    if has_thumbnail(old['filename']) and has_thumbnail(new['filename'])]
+        s3_map('copy_object', [
+            {'Key': thumbnail_key(new), 'CopySource': {'Bucket': S3_BUCKET, 'Key': thumbnail_key(old)}}
+            for old, new in previews
+        ], concurrency)
+        delete_keys([old['key'] for old, _ in done] + [thumbnail_key(old['key']) for old, _ in done
+                                                        if has_thumbnail(old['filename'])])
+        moved.extend(new['key'] for _, new in done)
+    return moved, errors
+
+def move_folder(user_id, folder, destination):
+    """Move a folder (with everything in it) to the path destination; returns (new keys, errors)"""
+    old_prefix, new_prefix = folder_prefix(user_id, folder), folder_prefix(user_id, destination)
+    markers = folder_markers(user_id, folder)
+    s3_map('copy_object', [
+        {'Key': new_prefix + key[len(old_prefix):], 'CopySource': {'Bucket': S3_BUCKET, 'Key': key}}
+        for key in markers
+    ])
+    create_folder(user_id, destination)  # folders that only existed implicitly still move
+    moved, errors = move_files(user_id, [
+        (entry, new_prefix + entry['key'][len(old_prefix):], entry['filename'])
+        for entry in folder_entries(user_id, folder)
+    ])
+    if not errors:
+        delete_keys(markers)
+    return moved, errors
+
+def delete_folder(user_id, folder):
+    """Delete a folder, its subfolders and every file in them; returns (deleted keys, errors)"""
+    deleted, errors = delete_entries(user_id, folder_entries(user_id, folder))
+    if not errors:
+        delete_keys(folder_markers(user_id, folder))
+    return deleted, errors
+
+def migrate_user_prefixes(concurrency=None):
+    """Move root-level user files under users/<user_id>/; returns (moved, errors)"""
+    moved, errors = 0, []
+    for user_id, files in scan_bucket_files().items():
+        root_files = [entry for key, entry in files.items() if not key.startswith(USER_PREFIX)]
+        keys, failed = move_files(user_id, [
+            (entry, user_prefix(user_id) + entry['key'], entry['filename']) for entry in root_files
+        ], concurrency)
+        moved += len(keys)
+        errors.extend(failed)
+    return moved, errors
+
+@app.cli.command('migrate-user-prefixes')
+@click.option('--concurrency', default=S3_CONCURRENCY, help='Copies in flight at once')
+def migrate_user_prefixes_command(concurrency):
+    """Move files stored at the bucket root under users/<user_id>/ (safe to re-run)."""
+    moved, errors = migrate_user_prefixes(concurrency)
+    for error in errors:
+        print(f"{error['key']}: {error['error']}")
+    print(f"Moved {moved} files, {len(errors)} errors")
+
+# ==================== PRESIGNED URLS ====================
+
+def presigned_download_url(key, download_name, expires_in=PRESIGNED_URL_EXPIRY):
+    """Presigned GET that makes S3 serve the file as an attachment"""
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': S3_BUCKET,
+            'Key': key,
+            'ResponseContentDisposition': f'attachment; filename="{download_name}"',
+            'ResponseContentType': mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        },
+        ExpiresIn=expires_in
+    )
+
+# ==================== BACKGROUND JOBS ====================
+# Jobs are rows in the local database, so they survive restarts and any
+# process sharing the database can run them. Claiming a job leases it for
+# JOB_LEASE seconds, renewed while its handler runs; if its worker dies,
+# the job is claimed again once the lease runs out.
+
+JOB_HANDLERS = {}
+_job_wakeup = threading.Event()
+_job_workers_pid = None
+_job_workers_lock = threading.Lock()
+_maintenance_at = 0.0
+
+def job_handler(kind):
+    """Register a function(payload) -> JSON-serialisable result for a job kind"""
+    def register(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return register
+
+def enqueue_job(kind, payload, user_id=None, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
+    """Persist a job and wake a worker; returns the job id"""
+    job_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc).isoformat()
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO jobs (id, kind, payload, user_id, status, max_attempts, run_after, created_at, updated_at) '
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), user_id, max_attempts, time.time() + delay, now, now)
+        )
+    start_job_workers()
+    _job_wakeup.set()
+    return job_id
+
+def claim_job():
+    """Lease the next due job (queued, or running with an expired lease)"""
+    now = time.time()
+    with get_db() as conn:
+        rows = conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, run_after = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE status IN ('queued', 'running') AND run_after <= ? "
+            "ORDER BY run_after LIMIT 1) RETURNING *",
+            (now + JOB_LEASE, datetime.now(timezone.utc).isoformat(), now)
+        ).fetchall()
+    return dict(rows[0]) if rows else None
+
+def renew_lease(job):
+    """Extend a running job's lease; False if another worker has claimed it since"""
+    with get_db() as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET run_after = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+            (time.time() + JOB_LEASE, job['id'], job['attempts'])
+        )
+    return cursor.rowcount == 1
+
+@contextmanager
+def lease_heartbeat(job):
+    """Renew a claimed job's lease every JOB_LEASE / 3 seconds until the block exits"""
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(JOB_LEASE / 3):
+            try:
+                if not renew_lease(job):
+                    return
+            except Exception as e:
+                print(f"Renewing the lease of job {job['id']} failed: {e}")
+    thread = threading.Thread(target=beat, name=f"job-lease-{job['id']}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+def finish_job(job_id, status, run_after=0, last_error=None, result=None):
+    with get_db() as conn:
+        conn.execute(
+            'UPDATE jobs SET status = ?, run_after = ?, last_error = ?, result = ?, updated_at = ? WHERE id = ?',
+            (status, run_after, last_error, result, datetime.now(timezone.utc).isoformat(), job_id)
+        )
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, so failed jobs do not retry in lockstep"""
+    delay = min(JOB_RETRY_DELAY * 2 ** (attempts - 1), JOB_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+def run_job(job):
+    """Run a claimed job and record its outcome (done, retry or failed)"""
+    if job['attempts'] > job['max_attempts']:
+        # Its last attempt never reported back (the worker died mid-job)
+        finish_job(job['id'], 'failed', last_error=job['last_error'] or 'Worker stopped during the last attempt')
+        return
+    
+    started = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(job['kind'])
+        if handler is None:
+            raise LookupError(f"Unknown job kind: {job['kind']}")
+        with lease_heartbeat(job):
+            result = handler(json.loads(job['payload']))
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        if job['attempts'] >= job['max_attempts']:
+            outcome = 'failed'
+            print(f"Job {job['id']} ({job['kind']}) failed after {job['attempts']} attempts: {error}")
+            finish_job(job['id'], 'failed', last_error=error)
+        else:
+            outcome = 'retry'
+            finish_job(job['id'], 'queued', run_after=time.time() + retry_delay(job['attempts']), last_error=error)
+    else:
+        outcome = 'done'
+        finish_job(job['id'], 'done', result=json.dumps(result))
+    with _metrics_lock:
+        job_latency[job['kind']].observe(time.perf_counter() - started)
+        job_outcomes[(job['kind'], outcome)] += 1
+
+def prune_jobs():
+    """Delete finished jobs older than JOB_RETENTION_DAYS; returns how many"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=JOB_RETENTION_DAYS)).isoformat()
+    with get_db() as conn:
+        cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+    return cursor.rowcount
+
+def job_worker():
+    """Worker thread loop: run due jobs, otherwise sleep until woken or polled"""
+    global _maintenance_at
+    while True:
+        try:
+            job = claim_job()
+            if job is not None:
+                run_job(job)
+                continue
+            if time.monotonic() - _maintenance_at > MAINTENANCE_INTERVAL:
+                _maintenance_at = time.monotonic()
+                prune_jobs()
+                sweep_expired_tokens()
+                gc_upload_sessions()
+                prune_rate_limits()
+        except Exception as e:
+            print(f"Job worker error: {e}")
+        _job_wakeup.wait(JOB_POLL_INTERVAL)
+        _job_wakeup.clear()
+
+def start_job_workers(count=JOB_WORKERS):
+    """Start this process's worker threads (once per process, so forked workers get their own)"""
+    global _job_workers_pid
+    if count <= 0 or _job_workers_pid == os.getpid():
+        return
+    with _job_workers_lock:
+        if _job_workers_pid == os.getpid():
+            return
+        for n in range(count):
+            threading.Thread(target=job_worker, name=f'job-worker-{n}', daemon=True).start()
+        _job_workers_pid = os.getpid()
+
+def job_counts():
+    rows = get_db().execute('SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status').fetchall()
+    return {(row['kind'], row['status']): row['n'] for row in rows}
+
+def job_status(row):
+    """Public view of a job row"""
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'key': json.loads(row['payload']).get('key'),
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'max_attempts': row['max_attempts'],
+        'last_error': row['last_error'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at']
+    }
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=2, help='Worker threads')
+def run_jobs_command(workers):
+    """Run background jobs in the foreground (use with JOB_WORKERS=0 on web workers)."""
+    start_job_workers(workers)
+    print(f"Running background jobs with {workers} workers (Ctrl+C to stop)")
+    while True:
+        time.sleep(3600)
+
+# ==================== JOB HANDLERS ====================
+
+def thumbnail_key(key):
+    return f'{THUMBNAIL_PREFIX}{key}.jpg'
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+def has_thumbnail(filename):
+    """Whether a file of this type may have a stored thumbnail"""
+    return file_extension(filename) in THUMBNAIL_EXTENSIONS
+
+def can_render_thumbnail(filename):
+    """Whether this process has the optional library needed to render one"""
+    extension = file_extension(filename)
+    if extension == 'pdf':
+        return pymupdf is not None
+    return extension in THUMBNAIL_EXTENSIONS and Image is not None
+
+def render_thumbnail(data, filename):
+    """JPEG thumbnail (longest side THUMBNAIL_SIZE) of an image or a PDF's first page.
+
+    Returns None when the bytes cannot be decoded; retrying will not change that.
+    """
+    with timed_span('thumbnail'):
+        if file_extension(filename) == 'pdf':
+            try:
+                with pymupdf.open(stream=data, filetype='pdf') as document:
+                    page = document[0]
+                    zoom = THUMBNAIL_SIZE / max(page.rect.width, page.rect.height)
+                    return page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).tobytes('jpeg')
+            except (RuntimeError, IndexError, ValueError):
+                return None
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                output = io.BytesIO()
+                image.convert('RGB').save(output, 'JPEG', quality=85)
+                return output.getvalue()
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+def store_thumbnail(key, stored):
+    """Render and store the thumbnail for a user key from read_stored_file() output.
+
+    Returns (thumbnail, ETag of the stored object), or None if it cannot be
+    rendered or the file is over THUMBNAIL_MAX_SOURCE_SIZE.
+    """
+    metadata, body = stored
+    try:
+        data = body.read(THUMBNAIL_MAX_SOURCE_SIZE + 1)  # one byte over tells a too-large file apart
+    finally:
+        body.close()
+    if len(data) > THUMBNAIL_MAX_SOURCE_SIZE:
+        return None
+    thumbnail = render_thumbnail(data, metadata.get('original-filename', key))
+    if thumbnail is None:
+        return None
+    # Previews show file content, so they are encrypted like the file
+    transform = storage_transform(thumbnail_key(key), metadata.get('user-id', 'unknown')) or {}
+    stored_body = b''.join(encode_chunks([thumbnail], transform)) if transform else thumbnail
+    response = s3_client.put_object(Bucket=S3_BUCKET, Key=thumbnail_key(key), Body=stored_body,
+                                    ContentType='image/jpeg', Metadata=transform)
+    return thumbnail, response['ETag']
+
+def enqueue_post_upload(entry, user_id, direct=False):
+    """Queue integrity verification, thumbnailing and text indexing for a new file; returns the job ids"""
+    jobs = []
+    if VERIFY_UPLOADS == 'all' or (VERIFY_UPLOADS == 'direct' and direct):
+        jobs.append(enqueue_job('verify_file', {'key': entry['key']}, user_id))
+    if can_render_thumbnail(entry['filename']):
+        jobs.append(enqueue_job('thumbnail', {'key': entry['key']}, user_id))
+    if can_extract_text(entry['filename']):
+        jobs.append(enqueue_job('index_text', {'key': entry['key']}, user_id))
+    return jobs
+
+def read_stored_file(key):
+    """(metadata, body stream) for a user key, following dedup pointers; None if deleted"""
+    try:
+        metadata = s3_client.head_object(Bucket=S3_BUCKET, Key=key)['Metadata']
+        file_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=storage_key(key, metadata))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return metadata, decoded_body(file_obj)
+
+@job_handler('send_email')
+def send_email_job(payload):
+    with create_app().app_context():
+        msg = Message(subject=payload['subject'], recipients=payload['recipients'])
+        msg.html = payload['html']
+        mail.send(msg)
+
+@job_handler('finalize_upload')
+def finalize_upload_job(payload):
+    """Hash a staged resumable upload that could not be hashed incrementally, then publish it"""
+    return finalize_upload(payload['upload_id'])
+
+@job_handler('verify_file')
+def verify_file_job(payload):
+    """Re-read a stored file and compare it with the hash recorded at upload"""
+    return record_integrity_check(check_file_integrity(payload['key']), 'job')
+
+@job_handler('thumbnail')
+def thumbnail_job(payload):
+    """Store a THUMBNAIL_SIZE JPEG of an uploaded image or PDF under previews/"""
+    stored = read_stored_file(payload['key'])
+    if stored is None:
+        return {'missing': True}
+    if not can_render_thumbnail(stored[0].get('original-filename', payload['key'])):
+        return {'skipped': 'No renderer installed for this file type'}
+    if store_thumbnail(payload['key'], stored) is None:
+        return {'skipped': 'File could not be decoded or is too large to preview'}
+    return {'thumbnail': thumbnail_key(payload['key'])}
+
+# ==================== INTEGRITY ====================
+# The scrubber walks every user's file index in (user, key) order, re-hashing
+# a page of files in parallel, then records the last key as its checkpoint,
+# so an interrupted run resumes where it stopped. Walking the indexes rather
+# than the bucket also finds files whose objects have gone missing.
+
+class ByteThrottle:
+    """Paces callers so that together they read at most rate bytes per second"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+def check_file_integrity(key, throttle=None, verified_blobs=None):
+    """Re-hash a user file's stored bytes against its recorded 'file-hash'.
+
+    Status is 'ok', 'mismatch', 'missing' (object or blob gone) or
+    'unverifiable' (no recorded hash). verified_blobs lets one scrub run
+    hash each dedup blob once.
+    """
+    result = {'key': key, 'expected': None, 'actual': None, 'size': 0}
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        metadata = response['Metadata']
+        result['expected'] = metadata.get('file-hash')
+        if metadata.get('blob-hash'):
+            response['Body'].close()
+            if verified_blobs is not None and metadata['blob-hash'] in verified_blobs:
+                return dict(result, status='ok', actual=metadata['blob-hash'])
+            response = s3_client.get_object(Bucket=S3_BUCKET, Key=blob_key(metadata['blob-hash']))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return dict(result, status='missing')
+        raise
+    
+    if not result['expected']:
+        response['Body'].close()
+        return dict(result, status='unverifiable')
+    body = decoded_body(response)
+    try:
+        result['actual'], result['size'] = hash_stream(body, float('inf'), throttle)
+    except StorageDecodeError:
+        return dict(result, status='mismatch')  # corrupt ciphertext or compressed stream
+    finally:
+        body.close()
+    if result['actual'] != result['expected']:
+        return dict(result, status='mismatch')
+    if verified_blobs is not None and metadata.get('blob-hash'):
+        verified_blobs.add(metadata['blob-hash'])
+    return dict(result, status='ok')
+
+def record_integrity_check(result, source):
+    """Count a check and keep a record of any failure; returns result"""
+    with _metrics_lock:
+        integrity_checks[(source, result['status'])] += 1
+    if result['status'] in ('mismatch', 'missing'):
+        print(f"Integrity check failed ({source}) for {result['key']}: {result['status']}, "
+              f"expected {result['expected']}, got {result['actual']}")
+        with get_db() as conn:
+            conn.execute(
+                'INSERT INTO integrity_failures (key, status, expected, actual, source, found_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (result['key'], result['status'], result['expected'], result['actual'], source,
+                 datetime.now(timezone.utc).isoformat())
+            )
+    return result
+
+def current_scrub_run(restart=False):
+    """The unfinished scrub run, or a new one"""
+    with get_db() as conn:
+        if restart:
+            conn.execute('UPDATE scrub_runs SET finished_at = ? WHERE finished_at IS NULL',
+                         (datetime.now(timezone.utc).isoformat(),))
+        row = conn.execute('SELECT * FROM scrub_runs WHERE finished_at IS NULL ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            conn.execute('INSERT INTO scrub_runs (started_at) VALUES (?)', (datetime.now(timezone.utc).isoformat(),))
+            row = conn.execute('SELECT * FROM scrub_runs ORDER BY id DESC LIMIT 1').fetchone()
+    return dict(row)
+
+def iter_scrub_pages(checkpoint, page_size):
+    """Pages of (user_id, key) after the checkpoint, in (user, key) order"""
+    while True:
+        page = [(row['user_id'], row['key']) for row in get_db().execute(
+            'SELECT user_id, key FROM file_index WHERE (user_id, key) > (?, ?) AND entry IS NOT NULL '
+            'ORDER BY user_id, key LIMIT ?', (*checkpoint, page_size)
+        )]
+        if not page:
+            return
+        yield page
+        checkpoint = page[-1]
+
+def scrub(workers=SCRUB_WORKERS, rate=SCRUB_BYTES_PER_SECOND, time_budget=None, restart=False):
+    """Verify every indexed file, resuming the current run from its checkpoint.
+
+    Memory is bounded by workers x DOWNLOAD_CHUNK_SIZE; reads are throttled to
+    rate bytes per second overall. Stops after time_budget seconds (at a page
+    boundary) if given. Returns the run's row; finished_at is set when done.
+    """
+    run = current_scrub_run(restart)
+    throttle = ByteThrottle(rate)
+    verified_blobs = set()
+    deadline = time.monotonic() + time_budget if time_budget else None
+    checkpoint = (run['checkpoint_user'], run['checkpoint_key'])
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in iter_scrub_pages(checkpoint, workers * 8):
+            results = list(pool.map(
+                lambda item: record_integrity_check(check_file_integrity(item[1], throttle, verified_blobs), 'scrub'),
+                page
+            ))
+            with get_db() as conn:
+                conn.execute(
+                    'UPDATE scrub_runs SET checkpoint_user = ?, checkpoint_key = ?, files = files + ?, '
+                    'bytes = bytes + ?, failures = failures + ? WHERE id = ?',
+                    (page[-1][0], page[-1][1], len(results), sum(r['size'] for r in results),
+                     sum(r['status'] in ('mismatch', 'missing') for r in results), run['id'])
+                )
+            if deadline and time.monotonic() > deadline:
+                return dict(get_db().execute('SELECT * FROM scrub_runs WHERE id = ?', (run['id'],)).fetchone())
+    
+    with get_db() as conn:
+        conn.execute('UPDATE scrub_runs SET finished_at = ? WHERE id = ?',
+                     (datetime.now(timezone.utc).isoformat(), run['id']))
+    return dict(get_db().execute('SELECT * FROM scrub_runs WHERE id = ?', (run['id'],)).fetchone())
+
+@job_handler('scrub')
+def scrub_job(payload):
+    """Scrub for one slice, then queue the next slice until the run is done"""
+    run = scrub(time_budget=SCRUB_SLICE_SECONDS, restart=payload.get('restart', False))
+    if not run['finished_at']:
+        enqueue_job('scrub', {})
+    return run
+
+@app.cli.command('scrub')
+@click.option('--workers', default=SCRUB_WORKERS, help='Files hashed in parallel')
+@click.option('--rate', default=SCRUB_BYTES_PER_SECOND, help='Bytes per second to read (0 = unthrottled)')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming the current run')
+@click.option('--background', is_flag=True, help='Queue the scrub as background jobs instead')
+def scrub_command(workers, rate, restart, background):
+    """Re-hash every stored file and report mismatches and missing objects."""
+    if background:
+        print(f"Queued scrub job {enqueue_job('scrub', {'restart': restart})}")
+        return
+    run = scrub(workers, rate, restart=restart)
+    print(f"Scrubbed {run['files']} files ({run['bytes'] / 1048576:.1f} MB), {run['failures']} failures")
+
+@app.cli.command('scrub-report')
+@click.option('--limit', default=100, help='Most recent failures to show')
+def scrub_report_command(limit):
+    """Show scrub progress and recent integrity failures."""
+    for run in get_db().execute('SELECT * FROM scrub_runs ORDER BY id DESC LIMIT 5'):
+        state = f"finished {run['finished_at']}" if run['finished_at'] else \
+            f"at {run['checkpoint_user']}/{run['checkpoint_key']}"
+        print(f"Run {run['id']} started {run['started_at']}, {state}: "
+              f"{run['files']} files, {run['bytes'] / 1048576:.1f} MB, {run['failures']} failures")
+    for failure in get_db().execute('SELECT * FROM integrity_failures ORDER BY id DESC LIMIT ?', (limit,)):
+        print(f"{failure['found_at']}  {failure['source']:<10}{failure['status']:<10}{failure['key']}")
+
+# ==================== SEARCH ====================
+# search_docs holds one row per file with the fields used for filtering;
+# search_fts indexes its name, extension and extracted text under the same
+# rowid. Each row also carries an owner token, so a query only intersects
+# the caller's posting lists instead of filtering every user's matches.
+# Rows follow update_file_index(); text is extracted by a background job.
+
+def owner_token(user_id):
+    return 'u' + re.sub(r'[^0-9A-Za-z]', '', user_id)
+
+def update_search_index(user_id, add=None, remove=None):
+    """Mirror file index changes into the search tables, keeping any extracted text"""
+    with get_db() as conn:
+        for entry in add or []:
+            doc_id = conn.execute(
+                'INSERT INTO search_docs (key, user_id, ext, folder, last_modified, entry) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET ext = excluded.ext, folder = excluded.folder, '
+                'last_modified = excluded.last_modified, entry = excluded.entry RETURNING id',
+                (entry['key'], user_id, file_extension(entry['filename']), key_folder(entry['key']),
+                 entry['last_modified'], json.dumps(entry))
+            ).fetchone()['id']
+            previous = conn.execute('SELECT content FROM search_fts WHERE rowid = ?', (doc_id,)).fetchone()
+            conn.execute('DELETE FROM search_fts WHERE rowid = ?', (doc_id,))
+            conn.execute(
+                'INSERT INTO search_fts (rowid, owner, filename, ext, content) VALUES (?, ?, ?, ?, ?)',
+                (doc_id, owner_token(user_id), entry['filename'], file_extension(entry['filename']),
+                 previous['content'] if previous and SEARCH_INDEX_CONTENT else '')
+            )
+        for key in remove or []:
+            row = conn.execute('DELETE FROM search_docs WHERE key = ? RETURNING id', (key,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM search_fts WHERE rowid = ?', (row['id'],))
+
+def rekey_search_docs(renamed):
+    """Carry search rows (and their text) over to moved files: renamed maps old key -> new key"""
+    with get_db() as conn:
+        conn.executemany('UPDATE search_docs SET key = ? WHERE key = ?', [(new, old) for old, new in renamed.items()])
+
+def set_search_text(key, text):
+    """Store a file's extracted text; False if the file is no longer indexed"""
+    with get_db() as conn:
+        row = conn.execute('SELECT id FROM search_docs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False
+        conn.execute('UPDATE search_fts SET content = ? WHERE rowid = ?', (text, row['id']))
+    return True
+
+def can_extract_text(filename):
+    if not SEARCH_INDEX_CONTENT:
+        return False
+    extension = file_extension(filename)
+    if extension == 'pdf':
+        return pymupdf is not None
+    return extension in SEARCH_TEXT_EXTENSIONS
+
+def extract_text(body, filename):
+    """Up to SEARCH_TEXT_LIMIT characters of a txt, docx or pdf body; None if it cannot be read or is too large"""
+    extension = file_extension(filename)
+    with timed_span('extract_text'):
+        if extension == 'txt':
+            # At most 4 bytes per character, so this reads no more than the limit needs
+            return body.read(SEARCH_TEXT_LIMIT * 4).decode('utf-8', errors='replace')[:SEARCH_TEXT_LIMIT]
+        data = body.read(SEARCH_MAX_SOURCE_SIZE + 1)
+        if len(data) > SEARCH_MAX_SOURCE_SIZE:
+            return None
+        if extension == 'docx':
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as archive, archive.open('word/document.xml') as document:
+                    xml = document.read(SEARCH_TEXT_LIMIT * 20).decode('utf-8', errors='replace')  # markup-heavy
+            except (zipfile.BadZipFile, KeyError):
+                return None
+            text = re.sub(r'<[^>]+>', '', re.sub(r'</w:p>|<w:tab/>|<w:br/>', '\n', xml))
+            return html.unescape(text)[:SEARCH_TEXT_LIMIT]
+        if extension == 'pdf':
+            try:
+                parts, length = [], 0
+                with pymupdf.open(stream=data, filetype='pdf') as document:
+                    for page in document:
+                        parts.append(page.get_text())
+                        length += len(parts[-1])
+                        if length >= SEARCH_TEXT_LIMIT:
+                            break
+                return ''.join(parts)[:SEARCH_TEXT_LIMIT]
+            except (RuntimeError, ValueError):
+                return None
+    return None
+
+@job_handler('index_text')
+def index_text_job(payload):
+    """Extract a txt, docx or pdf file's text into the search index"""
+    stored = read_stored_file(payload['key'])
+    if stored is None:
+        return {'missing': True}
+    metadata, body = stored
+    try:
+        text = extract_text(body, metadata.get('original-filename', payload['key']))
+    finally:
+        body.close()
+    if text is None:
+        return {'skipped': 'Text could not be extracted'}
+    return {'indexed': set_search_text(payload['key'], text), 'characters': len(text)}
+
+def index_user_for_search(user_id, extract=True):
+    """(Re)index all of a user's files from their file index; returns (files, text jobs queued)"""
+    index = get_file_index(user_id)
+    entries = list(index['files'].values())
+    stale = [row['key'] for row in get_db().execute('SELECT key FROM search_docs WHERE user_id = ?', (user_id,))
+             if row['key'] not in index['files']]
+    update_search_index(user_id, add=entries, remove=stale)
+    jobs = 0
+    if extract:
+        for entry in entries:
+            if can_extract_text(entry['filename']):
+                enqueue_job('index_text', {'key': entry['key']}, user_id)
+                jobs += 1
+    with get_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO search_users (user_id, indexed_at) VALUES (?, ?)',
+                     (user_id, datetime.now(timezone.utc).isoformat()))
+    return len(entries), jobs
+
+def ensure_search_index(user_id):
+    """Index the files of users who uploaded before search existed, on their first search"""
+    if get_db().execute('SELECT 1 FROM search_users WHERE user_id = ?', (user_id,)).fetchone() is None:
+        index_user_for_search(user_id)
+
+def fts_query(text):
+    """FTS5 query matching every word of text as a prefix in name, extension or content"""
+    words = re.findall(r'[^\W_]+', text.lower())[:16]
+    if not words:
+        return None
+    return '{filename ext content} : (' + ' AND '.join(f'"{word}"*' for word in words) + ')'
+
+def search_files(user_id, args):
+    """Ranked, paginated search of a user's files according to /api/search query args.
+
+    Raises ValueError for malformed parameters.
+    """
+    limit = max(1, min(int(args.get('limit', SEARCH_PAGE_SIZE)), MAX_PAGE_SIZE))
+    offset = max(0, int(decode_cursor(args['cursor'])[0])) if args.get('cursor') else 0
+    conditions, params = ['d.user_id = ?'], [user_id]
+    
+    extensions = [ext.strip().lower().lstrip('.') for ext in args.get('ext', '').split(',') if ext.strip()]
+    if extensions:
+        conditions.append(f"d.ext IN ({', '.join('?' * len(extensions))})")
+        params += extensions
+    if 'folder' in args:
+        conditions.append('d.folder = ?')
+        params.append(normalize_folder(args['folder']))
+    if args.get('from'):
+        conditions.append('d.last_modified >= ?')
+        params.append(parse_timestamp(args['from']).astimezone(timezone.utc).isoformat())
+    if args.get('to'):
+        conditions.append('d.last_modified <= ?')
+        params.append(parse_timestamp(args['to']).astimezone(timezone.utc).isoformat())
+    
+    query = fts_query(args.get('q', ''))
+    with timed_span('search'):
+        if query:
+            rows = get_db().execute(
+                "SELECT d.entry, d.folder, snippet(search_fts, 3, '', '', '…', 16) AS snippet "
+                'FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid '
+                f"WHERE search_fts MATCH ? AND {' AND '.join(conditions)} "
+                'ORDER BY bm25(search_fts, 0.0, 10.0, 4.0, 1.0), d.id LIMIT ? OFFSET ?',
+                [f'owner : "{owner_token(user_id)}" AND {query}'] + params + [limit + 1, offset]
+            ).fetchall()
+        else:
+            # Filters only: newest first
+            rows = get_db().execute(
+                "SELECT d.entry, d.folder, '' AS snippet FROM search_docs d "
+                f"WHERE {' AND '.join(conditions)} ORDER BY d.last_modified DESC, d.id LIMIT ? OFFSET ?",
+                params + [limit + 1, offset]
+            ).fetchall()
+    
+    results = []
+    for row in rows[:limit]:
+        result = dict(json.loads(row['entry']), folder=row['folder'])
+        if row['snippet']:
+            result['snippet'] = row['snippet']
+        results.append(result)
+    return {
+        'results': results,
+        'next_cursor': encode_cursor(offset + limit, '') if len(rows) > limit else None
+    }
+
+@app.cli.command('rebuild-search-index')
+@click.option('--extract/--no-extract', default=True, help='Queue text extraction for txt/docx/pdf files')
+def rebuild_search_index_command(extract):
+    """Re-index every user's files for search."""
+    user_ids = {user['user_id'] for user in user_store.all().values()}
+    files = jobs = 0
+    for user_id in sorted(user_ids):
+        indexed, queued = index_user_for_search(user_id, extract)
+        files += indexed
+        jobs += queued
+    print(f"Indexed {files} files for {len(user_ids)} users, queued {jobs} text extraction jobs")
+
+# ==================== RATE LIMITING ====================
+# Token buckets: a bucket holds up to <requests> tokens and refills at
+# <requests>/<seconds> per second; each request takes one. Concurrency caps
+# bound how many slow requests (password hashing, uploads) a worker runs at
+# once, so a burst is refused quickly instead of queueing behind them.
+
+def parse_rate(rule):
+    """'20/60' -> (capacity 20, refill 20/60 tokens per second)"""
+    count, seconds = rule.split('/')
+    return float(count), float(count) / float(seconds)
+
+class MemoryRateLimiter:
+    """Buckets in this process only"""
+    
+    max_keys = 100000
+    
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, monotonic time)
+        self._lock = threading.Lock()
+    
+    def take(self, key, capacity, rate):
+        """Take a token; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return 0 if allowed else (1 - tokens) / rate
+    
+    def _prune(self, now):
+        # A bucket idle for an hour has refilled (limits are per minute), so it can be forgotten
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < 3600}
+
+class SQLiteRateLimiter:
+    """Buckets in the local database, shared by every worker process on the host"""
+    
+    def take(self, key, capacity, rate):
+        now = time.time()
+        refill = 'MIN(:capacity, tokens + (:now - updated_at) * :rate)'
+        # One statement, so concurrent workers cannot both spend the last token
+        with get_db() as conn:
+            row = conn.execute(
+                'INSERT INTO rate_limits (key, tokens, allowed, updated_at) VALUES (:key, :capacity - 1, 1, :now) '
+                f'ON CONFLICT(key) DO UPDATE SET '
+                f'tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END, '
+                f'allowed = {refill} >= 1, updated_at = :now '
+                'RETURNING tokens, allowed',
+                {'key': key, 'capacity': capacity, 'rate': rate, 'now': now}
+            ).fetchall()[0]
+        return 0 if row['allowed'] else (1 - row['tokens']) / rate
+
+rate_limiter = SQLiteRateLimiter() if RATE_LIMIT_BACKEND == 'sqlite' else MemoryRateLimiter()
+_concurrency_slots = {name: threading.BoundedSemaphore(limit) for name, limit in CONCURRENCY_LIMITS.items()}
+
+def prune_rate_limits():
+    """Drop idle shared buckets (they have refilled anyway)"""
+    with get_db() as conn:
+        conn.execute('DELETE FROM rate_limits WHERE updated_at < ?', (time.time() - 3600,))
+
+def check_rate_limits(name, identity):
+    """Seconds to wait before retrying, or 0 if every bucket had a token"""
+    rules = RATE_LIMITS.get(name, {})
+    subjects = {'ip': request.remote_addr, 'user': identity}
+    waits = [
+        rate_limiter.take(f'{name}:{scope}:{subjects[scope]}', *parse_rate(rule))
+        for scope, rule in rules.items() if subjects.get(scope)
+    ]
+    return max(waits, default=0)
+
+def limit_response(name, reason, status, retry_after, message, template):
+    with _metrics_lock:
+        rejected_requests[(name, reason)] += 1
+    if template:
+        response = app.make_response((render_template(template, error=message, **request.view_args), status))
+    elif request.path.startswith('/api/'):
+        response = app.make_response((jsonify({'error': message}), status))
+    else:
+        response = app.make_response((message, status))
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def rate_limited(name, identity=lambda: session.get('user_id'), template=None, concurrency=None):
+    """Apply the named rate limits and concurrency cap to a route.
+
+    identity returns the per-user bucket key (the session user by default).
+    template renders HTML form pages with an error instead of JSON.
+    concurrency names another limit's cap to share instead of name's own.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            retry_after = check_rate_limits(name, identity())
+            if retry_after:
+                return limit_response(name, 'rate', 429, retry_after,
+                                      'Too many requests, please try again later', template)
+            slots = _concurrency_slots.get(concurrency or name)
+            if slots is None:
+                return f(*args, **kwargs)
+            if not slots.acquire(blocking=False):
+                return limit_response(name, 'concurrency', 503, 1,
+                                      'Server is busy, please try again shortly', template)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                slots.release()
+        return decorated_function
+    return decorator
+
+def form_email():
+    return (request.form.get('email') or '').strip().lower()
+
+def login_required(f):
+    """Decorator to check if user is logged in"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_email' not in session:
+            return redirect(url_for('login_page'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def generate_file_hash(file_content):
+    return hashlib.sha256(file_content).hexdigest()
+
+# ==================== AUTHENTICATION ROUTES ====================
+
+@app.route('/login')
+def login_page():
+    if 'user_email' in session:
+        return redirect(url_for('index'))
+    return render_template('login.html')
+
+@app.route('/signup')
+def signup_page():
+    if 'user_email' in session:
+        return redirect(url_for('index'))
+    return render_template('signup.html')
+
+@app.route('/login', methods=['POST'])
+@rate_limited('auth', identity=form_email, template='login.html')
+def login():
+    try:
+        email = request.form.get('email')
+        password = request.form.get('password')
+        
+        if not email or not password:
+            return render_template('login.html', error='Please provide email and password')
+        
+        user = user_store.get(email)
+        
+        if user is None:
+            return render_template('login.html', error='Invalid email or password')
+        
+        with timed_span('password-hash'):
+            valid = check_password_hash(user['password'], password)
+        if not valid:
+            return render_template('login.html', error='Invalid email or password')
+        
+        session['user_email'] = email
+        session['user_id'] = user['user_id']
+        return redirect(url_for('index'))
+        
+    except Exception as e:
+        return render_template('login.html', error=str(e))
+
+@app.route('/signup', methods=['POST'])
+@rate_limited('auth', identity=form_email, template='signup.html')
+def signup():
+    try:
+        email = request.form.get('email')
+        password = request.form.get('password')
+        
+        if not email or not password:
+            return render_template('signup.html', error='Please provide email and password')
+        
+        if len(password) < 6:
+            return render_template('signup.html', error='Password must be at least 6 characters')
+        
+        if user_store.get(email) is not None:
+            return render_template('signup.html', error='Email already registered')
+        
+        with timed_span('password-hash'):
+            password_hash = generate_password_hash(password)
+        user = {
+            'user_id': str(uuid.uuid4()),
+            'password': password_hash,
+            'created_at': datetime.now().isoformat()
+        }
+        
+        # The insert is atomic, so a concurrent signup for the same email loses here
+        if not user_store.create(email, user):
+            return render_template('signup.html', error='Email already registered')
+        replace_file_index(user['user_id'], {})
+        
+        session['user_email'] = email
+        session['user_id'] = user['user_id']
+        return redirect(url_for('index'))
+        
+    except Exception as e:
+        return render_template('signup.html', error=str(e))
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('login_page'))
+
+# ==================== PASSWORD RESET ROUTES ====================
+
+@app.route('/forgot-password')
+def forgot_password_page():
+    """Display forgot password page"""
+    if 'user_email' in session:
+        return redirect(url_for('index'))
+    return render_template('forgot_password.html')
+
+@app.route('/forgot-password', methods=['POST'])
+@rate_limited('auth', identity=form_email, template='forgot_password.html')
+def forgot_password():
+    """Handle password reset request"""
+    try:
+        email = request.form.get('email')
+        
+        if not email:
+            return render_template('forgot_password.html', error='Please provide your email')
+        
+        if user_store.get(email) is None:
+            return render_template('forgot_password.html', 
+                success='If an account exists with this email, you will receive a password reset link.')
+        
+        reset_token = create_reset_token(email)
+        
+        # Send email
+        base_url = os.environ.get("BASE_URL", request.host_url.rstrip("/"))
+        reset_link = f"{request.host_url}reset-password/{reset_token}"
+        
+        html = f"""
+        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+            <h2 style="color: #667eea;">CloudDrive Password Reset</h2>
+            <p>Hi there,</p>
+            <p>You recently requested to reset your password for your CloudDrive account.</p>
+            <p>Click the button below to reset your password:</p>
+            <div style="text-align: center; margin: 30px 0;">
+                <a href="{reset_link}" 
+                   style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                          color: white;
+                          padding: 12px 30px;
+                          text-decoration: none;
+                          border-radius: 8px;
+                          display: inline-block;
+                          font-weight: bold;">
+                    Reset Password
+                </a>
+            </div>
+            <p>Or copy and paste this link into your browser:</p>
+            <p style="background: #f5f5f5; padding: 10px; border-radius: 5px; word-break: break-all;">
+                {reset_link}
+            </p>
+            <p style="color: #666; font-size: 0.9em;">
+                This link will expire in 1 hour.
+            </p>
+            <p style="color: #666; font-size: 0.9em;">
+                If you didn't request a password reset, you can safely ignore this email.
+            </p>
+            <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
+            <p style="color: #999; font-size: 0.8em;">
+                CloudDrive - Secure File Storage System
+            </p>
+        </div>
+        """
+        
+        # Sent by a background worker, so an SMTP stall never holds up the request
+        enqueue_job('send_email', {
+            'subject': 'CloudDrive - Password Reset Request',
+            'recipients': [email],
+            'html': html
+        })
+        
+        return render_template('forgot_password.html', 
+            success='If an account exists with this email, you will receive a password reset link.')
+        
+    except Exception as e:
+        print(f"Error in forgot_password: {e}")
+        return render_template('forgot_password.html', 
+            error='An error occurred. Please try again later.')
+
+@app.route('/reset-password/<token>')
+def reset_password_page(token):
+    """Display reset password page"""
+    if 'user_email' in session:
+        return redirect(url_for('index'))
+    
+    token_data = get_reset_token(token)
+    
+    if token_data is None:
+        return render_template('reset_password.html', error='Invalid or expired reset link')
+    
+    expiry_time = datetime.fromisoformat(token_data['expiry'])
+    if datetime.now() > expiry_time:
+        return render_template('reset_password.html', error='This reset link has expired')
+    
+    if token_data.get('used', False):
+        return render_template('reset_password.html', error='This reset link has already been used')
+    
+    return render_template('reset_password.html', token=token)
+
+@app.route('/reset-password/<token>', methods=['POST'])
+@rate_limited('auth', identity=lambda: request.view_args.get('token'), template='reset_password.html')
+def reset_password(token):
+    """Handle password reset"""
+    try:
+        new_password = request.form.get('password')
+        confirm_password = request.form.get('confirm_password')
+        
+        if not new_password or not confirm_password:
+            return render_template('reset_password.html', token=token, 
+                error='Please provide both password fields')
+        
+        if new_password != confirm_password:
+            return render_template('reset_password.html', token=token,
+                error='Passwords do not match')
+        
+        if len(new_password) < 6:
+            return render_template('reset_password.html', token=token,
+                error='Password must be at least 6 characters')
+        
+        token_data = get_reset_token(token)
+        
+        if token_data is None:
+            return render_template('reset_password.html', token=token,
+                error='Invalid or expired reset link')
+        
+        expiry_time = datetime.fromisoformat(token_data['expiry'])
+        if datetime.now() > expiry_time:
             return render_template('reset_password.html', token=token,
                 error='This reset link has expired')
         
@@ -368,78 +3653,330 @@ def reset_password(token):
                 error='This reset link has already been used')
         
         email = token_data['email']
-        users = load_users()
         
-        if email not in users:
+        with timed_span('password-hash'):
+            password_hash = generate_password_hash(new_password)
+        
+        # Claimed atomically, so two concurrent submissions cannot both succeed
+        if not use_reset_token(token):
+            return render_template('reset_password.html', token=token,
+                error='This reset link has already been used')
+        
+        updated = user_store.update_password(email, password_hash)
+        if not updated:
             return render_template('reset_password.html', token=token,
                 error='User account not found')
         
-        users[email]['password'] = generate_password_hash(new_password)
-        save_users(users)
+        return render_template('reset_password.html', 
+            success='Password reset successful! You can now login with your new password.')
+        
+    except Exception as e:
+        print(f"Error in reset_password: {e}")
+        return render_template('reset_password.html', token=token,
+            error='An error occurred. Please try again.')
+
+# ==================== FILE MANAGEMENT ROUTES ====================
+
+@app.route('/')
+def index():
+    if 'user_email' not in session:
+        return redirect(url_for('login_page'))
+    return render_template('index.html', user_email=session.get('user_email'))
+
+
+@app.route('/api/upload', methods=['POST'])
+@login_required
+@rate_limited('upload')
+def upload_file():
+    try:
+        # Checked before request.files reads the body
+        if exceeds_quota(session.get('user_id'), 1):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'File type not allowed'}), 400
+        
+        folder = request_folder(request.form.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        # Werkzeug spools large form files to disk, so this reads in chunks
+        result = store_upload(
+            file.stream,
+            secure_filename(file.filename),
+            session.get('user_id', 'unknown'),
+            session.get('user_email', 'unknown'),
+            folder
+        )
+        return jsonify(result), 200
+        
+    except QuotaExceeded:
+        return jsonify({'error': 'Storage quota exceeded'}), 400
+    except FileTooLarge:
+        return jsonify({'error': 'File size exceeds limit'}), 400
+    except RequestEntityTooLarge:
+        raise
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/upload/stream', methods=['PUT'])
+@login_required
+@rate_limited('upload')
+def upload_stream():
+    """Upload a raw request body (no multipart form); filename and folder are query parameters"""
+    try:
+        filename = request.args.get('filename', '')
+        if filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(filename):
+            return jsonify({'error': 'File type not allowed'}), 400
+        
+        if request.content_length and request.content_length > MAX_FILE_SIZE:
+            return jsonify({'error': 'File size exceeds limit'}), 400
+        
+        if exceeds_quota(session.get('user_id'), request.content_length or 1):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        folder = request_folder(request.args.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        result = store_upload(
+            request.stream,
+            secure_filename(filename),
+            session.get('user_id', 'unknown'),
+            session.get('user_email', 'unknown'),
+            folder
+        )
+        return jsonify(result), 200
+        
+    except QuotaExceeded:
+        return jsonify({'error': 'Storage quota exceeded'}), 400
+    except FileTooLarge:
+        return jsonify({'error': 'File size exceeds limit'}), 400
+    except RequestEntityTooLarge:
+        raise
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+@rate_limited('upload')
+def create_resumable_upload():
+    """Start a resumable upload: {"filename", "size", "folder"} -> session with chunk size and count"""
+    try:
+        data = request.json or {}
+        filename = data.get('filename', '')
+        size = data.get('size')
+        
+        if filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(filename):
+            return jsonify({'error': 'File type not allowed'}), 400
+        
+        if not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'File size is required'}), 400
+        
+        if size > MAX_FILE_SIZE:
+            return jsonify({'error': 'File size exceeds limit'}), 400
+        
+        if exceeds_quota(session.get('user_id'), size):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        folder = request_folder(data.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        upload = create_upload_session(
+            secure_filename(filename), size,
+            session.get('user_id', 'unknown'), session.get('user_email', 'unknown'), folder
+        )
+        return jsonify(upload_session_status(upload)), 201
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def resumable_upload_status(upload_id):
+    """Chunks received so far, so a client can resume after a dropped connection"""
+    upload = get_upload_session(upload_id, session.get('user_id'))
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload_session_status(upload)), 200
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:number>', methods=['PUT'])
+@login_required
+@rate_limited('chunk', concurrency='upload')
+def upload_chunk(upload_id, number):
+    """Store chunk <number> (1-based); the X-Chunk-SHA256 header must match the body"""
+    try:
+        upload = get_upload_session(upload_id, session.get('user_id'))
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        if upload['status'] != 'open':
+            return jsonify({'error': 'Upload is already complete'}), 409
+        
+        if not 1 <= number <= upload['chunks']:
+            return jsonify({'error': f"Chunk number must be between 1 and {upload['chunks']}"}), 400
+        
+        checksum = request.headers.get('X-Chunk-SHA256', '').lower()
+        if len(checksum) != 64 or any(c not in '0123456789abcdef' for c in checksum):
+            return jsonify({'error': 'A SHA-256 chunk checksum is required'}), 400
+        
+        expected = expected_chunk_size(upload, number)
+        if request.content_length is not None and request.content_length != expected:
+            return jsonify({'error': f'Chunk {number} must be {expected} bytes'}), 400
+        
+        data = request.stream.read(expected + 1)
+        if len(data) != expected:
+            return jsonify({'error': f'Chunk {number} must be {expected} bytes'}), 400
+        
+        with timed_span('hash'):
+            chunk_hash = hashlib.sha256(data).hexdigest()
+        if chunk_hash != checksum:
+            return jsonify({'error': 'Chunk checksum mismatch'}), 400
+        
+        store_chunk(upload, number, data, chunk_hash)
+        return jsonify({'chunk': number, 'size': len(data), 'sha256': chunk_hash}), 200
+        
+    except RequestEntityTooLarge:
+        raise
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_resumable_upload(upload_id):
+    """Assemble the chunks; 200 with the file, or 202 while it is hashed in the background"""
+    try:
+        upload = get_upload_session(upload_id, session.get('user_id'))
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        status = upload_session_status(upload)
+        if upload['status'] == 'complete':
+            return jsonify(status['file']), 200
+        if upload['status'] != 'open':
+            return jsonify(status), 202
+        if status['missing']:
+            return jsonify({'error': 'Upload is missing chunks', 'missing': status['missing']}), 400
         
-        tokens[token]['used'] = True
-        save_reset_tokens(tokens)
+        # The session stays open, so the upload can finish once space is freed
+        if exceeds_quota(upload['user_id'], upload['size']):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
         
-        return render_template('reset_password.html', 
-            success='Password reset successful! You can now login with your new password.')
+        result, _ = complete_upload_session(upload)
+        if result is not None:
+            return jsonify(result), 200
+        # Finalizing: already in progress elsewhere, or queued as a job
+        return jsonify(upload_session_status(get_upload_session(upload_id, session.get('user_id')))), 202
         
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
     except Exception as e:
-        print(f"Error in reset_password: {e}")
-        return render_template('reset_password.html', token=token,
-            error='An error occurred. Please try again.')
-
-# ==================== FILE MANAGEMENT ROUTES ====================
-
-@app.route('/')
-def index():
-    if 'user_email' not in session:
-        return redirect(url_for('login_page'))
-    return render_template('index.html', user_email=session.get('user_email'))
+        return jsonify({'error': str(e)}), 500
 
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_resumable_upload(upload_id):
+    try:
+        upload = get_upload_session(upload_id, session.get('user_id'))
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        if upload['status'] != 'open':
+            return jsonify({'error': 'Upload is already complete'}), 409
+        abort_upload_session(upload)
+        return jsonify({'message': 'Upload cancelled'}), 200
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/api/upload', methods=['POST'])
+@app.route('/api/upload/presign', methods=['POST'])
 @login_required
-def upload_file():
+def presign_upload():
+    """Hand out a presigned POST so the browser uploads straight to S3"""
+    # The bytes would land as a plain object under the user's key, skipping
+    # blobs and storage transforms; resumable uploads still go through both
+    if not DIRECT_TRANSFERS or DEDUP_STORAGE or STORAGE_COMPRESSION != 'none' or STORAGE_ENCRYPTION:
+        return jsonify({'error': 'Direct uploads are disabled'}), 404  # browsers fall back to proxied uploads
+    
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
+        data = request.json or {}
+        filename = data.get('filename', '')
+        size = data.get('size')
+        content_type = data.get('content_type') or 'application/octet-stream'
+        file_hash = str(data.get('file_hash', '')).lower()
         
-        file = request.files['file']
-        if file.filename == '':
+        if filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        if not allowed_file(file.filename):
+        if not allowed_file(filename):
             return jsonify({'error': 'File type not allowed'}), 400
         
-        # Read file content
-        file_content = file.read()
-        if len(file_content) > MAX_FILE_SIZE:
+        if not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'File size is required'}), 400
+        
+        if size > MAX_FILE_SIZE:
             return jsonify({'error': 'File size exceeds limit'}), 400
         
-        # Generate unique filename
-        original_filename = secure_filename(file.filename)
-        file_hash = generate_file_hash(file_content)
-        unique_filename = f"{uuid.uuid4().hex}_{original_filename}"
+        if exceeds_quota(session.get('user_id'), size):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
         
-        # Upload to S3 with user information
-        s3_client.put_object(
+        if len(file_hash) != 64 or any(c not in '0123456789abcdef' for c in file_hash):
+            return jsonify({'error': 'A SHA-256 file hash is required'}), 400
+        
+        folder = request_folder(data.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        original_filename = secure_filename(filename)
+        unique_filename = new_file_key(session.get('user_id', 'unknown'), original_filename, folder)
+        
+        # Every field is pinned by a policy condition, so the client cannot
+        # change ownership, size or type after the URL is signed
+        fields = {
+            'Content-Type': content_type,
+            'x-amz-meta-original-filename': original_filename,
+            'x-amz-meta-file-hash': file_hash,
+            'x-amz-meta-upload-date': datetime.now().isoformat(),
+            'x-amz-meta-user-id': session.get('user_id', 'unknown'),
+            'x-amz-meta-user-email': session.get('user_email', 'unknown')
+        }
+        conditions = [{name: value} for name, value in fields.items()]
+        conditions.append(['content-length-range', size, size])
+        
+        presigned = s3_client.generate_presigned_post(
             Bucket=S3_BUCKET,
             Key=unique_filename,
-            Body=file_content,
-            Metadata={
-                'original-filename': original_filename,
-                'file-hash': file_hash,
-                'upload-date': datetime.now().isoformat(),
-                'user-id': session.get('user_id', 'unknown'),
-                'user-email': session.get('user_email', 'unknown')
-            }
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=PRESIGNED_URL_EXPIRY
         )
         
         return jsonify({
-            'message': 'File uploaded successfully',
-            'filename': original_filename,
-            's3_key': unique_filename,
-            'file_hash': file_hash
+            'url': presigned['url'],
+            'fields': presigned['fields'],
+            's3_key': unique_filename
         }), 200
         
     except ClientError as e:
@@ -447,75 +3984,240 @@ def upload_file():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/files', methods=['GET'])
+@app.route('/api/upload/precheck', methods=['POST'])
 @login_required
-def list_files():
+def precheck_upload():
+    """Skip the transfer when the server already stores a file with this hash"""
+    if not DEDUP_STORAGE:
+        return jsonify({'error': 'Deduplicated storage is disabled'}), 404
+    
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET)
+        data = request.json or {}
+        filename = data.get('filename', '')
+        file_hash = str(data.get('file_hash', '')).lower()
+        
+        if filename == '':
+            return jsonify({'error': 'No file selected'}), 400
         
-        if 'Contents' not in response:
-            return jsonify({'files': []}), 200
+        if not allowed_file(filename):
+            return jsonify({'error': 'File type not allowed'}), 400
         
-        files = []
-        user_id = session.get('user_id')
+        folder = request_folder(data.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
         
-        for obj in response['Contents']:
-            # Skip the users.json file
-            if obj['Key'] == USERS_FILE_KEY:
-                continue
-                
-            try:
-                metadata = s3_client.head_object(Bucket=S3_BUCKET, Key=obj['Key'])
-                
-                # Only show files uploaded by current user
-                if metadata['Metadata'].get('user-id') == user_id:
-                    files.append({
-                        'key': obj['Key'],
-                        'filename': metadata['Metadata'].get('original-filename', obj['Key']),
-                        'size': obj['Size'],
-                        'last_modified': obj['LastModified'].isoformat(),
-                        'file_hash': metadata['Metadata'].get('file-hash', 'N/A')
-                    })
-            except:
-                pass
-        
-        return jsonify({'files': files}), 200
+        user_id = session.get('user_id', 'unknown')
+        if DEDUP_PRECHECK_SCOPE != 'global':
+            if not user_has_blob(user_id, file_hash):
+                return jsonify({'exists': False}), 200
+        
+        size = acquire_blob(file_hash)
+        if size is None:
+            return jsonify({'exists': False}), 200
+        
+        if exceeds_quota(user_id, size):
+            release_blob(file_hash)
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        original_filename = secure_filename(filename)
+        unique_filename = new_file_key(user_id, original_filename, folder)
+        metadata = {
+            'original-filename': original_filename,
+            'upload-date': datetime.now().isoformat(),
+            'user-id': user_id,
+            'user-email': session.get('user_email', 'unknown')
+        }
+        try:
+            put_blob_pointer(unique_filename, metadata, file_hash, size)
+        except Exception:
+            release_blob(file_hash)
+            raise
+        
+        entry = file_index_entry(unique_filename, metadata, size, datetime.now(timezone.utc).isoformat())
+        update_file_index(user_id, add=[entry])
+        return jsonify({'exists': True, **upload_result(entry), 'jobs': enqueue_post_upload(entry, user_id)}), 200
         
     except ClientError as e:
         return jsonify({'error': f'AWS Error: {str(e)}'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/download/<key>', methods=['GET'])
+@app.route('/api/upload/complete', methods=['POST'])
 @login_required
-def download_file(key):
+def complete_upload():
+    """Record a direct-to-S3 upload in the owner's file index"""
     try:
-        # Verify file belongs to user
+        key = (request.json or {}).get('s3_key', '')
+        if key == '':
+            return jsonify({'error': 'No file key provided'}), 400
+        
+        object_metadata_cache.invalidate(key)
         metadata = s3_client.head_object(Bucket=S3_BUCKET, Key=key)
         if metadata['Metadata'].get('user-id') != session.get('user_id'):
             return jsonify({'error': 'Unauthorized'}), 403
         
-        file_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
-        return send_file(
-            file_obj['Body'],
-            as_attachment=True,
-            download_name=file_obj['Metadata'].get('original-filename', key)
+        # Re-checked here: several presigned uploads may have been granted at once
+        if exceeds_quota(session.get('user_id'), metadata['ContentLength']):
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        entry = file_index_entry(
+            key, metadata['Metadata'], metadata['ContentLength'],
+            metadata['LastModified'].isoformat()
         )
+        update_file_index(session.get('user_id'), add=[entry])
+        
+        return jsonify({
+            'message': 'File uploaded successfully',
+            'filename': metadata['Metadata'].get('original-filename', key),
+            's3_key': key,
+            'file_hash': metadata['Metadata'].get('file-hash', 'N/A'),
+            'size': metadata['ContentLength'],
+            # The hash came from the client, so the stored bytes are re-checked
+            'jobs': enqueue_post_upload(entry, session.get('user_id'), direct=True)
+        }), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'File not found: {str(e)}'}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files', methods=['GET'])
+@login_required
+def list_files():
+    """List the caller's files.
+
+    Query args: limit, cursor, sort (name|size|date), order (asc|desc),
+    ext (comma separated), prefix, from/to (ISO dates) and since (ISO
+    timestamp: only changes after it, plus deleted keys).
+    """
+    try:
+        user_id = session.get('user_id')
+        server_time = datetime.now(timezone.utc).isoformat()
+        # Users from before the index existed get one built on first listing
+        ensure_file_index(user_id)
+        
+        try:
+            result = query_file_index(user_id, request.args)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+        
+        result['server_time'] = server_time
+        return jsonify(result), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/search', methods=['GET'])
+@login_required
+def search():
+    """Search the caller's files by name, extension and content, best match first.
+
+    Query args: q (words, matched as prefixes), ext, folder, from/to (ISO
+    dates), limit and cursor. Without q, filtered files are listed newest first.
+    """
+    try:
+        user_id = session.get('user_id')
+        ensure_search_index(user_id)
+        try:
+            result = search_files(user_id, request.args)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+        return jsonify(result), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/download/<path:key>', methods=['GET'])
+@login_required
+def download_file(key):
+    try:
+        entry = get_file_entry(session.get('user_id'), key)
+        if entry is None:
+            return jsonify({'error': 'File not found'}), 404
+        
+        if DIRECT_TRANSFERS:
+            metadata = get_object_metadata(key)
+            # S3 cannot decode transformed files, so those are still streamed through here
+            if not is_transformed(stored_object_metadata(key, metadata)):
+                return redirect(presigned_download_url(storage_key(key, metadata), entry['filename']))
+        
+        file_obj = open_user_file(key)
+        return s3_object_response(file_obj, entry['filename'], key)
     except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return jsonify({'error': 'Requested range not satisfiable'}), 416
         return jsonify({'error': f'File not found: {str(e)}'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/delete/<key>', methods=['DELETE'])
+@app.route('/api/preview/<path:key>', methods=['GET'])
+@login_required
+def preview_file(key):
+    """JPEG thumbnail of an image or a PDF's first page, rendered once and then served from S3"""
+    try:
+        entry = get_file_entry(session.get('user_id'), key)
+        if entry is None:
+            return jsonify({'error': 'File not found'}), 404
+        
+        filename = entry['filename']
+        if not has_thumbnail(filename):
+            return jsonify({'error': 'Preview not available for this file type'}), 404
+        
+        params = {'Bucket': S3_BUCKET, 'Key': thumbnail_key(key)}
+        if request.headers.get('If-None-Match'):
+            params['IfNoneMatch'] = request.headers['If-None-Match']
+        try:
+            preview = s3_client.get_object(**params)
+            body, etag = decoded_body(preview).read(), preview['ETag']
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                body, etag = None, request.headers['If-None-Match']
+            elif code in ('404', 'NoSuchKey') and can_render_thumbnail(filename):
+                # Not generated yet (upload job still queued, or the file predates previews)
+                stored = read_stored_file(key)
+                rendered = store_thumbnail(key, stored) if stored else None
+                if rendered is None:
+                    return jsonify({'error': 'Preview not available'}), 404
+                body, etag = rendered
+            elif code in ('404', 'NoSuchKey'):
+                return jsonify({'error': 'Preview not available'}), 404
+            else:
+                raise
+        
+        response = Response(body, status=200 if body is not None else 304, mimetype='image/jpeg')
+        response.set_etag(unquote_etag(etag)[0])
+        response.cache_control.private = True
+        response.cache_control.max_age = PREVIEW_MAX_AGE
+        response.cache_control.immutable = True
+        return response.make_conditional(request) if body is not None else response
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/delete/<path:key>', methods=['DELETE'])
 @login_required
 def delete_file(key):
     try:
-        # Verify file belongs to user
-        metadata = s3_client.head_object(Bucket=S3_BUCKET, Key=key)
-        if metadata['Metadata'].get('user-id') != session.get('user_id'):
-            return jsonify({'error': 'Unauthorized'}), 403
+        entry = get_file_entry(session.get('user_id'), key)
+        if entry is None:
+            return jsonify({'error': 'File not found'}), 404
         
         s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+        object_metadata_cache.invalidate(key)
+        # Only the request that removes the index row releases the blob and cleans up
+        if not update_file_index(session.get('user_id'), remove=[key], release_blobs=True):
+            return jsonify({'error': 'File not found'}), 404
+        if has_thumbnail(entry['filename']):
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=thumbnail_key(key))
+        delete_shares_for_keys([key])
         return jsonify({'message': 'File deleted successfully'}), 200
     except ClientError as e:
         return jsonify({'error': f'AWS Error: {str(e)}'}), 500
@@ -523,41 +4225,357 @@ def delete_file(key):
         return jsonify({'error': str(e)}), 500
 
 # File Sharing - Generate Share Link
-@app.route('/api/share/<key>', methods=['POST'])
+@app.route('/api/share/<path:key>', methods=['POST'])
 @login_required
 def share_file(key):
     try:
-        # Verify file belongs to user
-        metadata = s3_client.head_object(Bucket=S3_BUCKET, Key=key)
-        if metadata['Metadata'].get('user-id') != session.get('user_id'):
-            return jsonify({'error': 'Unauthorized'}), 403
+        entry = get_file_entry(session.get('user_id'), key)
+        if entry is None:
+            return jsonify({'error': 'File not found'}), 404
         
-        # Generate share token
-        share_token = str(uuid.uuid4())
         expiry_hours = request.json.get('expiry_hours', 24)
         expiry_time = datetime.now() + timedelta(hours=expiry_hours)
+        share = create_share(key, entry['filename'], session.get('user_id'), expiry_time)
         
-        # Store share info in metadata
-        share_data = {
-            'token': share_token,
-            'key': key,
-            'filename': metadata['Metadata'].get('original-filename', key),
-            'expiry': expiry_time.isoformat(),
-            'owner_id': session.get('user_id')
-        }
+        share_link = f"{request.host_url}shared/{share['token']}"
+        return jsonify({'share_link': share_link, 'expiry': share['expiry']}), 200
         
-        # Save to S3 as JSON
-        share_key = f'shares/{share_token}.json'
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=share_key,
-            Body=json.dumps(share_data),
-            ContentType='application/json'
-        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/shares', methods=['GET'])
+@login_required
+def list_share_links():
+    """The caller's active share links"""
+    try:
+        return jsonify({'shares': [{
+            'token': share['token'],
+            'share_link': f"{request.host_url}shared/{share['token']}",
+            'key': share['key'],
+            'filename': share['filename'],
+            'expiry': share['expiry']
+        } for share in list_shares(session.get('user_id'))]}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/shares/<token>', methods=['DELETE'])
+@login_required
+def revoke_share_link(token):
+    try:
+        if not revoke_share(token, session.get('user_id')):
+            return jsonify({'error': 'Share link not found'}), 404
+        return jsonify({'message': 'Share link revoked'}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/usage', methods=['GET'])
+@login_required
+def storage_usage():
+    """Bytes and files stored by the caller, against their quota (0 = unlimited)"""
+    try:
+        usage = get_usage(session.get('user_id'))
+        usage['remaining'] = quota_remaining(session.get('user_id'))
+        return jsonify(usage), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cache/stats', methods=['GET'])
+@login_required
+def cache_stats():
+    return jsonify({name: cache.stats() for name, cache in caches.items()}), 200
+
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """The caller's background jobs, newest first; ?status= filters"""
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), MAX_PAGE_SIZE)
+        query = 'SELECT * FROM jobs WHERE user_id = ?'
+        params = [session.get('user_id')]
+        if request.args.get('status'):
+            query += ' AND status = ?'
+            params.append(request.args['status'])
+        rows = get_db().execute(query + ' ORDER BY created_at DESC LIMIT ?', params + [limit]).fetchall()
+        return jsonify({'jobs': [job_status(row) for row in rows]}), 200
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    row = get_db().execute(
+        'SELECT * FROM jobs WHERE id = ? AND user_id = ?', (job_id, session.get('user_id'))
+    ).fetchone()
+    if row is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(row)), 200
+
+# ==================== BATCH ROUTES ====================
+
+@app.route('/api/batch/delete', methods=['POST'])
+@login_required
+def batch_delete():
+    try:
+        keys = (request.json or {}).get('keys') or []
+        if not keys:
+            return jsonify({'error': 'No files selected'}), 400
+        
+        if len(keys) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} files per request'}), 400
+        
+        user_id = session.get('user_id')
+        owned, errors = split_owned_keys(keys, user_id)
+        deleted, failed = delete_entries(user_id, owned)
+        
+        return jsonify({'deleted': deleted, 'errors': errors + failed}), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batch/download', methods=['POST'])
+@login_required
+def batch_download():
+    try:
+        keys = (request.json or {}).get('keys') or []
+        if not keys:
+            return jsonify({'error': 'No files selected'}), 400
+        
+        if len(keys) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} files per request'}), 400
+        
+        owned, errors = split_owned_keys(keys, session.get('user_id'))
+        if errors:
+            return jsonify({'error': 'Unauthorized', 'errors': errors}), 403
+        
+        response = Response(iter_zip(owned), mimetype='application/zip', direct_passthrough=True)
+        response.headers.set('Content-Disposition', 'attachment', filename='clouddrive-files.zip')
+        return response
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batch/upload', methods=['POST'])
+@login_required
+@rate_limited('upload')
+def batch_upload():
+    try:
+        if exceeds_quota(session.get('user_id'), 1):
+            return jsonify({'error': 'Storage quota exceeded'}), 400
+        
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        if len(files) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} files per request'}), 400
+        
+        user_id = session.get('user_id', 'unknown')
+        user_email = session.get('user_email', 'unknown')
+        folder = request_folder(request.form.get('folder'))
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        # The parts run concurrently, so share out the remaining quota up front
+        remaining = quota_remaining(user_id)
+        over_quota = set()
+        for file in files:
+            size = file.stream.seek(0, io.SEEK_END)
+            file.stream.seek(0)
+            if remaining is not None:
+                if size > remaining:
+                    over_quota.add(id(file))
+                else:
+                    remaining -= size
+        
+        def upload_one(file):
+            if file.filename == '':
+                return None, 'No file selected'
+            if not allowed_file(file.filename):
+                return None, 'File type not allowed'
+            if id(file) in over_quota:
+                return None, 'Storage quota exceeded'
+            try:
+                return put_user_file(file.stream, secure_filename(file.filename), user_id, user_email, folder), None
+            except QuotaExceeded:
+                return None, 'Storage quota exceeded'
+            except FileTooLarge:
+                return None, 'File size exceeds limit'
+            except Exception as e:
+                return None, str(e)
+        
+        # Each form file is its own spooled stream, so the puts can run concurrently
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            outcomes = list(pool.map(upload_one, files))
+        
+        entries = [entry for entry, _ in outcomes if entry]
+        if entries:
+            update_file_index(user_id, add=entries)
+        
+        return jsonify({
+            'uploaded': [dict(upload_result(entry), jobs=enqueue_post_upload(entry, user_id))
+                         for entry in entries],
+            'errors': [{'filename': file.filename, 'error': error}
+                       for file, (_, error) in zip(files, outcomes) if error]
+        }), 200
+        
+    except RequestEntityTooLarge:
+        raise
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ==================== FOLDER ROUTES ====================
+
+@app.route('/api/folders', defaults={'folder': ''}, methods=['GET'])
+@app.route('/api/folders/<path:folder>', methods=['GET'])
+@login_required
+def get_folder(folder):
+    """One page of a folder's subfolders and files. Query args: limit, cursor"""
+    try:
+        folder = request_folder(folder)
+        if folder is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        try:
+            limit = max(1, min(int(request.args.get('limit', MAX_PAGE_SIZE)), MAX_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'Invalid query: limit must be a number'}), 400
+        
+        result = list_folder(session.get('user_id'), folder, limit, request.args.get('cursor'))
+        if not result.pop('exists'):
+            return jsonify({'error': 'Folder not found'}), 404
+        return jsonify(result), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/folders', methods=['POST'])
+@login_required
+def create_folder_route():
+    """Create a folder (and any missing parents): {"path": "a/b"}"""
+    try:
+        folder = request_folder((request.json or {}).get('path'))
+        if not folder:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        create_folder(session.get('user_id'), folder)
+        return jsonify({'folder': folder}), 201
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/folders/<path:folder>', methods=['DELETE'])
+@login_required
+def delete_folder_route(folder):
+    """Delete a folder with its subfolders and files"""
+    try:
+        folder = request_folder(folder)
+        if not folder:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        deleted, errors = delete_folder(session.get('user_id'), folder)
+        return jsonify({'deleted': deleted, 'errors': errors}), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/move', methods=['POST'])
+@login_required
+def move_items():
+    """Move files and folders into a folder: {"keys": [...], "folders": [...], "to": "a/b"}"""
+    try:
+        data = request.json or {}
+        keys = data.get('keys') or []
+        folders = data.get('folders') or []
+        destination = request_folder(data.get('to'))
+        
+        if not keys and not folders:
+            return jsonify({'error': 'Nothing selected'}), 400
+        
+        if len(keys) + len(folders) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items per request'}), 400
+        
+        if destination is None:
+            return jsonify({'error': 'Invalid folder'}), 400
+        
+        user_id = session.get('user_id')
+        owned, errors = split_owned_keys(keys, user_id)
+        moved, failed = move_files(user_id, [
+            (entry, folder_prefix(user_id, destination) + key_basename(entry['key']), entry['filename'])
+            for entry in owned
+            if not (entry['key'].startswith(USER_PREFIX) and key_folder(entry['key']) == destination)
+        ])
+        errors += failed
+        
+        for requested in folders:
+            folder = request_folder(requested)
+            if not folder:
+                errors.append({'folder': requested, 'error': 'Invalid folder'})
+                continue
+            if destination == folder or destination.startswith(folder + '/'):
+                errors.append({'folder': folder, 'error': 'Cannot move a folder into itself'})
+                continue
+            target = '/'.join(filter(None, [destination, folder.rsplit('/', 1)[-1]]))
+            if target != folder:
+                keys_moved, failed = move_folder(user_id, folder, target)
+                moved += keys_moved
+                errors += [dict(error, folder=folder) for error in failed]
+        
+        return jsonify({'moved': moved, 'errors': errors}), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/rename', methods=['POST'])
+@login_required
+def rename_item():
+    """Rename a file or a folder in place: {"key" or "folder", "name"}"""
+    try:
+        data = request.json or {}
+        name = secure_filename(data.get('name') or '')
+        user_id = session.get('user_id')
         
-        share_link = f"{request.host_url}shared/{share_token}"
-        return jsonify({'share_link': share_link, 'expiry': expiry_time.isoformat()}), 200
+        if name == '':
+            return jsonify({'error': 'A new name is required'}), 400
         
+        if data.get('key'):
+            if not allowed_file(name):
+                return jsonify({'error': 'File type not allowed'}), 400
+            owned, errors = split_owned_keys([data['key']], user_id)
+            if errors:
+                return jsonify({'error': 'Unauthorized'}), 403
+            entry = owned[0]
+            file_id = key_basename(entry['key']).split('_', 1)[0]
+            new_key = f"{folder_prefix(user_id, key_folder(entry['key']))}{file_id}_{name}"
+            moved, errors = move_files(user_id, [(entry, new_key, name)])
+        else:
+            folder = request_folder(data.get('folder'))
+            if not folder:
+                return jsonify({'error': 'Invalid folder'}), 400
+            target = '/'.join(filter(None, [folder.rpartition('/')[0], name]))
+            moved, errors = move_folder(user_id, folder, target) if target != folder else ([], [])
+        
+        if errors:
+            return jsonify({'error': errors[0]['error'], 'moved': moved, 'errors': errors}), 500
+        return jsonify({'moved': moved}), 200
+        
+    except ClientError as e:
+        return jsonify({'error': f'AWS Error: {str(e)}'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -566,27 +4584,59 @@ def share_file(key):
 def shared_file(token):
     try:
         # Get share data
-        share_key = f'shares/{token}.json'
-        share_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=share_key)
-        share_data = json.loads(share_obj['Body'].read().decode('utf-8'))
+        share_data = load_share(token)
         
         # Check expiry
         expiry_time = datetime.fromisoformat(share_data['expiry'])
         if datetime.now() > expiry_time:
             return "This link has expired", 410
         
-        # Get the actual file
-        file_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=share_data['key'])
-        return send_file(
-            io.BytesIO(file_obj['Body'].read()),
-            as_attachment=True,
-            download_name=share_data['filename']
-        )
+        # The owner may have deleted the file since (possibly through another worker)
+        if get_file_entry(share_data['owner_id'], share_data['key']) is None:
+            return "Invalid or expired link", 404
         
-    except ClientError:
+        metadata = get_object_metadata(share_data['key']) if DIRECT_TRANSFERS else None
+        if DIRECT_TRANSFERS and not is_transformed(stored_object_metadata(share_data['key'], metadata)):
+            remaining = int((expiry_time - datetime.now()).total_seconds())
+            return redirect(presigned_download_url(
+                storage_key(share_data['key'], metadata),
+                share_data['filename'],
+                expires_in=max(1, min(PRESIGNED_URL_EXPIRY, remaining))
+            ))
+        
+        # Stream the actual file
+        file_obj = open_user_file(share_data['key'])
+        return s3_object_response(file_obj, share_data['filename'], share_data['key'])
+        
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return "Requested range not satisfiable", 416
         return "Invalid or expired link", 404
     except Exception as e:
         return f"Error: {str(e)}", 500
 
+# ==================== APPLICATION FACTORY ====================
+
+def create_app(config=None):
+    """Entry point for WSGI servers (gunicorn 'app:create_app()').
+
+    Applies optional config overrides, binds extensions and starts this
+    process's job workers. Nothing here touches the network: S3 and SMTP
+    connections are opened on first use.
+    """
+    if config:
+        app.config.update(config)
+    if TRUSTED_PROXIES and not isinstance(app.wsgi_app, ProxyFix):
+        # Rate limits key on the client address, not the load balancer's
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+    if 'mail' not in app.extensions:
+        mail.init_app(app)
+    if STORAGE_ENCRYPTION:
+        if AESGCM is None:
+            raise RuntimeError('STORAGE_ENCRYPTION needs the cryptography package')
+        storage_master_key()  # fail at boot, not on the first upload
+    start_job_workers()
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
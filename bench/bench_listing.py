@@ -0,0 +1,87 @@
+# bench/bench_listing.py - Listing latency against a local S3 stand-in (moto server)
+#
+# Seeds one user's files into a moto S3 server and times:
+#   - the bucket scan (list + one head_object per key) run sequentially
+#   - the same scan with the head_object calls issued concurrently (S3_ASYNC_IO)
+#   - the per-user index read (local SQLite rows) that GET /api/files does
+#
+# The emulator answers in well under a millisecond, so --latency-ms adds a
+# per-request delay on the client side to stand in for the S3 round trip.
+#
+# Usage: python bench/bench_listing.py [--files 5000] [--concurrency 32] [--latency-ms 20] [--runs 1]
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import BUCKET, import_app, start_s3
+
+
+def add_latency(client, seconds):
+    client.meta.events.register('before-send.s3', lambda **kwargs: time.sleep(seconds))
+
+
+def seed(app, user_id, count):
+    app.s3_client.create_bucket(Bucket=BUCKET)
+
+    def put(i):
+        app.s3_client.put_object(
+            Bucket=BUCKET, Key=f'{i:08x}_file{i}.txt', Body=b'x' * 64,
+            Metadata={'original-filename': f'file{i}.txt', 'file-hash': 'bench', 'user-id': user_id}
+        )
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        list(pool.map(put, range(count)))
+    app.rebuild_file_indexes()
+
+
+def timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    os.environ['S3_CONCURRENCY'] = str(args.concurrency)
+    server = start_s3(args.port)
+    try:
+        app = import_app()
+
+        user_id = 'bench-user'
+        seed(app, user_id, args.files)
+        add_latency(app.s3_client, args.latency_ms / 1000)
+
+        def scan():
+            assert len(app.scan_bucket_files()[user_id]) == args.files
+
+        app.S3_ASYNC_IO = False
+        sequential = timed(scan, args.runs)
+        app.S3_ASYNC_IO = True
+        concurrent = timed(scan, args.runs)
+        index = timed(lambda: app.load_file_index(user_id), args.runs)
+        page = timed(lambda: app.query_file_index(user_id, {'sort': 'name', 'limit': '100'}), args.runs)
+
+        print(f"\n{args.files} files, concurrency {args.concurrency}, "
+              f"{args.latency_ms:g} ms simulated S3 latency, median of {args.runs} runs")
+        print(f"{'bucket scan, sequential':<32}{sequential * 1000:>10.1f} ms")
+        print(f"{'bucket scan, async S3 I/O':<32}{concurrent * 1000:>10.1f} ms  ({sequential / concurrent:.1f}x)")
+        print(f"{'per-user index read':<32}{index * 1000:>10.1f} ms")
+        print(f"{'first page of 100, by name':<32}{page * 1000:>10.1f} ms")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# bench/cold_start.py - Worker boot time: import app + create_app() + first request
+#
+# Each run happens in a fresh interpreter so nothing is warm. The
+# "unreachable" case points S3 at a blackholed address: boot must not
+# wait on the network, so it should cost the same as the reachable case.
+#
+# Usage: python bench/cold_start.py [--runs 5] [--target-ms 500]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from common import REPO_ROOT, start_s3
+
+PROBE = r'''
+import json, time
+start = time.perf_counter()
+import app
+application = app.create_app()
+booted = time.perf_counter()
+response = application.test_client().get('/health')
+assert response.status_code == 200
+done = time.perf_counter()
+print(json.dumps({'boot': booted - start, 'first_request': done - booted}))
+'''
+
+
+def measure(env, runs):
+    boots, firsts = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=REPO_ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        boots.append(result['boot'])
+        firsts.append(result['first_request'])
+    return statistics.median(boots), statistics.median(firsts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CloudDrive cold start benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--target-ms', type=float, default=500)
+    parser.add_argument('--s3-port', type=int, default=5058)
+    args = parser.parse_args()
+
+    s3_server = start_s3(args.s3_port)
+    try:
+        reachable = os.environ.copy()
+        unreachable = dict(reachable, S3_ENDPOINT_URL='http://10.255.255.1:9',
+                           SQLITE_DB_PATH=os.path.join(tempfile.mkdtemp(), 'cold.db'))
+        print(f"{'case':<14}{'boot ms':>10}{'first req ms':>14}{'total ms':>10}  target {args.target_ms:.0f} ms")
+        failed = False
+        for name, env in (('reachable', reachable), ('unreachable', unreachable)):
+            boot, first = measure(env, args.runs)
+            total = (boot + first) * 1000
+            failed |= total > args.target_ms
+            print(f"{name:<14}{boot * 1000:>10.1f}{first * 1000:>14.1f}{total:>10.1f}  "
+                  f"{'ok' if total <= args.target_ms else 'OVER'}")
+    finally:
+        s3_server.terminate()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
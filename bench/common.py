@@ -0,0 +1,56 @@
+# bench/common.py - Shared helpers: a local S3 stand-in and environment setup
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = 'bench-bucket'
+
+
+def wait_for(url, timeout=30):
+    """Poll url until it answers (any HTTP status) or timeout expires"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+
+def start_s3(port):
+    """Run a moto S3 server in its own process and point the app's env at it"""
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for(f'http://127.0.0.1:{port}/moto-api/')
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_REGION': 'us-east-1',
+        'S3_BUCKET_NAME': BUCKET,
+        'S3_ENDPOINT_URL': f'http://127.0.0.1:{port}',
+        'SQLITE_DB_PATH': os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        'SESSION_COOKIE_SECURE': 'False',
+        # Every bench client shares one address; measure the app, not the limiter
+        'RATE_LIMIT_AUTH_IP': '1000000/1',
+        'RATE_LIMIT_AUTH_USER': '1000000/1',
+        'RATE_LIMIT_UPLOAD_IP': '1000000/1',
+        'RATE_LIMIT_UPLOAD_USER': '1000000/1',
+    })
+    return server
+
+
+def import_app():
+    """Import app.py with the environment set up by start_s3()"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import app
+    return app
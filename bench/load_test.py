@@ -0,0 +1,247 @@
+# bench/load_test.py - Endpoint load test against a local S3 stand-in
+#
+# Boots a moto S3 server and app.py under gunicorn, seeds USERS x FILES,
+# then drives each endpoint with CONCURRENCY client threads and reports
+# p50/p95/p99 latency, throughput and the app's peak RSS per endpoint.
+#
+# Usage: python bench/load_test.py [--users 100] [--files 10000] [--concurrency 16]
+#                                  [--requests 500] [--workers 2] [--threads 4]
+#                                  [--endpoints login,list_files,...]
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import BUCKET, REPO_ROOT, import_app, start_s3, wait_for
+
+PASSWORD = 'bench-password'
+UPLOAD_BODY = os.urandom(64 * 1024)
+
+
+# ==================== SEEDING ====================
+
+def seed(app, users, files_per_user, file_size):
+    """Write users, objects and file indexes straight to the stores"""
+    app.s3_client.create_bucket(Bucket=BUCKET)
+    password_hash = app.generate_password_hash(PASSWORD)  # hashing is slow; reuse one
+    body = b'x' * file_size
+    body_hash = app.generate_file_hash(body)
+    accounts = []
+
+    def put(args):
+        user_id, email, i = args
+        key = f'{uuid.uuid4().hex}_file{i}.txt'
+        metadata = {
+            'original-filename': f'file{i}.txt',
+            'file-hash': body_hash,
+            'upload-date': app.datetime.now().isoformat(),
+            'user-id': user_id,
+            'user-email': email
+        }
+        app.s3_client.put_object(Bucket=BUCKET, Key=key, Body=body, Metadata=metadata)
+        return app.file_index_entry(key, metadata, file_size, app.datetime.now(app.timezone.utc).isoformat())
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        for n in range(users):
+            email = f'user{n}@bench.local'
+            user_id = str(uuid.uuid4())
+            app.user_store.create(email, {
+                'user_id': user_id,
+                'password': password_hash,
+                'created_at': app.datetime.now().isoformat()
+            })
+            entries = list(pool.map(put, [(user_id, email, i) for i in range(files_per_user)]))
+            app.replace_file_index(user_id, {e['key']: e for e in entries})
+            accounts.append({'email': email, 'user_id': user_id, 'keys': [e['key'] for e in entries]})
+            print(f"\rSeeded {n + 1}/{users} users", end='', flush=True)
+    print()
+    return accounts
+
+
+# ==================== PROCESS MONITORING ====================
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of pid and its children (Linux /proc)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            with open(f'/proc/{current}/task/{current}/children') as children:
+                pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return total
+
+
+class PeakRSS:
+    """Samples the app's RSS in the background while a scenario runs"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# ==================== SCENARIOS ====================
+
+def logged_in_session(base_url, account):
+    client = requests.Session()
+    response = client.post(f'{base_url}/login', data={'email': account['email'], 'password': PASSWORD},
+                           allow_redirects=False)
+    response.raise_for_status()
+    return client
+
+
+def make_scenarios(base_url, accounts):
+    """endpoint name -> function(worker state) returning a requests.Response"""
+    def login(state):
+        account = random.choice(accounts)
+        return requests.post(f'{base_url}/login', data={'email': account['email'], 'password': PASSWORD},
+                             allow_redirects=False)
+
+    def list_files(state):
+        return state['client'].get(f'{base_url}/api/files')
+
+    def upload_file(state):
+        return state['client'].post(f'{base_url}/api/upload', files={'file': ('bench.txt', UPLOAD_BODY)})
+
+    def download_file(state):
+        key = random.choice(state['account']['keys'])
+        return state['client'].get(f'{base_url}/api/download/{key}')
+
+    def shared_file(state):
+        return requests.get(f"{base_url}/shared/{state['share_token']}")
+
+    return {
+        'login': login,
+        'list_files': list_files,
+        'upload_file': upload_file,
+        'download_file': download_file,
+        'shared_file': shared_file
+    }
+
+
+def run_scenario(scenario, states, total_requests):
+    """Run total_requests calls spread over one thread per state"""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    remaining = iter(range(total_requests))
+
+    def worker(state):
+        nonlocal errors
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                response = scenario(state)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(states)) as pool:
+        list(pool.map(worker, states))
+    return latencies, errors, time.perf_counter() - started
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# ==================== MAIN ====================
+
+def main():
+    parser = argparse.ArgumentParser(description='CloudDrive endpoint load test')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--files', type=int, default=10000, help='files per user')
+    parser.add_argument('--file-size', type=int, default=1024)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--endpoints', default='login,list_files,upload_file,download_file,shared_file')
+    parser.add_argument('--s3-port', type=int, default=5056)
+    parser.add_argument('--app-port', type=int, default=5057)
+    args = parser.parse_args()
+
+    s3_server = start_s3(args.s3_port)
+    app_server = None
+    try:
+        app = import_app()
+        accounts = seed(app, args.users, args.files, args.file_size)
+
+        app_server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+             '--bind', f'127.0.0.1:{args.app_port}', 'app:create_app()'],
+            cwd=REPO_ROOT, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        base_url = f'http://127.0.0.1:{args.app_port}'
+        wait_for(f'{base_url}/health')
+
+        # One logged-in client per concurrent worker, each with its own user and share link
+        states = []
+        for n in range(args.concurrency):
+            account = accounts[n % len(accounts)]
+            client = logged_in_session(base_url, account)
+            share = client.post(f"{base_url}/api/share/{account['keys'][0]}", json={'expiry_hours': 24}).json()
+            states.append({'client': client, 'account': account,
+                           'share_token': share['share_link'].rsplit('/', 1)[1]})
+
+        scenarios = make_scenarios(base_url, accounts)
+        print(f"\n{args.users} users x {args.files} files, {args.concurrency} clients, "
+              f"{args.requests} requests per endpoint, gunicorn {args.workers}x{args.threads}")
+        print(f"{'endpoint':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}{'peak RSS MB':>13}")
+
+        for name in args.endpoints.split(','):
+            with PeakRSS(app_server.pid) as rss:
+                latencies, errors, elapsed = run_scenario(scenarios[name], states, args.requests)
+            latencies.sort()
+            print(f"{name:<16}"
+                  f"{percentile(latencies, 50) * 1000:>10.1f}"
+                  f"{percentile(latencies, 95) * 1000:>10.1f}"
+                  f"{percentile(latencies, 99) * 1000:>10.1f}"
+                  f"{len(latencies) / elapsed:>10.1f}"
+                  f"{errors:>8}"
+                  f"{rss.peak / (1024 * 1024):>13.1f}")
+    finally:
+        if app_server:
+            app_server.terminate()
+        s3_server.terminate()
+
+
+if __name__ == '__main__':
+    main()
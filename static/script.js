@@ -5,6 +5,19 @@ const API_URL = "https://clouddrive-secure-file-storage-system.onrender.com/api"
 // Search and filter variables
 let allFiles = [];
 let filteredFiles = [];
+
+// Server time of the last listing, so refreshes only fetch what changed since
+let lastSync = null;
+// Folder being viewed ('' is the root); uploads go into it
+let currentFolder = '';
+let currentSubfolders = [];
+// Active server-side search ('' when browsing folders)
+let searchQuery = '';
+let searchTimer = null;
+const SEARCH_DELAY = 300;
+const PAGE_SIZE = 500;
+const RESUMABLE_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
 // Upload functionality
 const fileInput = document.getElementById('fileInput');
 const dropZone = document.getElementById('dropZone');
@@ -36,20 +49,44 @@ async function handleFiles(files) {
     for (let file of files) {
         await uploadFile(file);
     }
-    loadFiles();
 }
 
 async function uploadFile(file) {
-    const formData = new FormData();
-    formData.append('file', file);
-
     // Create progress indicator
     const progressId = 'progress-' + Date.now();
     showUploadProgress(file.name, progressId);
 
     try {
+        // Web Crypto is only available on secure origins
+        const canHash = Boolean(window.crypto && crypto.subtle);
+
+        if (canHash && file.size > RESUMABLE_THRESHOLD) {
+            // Large files go up in checksummed chunks that survive a dropped connection.
+            // Web Crypto can only hash a whole buffer, so the file is never hashed
+            // as one piece here: the server hashes (and deduplicates) it as it finalizes.
+            await uploadResumable(file, progressId);
+        } else {
+            const fileHash = canHash ? await sha256Hex(file) : null;
+
+            // Skip the transfer entirely when the server already has these bytes,
+            // else prefer a direct-to-S3 upload (the server answers 404 for modes that are off)
+            const uploaded = (fileHash && await precheckUpload(file, fileHash))
+                || await uploadDirect(file, progressId, fileHash);
+            if (!uploaded) await uploadViaServer(file, progressId);
+        }
+        completeUploadProgress(progressId);
+        showNotification('File uploaded successfully!', 'success');
+        syncFiles();
+    } catch (error) {
+        failUploadProgress(progressId);
+        showNotification(error.message || 'Upload failed', 'error');
+    }
+}
+
+function sendWithProgress(url, body, progressId, withCredentials, method = 'POST') {
+    return new Promise((resolve, reject) => {
         const xhr = new XMLHttpRequest();
-        
+
         // Track upload progress
         xhr.upload.addEventListener('progress', (e) => {
             if (e.lengthComputable) {
@@ -57,71 +94,270 @@ async function uploadFile(file) {
                 updateUploadProgress(progressId, percentComplete);
             }
         });
-        
-        xhr.addEventListener('load', () => {
-            if (xhr.status === 200) {
-                completeUploadProgress(progressId);
-                showNotification('File uploaded successfully!', 'success');
-                setTimeout(() => loadFiles(), 1000);
-            } else {
-                failUploadProgress(progressId);
-                const data = JSON.parse(xhr.responseText);
-                showNotification(data.error || 'Upload failed', 'error');
+
+        xhr.addEventListener('load', () => resolve(xhr));
+        xhr.addEventListener('error', () => reject(new Error('Network error during upload')));
+
+        xhr.open(method, url);
+        xhr.withCredentials = withCredentials;
+        xhr.send(body);
+    });
+}
+
+// The raw body is streamed to S3 as it arrives, so the server never spools it
+async function uploadViaServer(file, progressId) {
+    const params = new URLSearchParams({ filename: file.name, folder: currentFolder });
+    const xhr = await sendWithProgress(`${API_URL}/upload/stream?${params}`, file, progressId, true, 'PUT');
+    if (xhr.status !== 200) {
+        const data = JSON.parse(xhr.responseText);
+        throw new Error(data.error || 'Upload failed');
+    }
+}
+
+async function sha256Hex(blob) {
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function apiJson(url, options = {}) {
+    const response = await fetch(url, { credentials: 'include', ...options });
+    const data = await response.json();
+    if (!response.ok && response.status !== 202) {
+        throw new Error(data.error || 'Upload failed');
+    }
+    return { status: response.status, data };
+}
+
+// Resumable upload: the session id is kept in localStorage, so re-adding the
+// same file after a failure or a page reload only sends the missing chunks
+async function uploadResumable(file, progressId) {
+    const storageKey = `upload:${currentFolder}:${file.name}:${file.size}:${file.lastModified}`;
+    let upload = null;
+
+    const savedId = localStorage.getItem(storageKey);
+    if (savedId) {
+        const response = await fetch(`${API_URL}/uploads/${savedId}`, { credentials: 'include' });
+        if (response.ok) {
+            upload = await response.json();
+            if (upload.status !== 'open') upload = null;
+        }
+    }
+    if (!upload) {
+        upload = (await apiJson(`${API_URL}/uploads`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, folder: currentFolder })
+        })).data;
+        localStorage.setItem(storageKey, upload.upload_id);
+    }
+
+    let sent = upload.bytes_received;
+    updateUploadProgress(progressId, (sent / file.size) * 100);
+
+    for (const number of upload.missing) {
+        const start = (number - 1) * upload.chunk_size;
+        const chunk = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+        const checksum = await sha256Hex(chunk);
+
+        for (let attempt = 1; ; attempt++) {
+            try {
+                await apiJson(`${API_URL}/uploads/${upload.upload_id}/chunks/${number}`, {
+                    method: 'PUT',
+                    headers: { 'X-Chunk-SHA256': checksum },
+                    body: chunk
+                });
+                break;
+            } catch (error) {
+                if (attempt >= CHUNK_RETRIES) throw error;
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
             }
-        });
-        
-        xhr.addEventListener('error', () => {
-            failUploadProgress(progressId);
-            showNotification('Network error during upload', 'error');
-        });
-        
-        xhr.open('POST', `${API_URL}/upload`);
-        xhr.withCredentials = true;
-        xhr.send(formData);
-        
-    } catch (error) {
-        failUploadProgress(progressId);
-        showNotification('Network error: ' + error.message, 'error');
+        }
+        sent += chunk.size;
+        updateUploadProgress(progressId, (sent / file.size) * 100);
     }
+
+    let result = await apiJson(`${API_URL}/uploads/${upload.upload_id}/complete`, { method: 'POST' });
+    // 202: the server is still hashing the assembled file
+    while (result.status === 202) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        result = await apiJson(`${API_URL}/uploads/${upload.upload_id}/complete`, { method: 'POST' });
+    }
+    localStorage.removeItem(storageKey);
+}
+
+async function precheckUpload(file, fileHash) {
+    const response = await fetch(`${API_URL}/upload/precheck`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: JSON.stringify({ filename: file.name, file_hash: fileHash, folder: currentFolder })
+    });
+    if (!response.ok) return false;
+
+    const data = await response.json();
+    return data.exists;
+}
+
+async function uploadDirect(file, progressId, fileHash) {
+    if (!fileHash) return false;
+
+    const presignResponse = await fetch(`${API_URL}/upload/presign`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: JSON.stringify({
+            filename: file.name,
+            size: file.size,
+            content_type: file.type || 'application/octet-stream',
+            file_hash: fileHash,
+            folder: currentFolder
+        })
+    });
+
+    if (presignResponse.status === 404) return false;
+
+    const presigned = await presignResponse.json();
+    if (!presignResponse.ok) {
+        throw new Error(presigned.error || 'Upload failed');
+    }
+
+    // The file must be the last field of an S3 POST upload
+    const formData = new FormData();
+    Object.entries(presigned.fields).forEach(([name, value]) => formData.append(name, value));
+    formData.append('file', file);
+
+    const xhr = await sendWithProgress(presigned.url, formData, progressId, false);
+    if (xhr.status < 200 || xhr.status >= 300) {
+        throw new Error('Upload to storage failed');
+    }
+
+    const completeResponse = await fetch(`${API_URL}/upload/complete`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: JSON.stringify({ s3_key: presigned.s3_key })
+    });
+    if (!completeResponse.ok) {
+        const data = await completeResponse.json();
+        throw new Error(data.error || 'Upload failed');
+    }
+    return true;
 }
+// List the current folder: its subfolders and files
 async function loadFiles() {
     try {
-        const response = await fetch(`${API_URL}/files`, {
-            credentials: 'include'  // Important for sessions
-        });
+        let files = [];
+        let folders = [];
+        let cursor = null;
+        // The server's clock, from before the first page: sync asks for changes after it
+        let serverTime = null;
+
+        do {
+            const params = new URLSearchParams({ limit: PAGE_SIZE });
+            if (cursor) params.set('cursor', cursor);
+
+            const response = await fetch(`${API_URL}/folders/${currentFolder}?${params}`, {
+                credentials: 'include'  // Important for sessions
+            });
+
+            if (response.status === 401) {
+                window.location.href = '/login';
+                return;
+            }
 
-        if (response.status === 401) {
-            window.location.href = '/login';
-            return;
-        }
+            // The folder was moved or deleted elsewhere
+            if (response.status === 404 && currentFolder) {
+                return openFolder('');
+            }
 
-        const data = await response.json();
+            const data = await response.json();
 
-        if (response.ok) {
-            displayFiles(data.files);
-        } else {
-            filesList.innerHTML = '<p class="loading">Error loading files</p>';
-        }
+            if (!response.ok) {
+                filesList.innerHTML = '<p class="loading">Error loading files</p>';
+                return;
+            }
+
+            serverTime = serverTime || data.server_time;
+            files = files.concat(data.files);
+            folders = folders.concat(data.folders);
+            cursor = data.next_cursor;
+        } while (cursor);
+
+        lastSync = serverTime;
+        currentSubfolders = folders;
+        displayFiles(files.sort((a, b) => b.last_modified.localeCompare(a.last_modified)));
     } catch (error) {
         filesList.innerHTML = '<p class="loading">Network error</p>';
     }
 }
 
-function displayFiles(files) {
+// Merge only the changes since the last listing into allFiles
+async function syncFiles() {
+    if (searchQuery) return runSearch();
+    if (!lastSync) return loadFiles();
+
+    try {
+        const params = new URLSearchParams({ since: lastSync, folder: currentFolder });
+        const response = await fetch(`${API_URL}/files?${params}`, {
+            credentials: 'include'
+        });
+        const data = await response.json();
+
+        if (!response.ok || data.full_resync) return loadFiles();
+
+        const changed = new Set(data.files.map(file => file.key).concat(data.deleted));
+        const files = allFiles.filter(file => !changed.has(file.key)).concat(data.files);
+        files.sort((a, b) => b.last_modified.localeCompare(a.last_modified));
+
+        lastSync = data.server_time;
+        displayFiles(files);
+    } catch (error) {
+        loadFiles();
+    }
+}
+
+function displayFiles(files, emptyMessage) {
     allFiles = files; // Store all files globally
+    renderBreadcrumb();
     
-    if (files.length === 0) {
-        filesList.innerHTML = '<p class="loading">No files uploaded yet</p>';
+    if (files.length === 0 && currentSubfolders.length === 0) {
+        emptyMessage = emptyMessage || (currentFolder ? 'This folder is empty' : 'No files uploaded yet');
+        filesList.innerHTML = `<p class="loading">${emptyMessage}</p>`;
+        updateStorageDisplay();
         return;
     }
 
-    filesList.innerHTML = files.map(file => `
+    filesList.innerHTML = currentSubfolders.map(name => {
+        const path = joinPath(currentFolder, name);
+        return `
+        <div class="file-item folder-item" data-filename="${name.toLowerCase()}" data-type="folder">
+            <div class="file-info" onclick="openFolder('${path}')">
+                <div class="file-icon">📁</div>
+                <div class="file-details">
+                    <h4>${name}</h4>
+                    <p>Folder</p>
+                </div>
+            </div>
+            <div class="file-actions">
+                <button class="btn-icon" onclick="renameItem({ folder: '${path}' }, '${name}')" title="Rename">
+                    ✏️
+                </button>
+                <button class="btn-icon" onclick="moveItem({ folders: ['${path}'] })" title="Move">
+                    📂
+                </button>
+                <button class="btn-icon" onclick="deleteFolder('${path}')" title="Delete">
+                    🗑️
+                </button>
+            </div>
+        </div>`;
+    }).join('') + files.map(file => `
         <div class="file-item" data-filename="${file.filename.toLowerCase()}" data-type="${getFileType(file.filename)}">
             <div class="file-info">
-                <div class="file-icon">${getFileIcon(file.filename)}</div>
+                <div class="file-icon">${getFileThumbnail(file)}</div>
                 <div class="file-details">
                     <h4>${file.filename}</h4>
-                    <p>${formatFileSize(file.size)} • ${formatDate(file.last_modified)}</p>
+                    <p>${formatFileSize(file.size)} • ${formatDate(file.last_modified)}${searchQuery && file.folder ? ` • 📁 ${file.folder}` : ''}</p>
+                    ${file.snippet ? `<p class="search-snippet">${escapeHtml(file.snippet)}</p>` : ''}
                 </div>
             </div>
             <div class="file-actions">
@@ -134,6 +370,12 @@ function displayFiles(files) {
                 <button class="btn-icon" onclick="shareFile('${file.key}', '${file.filename}')" title="Share">
                     🔗
                 </button>
+                <button class="btn-icon" onclick="renameItem({ key: '${file.key}' }, '${file.filename}')" title="Rename">
+                    ✏️
+                </button>
+                <button class="btn-icon" onclick="moveItem({ keys: ['${file.key}'] })" title="Move">
+                    📂
+                </button>
                 <button class="btn-icon" onclick="deleteFile('${file.key}')" title="Delete">
                     🗑️
                 </button>
@@ -144,6 +386,90 @@ function displayFiles(files) {
     updateStorageDisplay();
 }
 
+// ==================== FOLDERS ====================
+
+function joinPath(folder, name) {
+    return folder ? `${folder}/${name}` : name;
+}
+
+function openFolder(path) {
+    clearSearch();
+    currentFolder = path;
+    lastSync = null;
+    loadFiles();
+}
+
+function renderBreadcrumb() {
+    const breadcrumb = document.getElementById('breadcrumb');
+    if (searchQuery) {
+        breadcrumb.innerHTML = `${allFiles.length} result${allFiles.length === 1 ? '' : 's'} for "${escapeHtml(searchQuery)}" · <a onclick="openFolder(currentFolder)">Clear search</a>`;
+        return;
+    }
+    const segments = currentFolder ? currentFolder.split('/') : [];
+    breadcrumb.innerHTML = [`<a onclick="openFolder('')">Home</a>`].concat(
+        segments.map((name, i) => `<a onclick="openFolder('${segments.slice(0, i + 1).join('/')}')">${name}</a>`)
+    ).join(' / ');
+}
+
+async function folderRequest(url, method, body) {
+    const response = await fetch(url, {
+        method,
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: body ? JSON.stringify(body) : undefined
+    });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Request failed');
+    if (data.errors && data.errors.length) throw new Error(data.errors[0].error);
+    return data;
+}
+
+async function createFolder() {
+    const name = prompt('Folder name:');
+    if (!name) return;
+    try {
+        await folderRequest(`${API_URL}/folders`, 'POST', { path: joinPath(currentFolder, name) });
+        loadFiles();
+    } catch (error) {
+        showNotification(error.message, 'error');
+    }
+}
+
+async function renameItem(item, currentName) {
+    const name = prompt('New name:', currentName);
+    if (!name || name === currentName) return;
+    try {
+        await folderRequest(`${API_URL}/rename`, 'POST', { ...item, name });
+        showNotification('Renamed', 'success');
+    } catch (error) {
+        showNotification(error.message, 'error');
+    }
+    loadFiles();
+}
+
+async function moveItem(items) {
+    const destination = prompt('Move to folder (empty for Home):', currentFolder);
+    if (destination === null) return;
+    try {
+        await folderRequest(`${API_URL}/move`, 'POST', { ...items, to: destination });
+        showNotification('Moved', 'success');
+    } catch (error) {
+        showNotification(error.message, 'error');
+    }
+    loadFiles();
+}
+
+async function deleteFolder(path) {
+    if (!confirm(`Delete the folder "${path}" and everything in it?`)) return;
+    try {
+        await folderRequest(`${API_URL}/folders/${path}`, 'DELETE');
+        showNotification('Folder deleted', 'success');
+    } catch (error) {
+        showNotification(error.message, 'error');
+    }
+    loadFiles();
+}
+
 async function downloadFile(key, filename) {
     try {
         window.location.href = `${API_URL}/download/${key}`;
@@ -164,7 +490,7 @@ async function deleteFile(key) {
 
         if (response.ok) {
             showNotification('File deleted successfully', 'success');
-            loadFiles();
+            syncFiles();
         } else if (response.status === 401) {
             showNotification('Session expired. Please login again.', 'error');
             setTimeout(() => window.location.href = '/login', 2000);
@@ -224,19 +550,65 @@ function getFileIcon(filename) {
     return icons[type];
 }
 
-// Search functionality
+// Images and PDFs get a server-rendered thumbnail; lazy so only visible rows load one
+function getFileThumbnail(file) {
+    const type = getFileType(file.filename);
+    if (type !== 'image' && type !== 'pdf') return getFileIcon(file.filename);
+    return `<img src="${API_URL}/preview/${file.key}" alt="" loading="lazy"
+                 onerror="this.replaceWith(document.createTextNode('${getFileIcon(file.filename)}'))">`;
+}
+
+// Search functionality: names and document text, searched on the server as you type
 function searchFiles() {
-    const searchTerm = document.getElementById('searchInput').value.toLowerCase();
-    const fileItems = document.querySelectorAll('.file-item');
-    
-    fileItems.forEach(item => {
-        const filename = item.dataset.filename;
-        if (filename.includes(searchTerm)) {
-            item.style.display = 'flex';
-        } else {
-            item.style.display = 'none';
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runSearch, SEARCH_DELAY);
+}
+
+async function runSearch() {
+    const query = document.getElementById('searchInput').value.trim();
+    if (!query) {
+        if (searchQuery) openFolder(currentFolder);
+        return;
+    }
+
+    try {
+        const params = new URLSearchParams({ q: query, limit: PAGE_SIZE });
+        const response = await fetch(`${API_URL}/search?${params}`, {
+            credentials: 'include'
+        });
+
+        if (response.status === 401) {
+            window.location.href = '/login';
+            return;
         }
-    });
+
+        const data = await response.json();
+        // A newer search or navigation has replaced this one
+        if (query !== document.getElementById('searchInput').value.trim()) return;
+
+        if (!response.ok) {
+            filesList.innerHTML = `<p class="loading">${escapeHtml(data.error || 'Search failed')}</p>`;
+            return;
+        }
+
+        searchQuery = query;
+        currentSubfolders = [];
+        displayFiles(data.results, 'No matching files');
+    } catch (error) {
+        filesList.innerHTML = '<p class="loading">Network error</p>';
+    }
+}
+
+function clearSearch() {
+    clearTimeout(searchTimer);
+    searchQuery = '';
+    document.getElementById('searchInput').value = '';
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
 }
 
 // Filter functionality
@@ -260,17 +632,29 @@ function filterFiles(type) {
     });
 }
 
-// Update storage display
-function updateStorageDisplay() {
-    const totalSize = allFiles.reduce((sum, file) => sum + file.size, 0);
-    const totalSizeMB = (totalSize / (1024 * 1024)).toFixed(2);
-    const fileCount = allFiles.length;
-    const limitMB = 200;
-    const percentage = Math.min((totalSizeMB / limitMB) * 100, 100);
+// Update storage display from the server's usage counters (the list may be partial)
+async function updateStorageDisplay() {
+    let usage = {
+        bytes: allFiles.reduce((sum, file) => sum + file.size, 0),
+        files: allFiles.length,
+        quota: 200 * 1024 * 1024
+    };
+    try {
+        const response = await fetch(`${API_URL}/usage`, { credentials: 'include' });
+        if (response.ok) usage = await response.json();
+    } catch (error) {
+        // Keep the local estimate
+    }
+
+    const totalSizeMB = (usage.bytes / (1024 * 1024)).toFixed(2);
+    const percentage = usage.quota ? Math.min((usage.bytes / usage.quota) * 100, 100) : 0;
     
     document.getElementById('storageUsed').textContent = `${totalSizeMB} MB`;
-    document.getElementById('fileCount').textContent = fileCount;
+    document.getElementById('fileCount').textContent = usage.files;
     document.getElementById('storageProgress').style.width = `${percentage}%`;
+    document.getElementById('storageLimit').textContent = usage.quota
+        ? `${Math.round(usage.quota / (1024 * 1024))} MB limit`
+        : 'No storage limit';
     
     // Change color based on usage
     const progressBar = document.getElementById('storageProgress');